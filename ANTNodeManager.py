@@ -0,0 +1,80 @@
+import logging
+import threading
+
+from ANTSensorProxy import create_device, create_node
+
+LOG = logging.getLogger(__name__)
+
+
+class ANTNodeManager:
+    # Owns the single openant Node on a USB stick and opens one channel per registered ANT+ proxy, so HR, power and
+    # CSC sensors share one dongle, one network key setup and one node thread.
+    def __init__(self):
+        self.node = None
+        self.node_thread = None
+        self.devices = {}
+        # (device type, device id) -> device of an unregistered proxy, whose channel is kept open
+        self.detached = {}
+        self.lock = threading.Lock()
+
+    @property
+    def max_channels(self):
+        return self.node.max_channels if self.node is not None else 0
+
+    def register(self, proxy):
+        with self.lock:
+            if self.node is None:
+                self.node = create_node()
+            key = (proxy.device_type, proxy.device_id)
+            if key in self.devices:
+                raise ValueError(f"ANT+ device {key} is already registered")
+            device = self.detached.pop(key, None)
+            if device is None:
+                if len(self.node.channels) >= self.node.max_channels:
+                    raise RuntimeError(f"ANT+ node has no free channels ({self.node.max_channels} in use)")
+                device = create_device(self.node, proxy.device_type, proxy.device_id)
+            device.on_found = proxy._dispatch(proxy.on_found)
+            device.on_device_data = proxy._dispatch(proxy.instrument_handler(proxy.on_device_data))
+            device.on_update = proxy.capture_page
+            self.devices[key] = device
+            proxy.node = self.node
+            proxy.device = device
+            if self.node_thread is None:
+                self.node_thread = threading.Thread(target=self.node.start, name="ANTNodeManager")
+                self.node_thread.start()
+        LOG.info("ANT+ node| registered %s (%d/%d channels)", device, len(self.devices), self.node.max_channels)
+
+    def unregister(self, proxy):
+        # openant routes data by position in node.channels and numbers new channels by its length, so removing a
+        # channel other than the last would hand the pages of the remaining devices to the wrong channels. The channel
+        # stays open with its callbacks detached instead, and is reused when the proxy registers again.
+        with self.lock:
+            key = (proxy.device_type, proxy.device_id)
+            device = self.devices.pop(key, None)
+            if device is not None:
+                device.on_found = ignore
+                device.on_device_data = ignore
+                device.on_update = ignore
+                self.detached[key] = device
+            proxy.device = None
+            if not self.devices:
+                self._stop_node()
+
+    def stop(self):
+        with self.lock:
+            self.devices = {}
+            self._stop_node()
+
+    def _stop_node(self):
+        if self.node is not None:
+            # the last channel first, so the channels still open keep their positions
+            for channel in reversed(list(self.node.channels)):
+                self.node.remove_channel(channel)
+            self.node.stop()
+        self.node = None
+        self.node_thread = None
+        self.detached = {}
+
+
+def ignore(*args):
+    pass
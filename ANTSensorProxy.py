@@ -1,40 +1,122 @@
+import asyncio
+import importlib
+import logging
 import threading
 import time
 
-from openant.easy.node import Node
-from openant.devices import ANTPLUS_NETWORK_KEY
-from openant.devices.bike_speed_cadence import (
-    BikeSpeedCadence,
-    BikeSpeedData,
-    BikeCadenceData,
-)
-from openant.devices.heart_rate import (
-    HeartRateData
+from AbstractSensorProxy import AbstractSensorProxy
+from CaptureJournal import JOURNAL_KIND_ANT_PAGE
+from CSCEngine import (
+    CSCEngine,
+    ANT_WHEEL_FORMAT,
+    ANT_CRANK_FORMAT,
+    WHEEL_CIRCUMFERENCE_M_700CX23,
+    WHEEL_CIRCUMFERENCE_M_700CX25,
+    WHEEL_CIRCUMFERENCE_M_700CX28,
 )
-from openant.devices.power_meter import (
-    PowerData
+from DataPoints import (
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
 )
 
-from AbstractSensorProxy import AbstractSensorProxy
-
-WHEEL_CIRCUMFERENCE_M_700CX23 = 2.096
-WHEEL_CIRCUMFERENCE_M_700CX25 = 2.109
-WHEEL_CIRCUMFERENCE_M_700CX28 = 2.127
-
 DEVICE_TYPE_HEART_RATE = 1
 DEVICE_TYPE_POWER = 2
 DEVICE_TYPE_CSC = 3
+DEVICE_TYPE_FITNESS_EQUIPMENT = 4
+
+LOG = logging.getLogger(__name__)
+
+# device type -> (openant.devices module, device class, {device data class: ANTDataHandlers handler}). openant is only
+# imported when the first ANT+ device is created, so configs without ANT+ sensors start without it.
+DEVICE_PROFILES = {
+    DEVICE_TYPE_HEART_RATE: ("heart_rate", "HeartRate", {"HeartRateData": "on_heart_rate_data"}),
+    DEVICE_TYPE_POWER: ("power_meter", "PowerMeter", {"PowerData": "on_power_data"}),
+    DEVICE_TYPE_CSC: ("bike_speed_cadence", "BikeSpeedCadence",
+                      {"BikeCadenceData": "on_cadence_data", "BikeSpeedData": "on_speed_data"}),
+    DEVICE_TYPE_FITNESS_EQUIPMENT: ("fitness_equipment", "FitnessEquipment", {}),
+}
+# device type -> (device class, {device data class: handler function}), filled by load_device_profile()
+LOADED_PROFILES = {}
+
+
+def load_device_profile(device_type):
+    profile = LOADED_PROFILES.get(device_type)
+    if profile is None:
+        module_name, class_name, data_handlers = DEVICE_PROFILES[device_type]
+        module = importlib.import_module(f"openant.devices.{module_name}")
+        profile = (getattr(module, class_name), {getattr(module, data_class): getattr(ANTDataHandlers, handler)
+                                                 for data_class, handler in data_handlers.items()})
+        LOADED_PROFILES[device_type] = profile
+    return profile
+
+
+def create_device(node, device_type, device_id):
+    return load_device_profile(device_type)[0](node, device_id)
+
+
+def create_node():
+    from openant.easy.node import Node
+    from openant.devices import ANTPLUS_NETWORK_KEY
+    node = Node()
+    node.set_network_key(0x00, ANTPLUS_NETWORK_KEY)
+    return node
+
+
+class ANTDataHandlers:
+    # Publishes the device data openant decodes, shared by ANTSensorProxy and ReplaySensorProxy. Used with
+    # AbstractSensorProxy, whose subclasses set device_type, device, connecting and an ANT+ format csc_engine.
+    def on_found(self):
+        LOG.info("%s| %s found and receiving", self.name, self.device)
+        self.connecting = False
+        self.set_connected(True)
+
+    def on_device_data(self, page: int, page_name: str, data):
+        LOG.debug("Data received: %s", data)
+        # handlers are looked up on the data's exact class, the openant data classes do not subclass each other
+        handler = load_device_profile(self.device_type)[1].get(type(data))
+        if handler is not None:
+            handler(self, data)
+
+    def on_cadence_data(self, data):
+        self.csc_engine.update_crank(data.cumulative_cadence_revolution[1],
+                                     round(data.bike_cadence_event_time[1] * 1024))
+        self.publish(DATA_POINT_CADENCE, self.csc_engine.cadence)
+        LOG.debug("cadence: %.0f rpm", self.last_cadence_value)
 
+    def on_speed_data(self, data):
+        self.csc_engine.update_wheel(data.cumulative_speed_revolution[1],
+                                     round(data.bike_speed_event_time[1] * 1024))
+        self.publish(DATA_POINT_SPEED, self.csc_engine.speed)
+        self.publish(DATA_POINT_DISTANCE, self.csc_engine.distance)
+        LOG.debug("speed: %.2f km/h", self.last_speed_value)
 
-class ANTSensorProxy(AbstractSensorProxy):
-    def __init__(self, device_type: int, device_id, connection_retries=3):
-        super().__init__(connection_retries)
+    def on_power_data(self, data):
+        power = data.instantaneous_power
+        if power:
+            self.publish(DATA_POINT_POWER, power)
+            LOG.debug("power: %s W", power)
+
+    def on_heart_rate_data(self, data):
+        hr = data.heart_rate
+        if hr:
+            self.publish(DATA_POINT_HEART_RATE, hr)
+            LOG.debug("HR: %s bpm", hr)
+
+
+class ANTSensorProxy(ANTDataHandlers, AbstractSensorProxy):
+    def __init__(self, device_type: int, device_id, connection_retries=3, data_bus=None, node_manager=None,
+                 wheel_circumference_m=WHEEL_CIRCUMFERENCE_M_700CX25):
+        super().__init__(connection_retries, data_bus, f"ANT+ {device_id}")
         self.device_type = device_type
         self.device_id = device_id
+        self.node_manager = node_manager
+        self.csc_engine = CSCEngine(wheel_circumference_m, ANT_WHEEL_FORMAT, ANT_CRANK_FORMAT)
         self.node = None
         self.device = None
         self.connecting = False
-        self.connected = False
 
     def start(self):
         if self.running:
@@ -43,90 +125,75 @@ class ANTSensorProxy(AbstractSensorProxy):
         n_tries = 0
         while n_tries <= self.connection_retries and self.running and not self.connected:
             if n_tries > 0:
-                print(f"ANT+ sensor {self.device_id}| retrying connection ({n_tries})")
+                LOG.info("ANT+ sensor %s| retrying connection (%d)", self.device_id, n_tries)
             n_tries += 1
             try:
                 t = threading.Thread(target=self._start_sensor_thread)
                 t.start()
-                print(f"!!!CONNECTING")
+                LOG.debug("ANT+ sensor %s| connecting", self.device_id)
                 while self.connecting:
                     time.sleep(0.05)
-                print(f"!!!CONNECTED: {self.connected}")
+                LOG.debug("ANT+ sensor %s| connected: %s", self.device_id, self.connected)
             except Exception as e:
-                print(f"ANT+ sensor {self.device_id}| error starting thread: ({e})")
-        print("!!!END!!!")
+                LOG.error("ANT+ sensor %s| error starting thread: (%s)", self.device_id, e)
+
+    async def run(self):
+        # Node.start() blocks until the node is stopped, so it runs on an executor thread and device callbacks are
+        # handed back to the sensor loop
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+        if self.node_manager is None:
+            await self.loop.run_in_executor(None, self._start_sensor_thread)
+            return
+        await self.loop.run_in_executor(None, self.node_manager.register, self)
+        try:
+            while self.running:
+                await asyncio.sleep(0.5)
+        finally:
+            self.node_manager.unregister(self)
+            self.set_connected(False)
+
+    def _dispatch(self, callback):
+        if self.loop is None:
+            return callback
+        loop = self.loop
+        return lambda *args: loop.call_soon_threadsafe(callback, *args)
 
     def _start_sensor_thread(self):
         self.connecting = True
         try:
             while self.running:
                 if self.node is None:
-                    self.node = Node()
-                    self.node.set_network_key(0x00, ANTPLUS_NETWORK_KEY)
-                    self.device = BikeSpeedCadence(self.node, self.device_id)
-                    self.device.on_found = self.on_found
-                    self.device.on_device_data = self.on_device_data
+                    self.node = create_node()
+                    self.device = create_device(self.node, self.device_type, self.device_id)
+                    self.device.on_found = self._dispatch(self.on_found)
+                    self.device.on_device_data = self._dispatch(self.instrument_handler(self.on_device_data))
+                    self.device.on_update = self.capture_page
                 self.node.start()
         finally:
-            print(f"ANT+ sensor {self.device_id}| closing ...")
+            LOG.info("ANT+ sensor %s| closing ...", self.device_id)
             if self.device is not None:
                 self.device.close_channel()
             if self.node is not None:
                 self.node.stop()
             self.connecting = False
-            self.connected = False
+            self.set_connected(False)
 
     def stop(self):
-        print(f"ANT+ sensor {self.device_id}| stopping")
+        LOG.info("ANT+ sensor %s| stopping", self.device_id)
         self.running = False
+        if self.node is not None and self.node_manager is None:
+            self.node.stop()
 
-    def on_found(self):
-        print(f"Device {self.device} found and receiving")
-        self.connected = True
-        self.connecting = False
+    async def write_fec_page(self, page):
+        # Sends an FE-C control page as acknowledged data; openant blocks until the trainer acknowledges it
+        if self.device_type != DEVICE_TYPE_FITNESS_EQUIPMENT:
+            raise ValueError(f"ANT+ sensor {self.device_id} is not fitness equipment")
+        if self.device is None:
+            raise ConnectionError(f"ANT+ sensor {self.device_id} is not connected")
+        await asyncio.get_running_loop().run_in_executor(None, self.device.send_acknowledged_data, list(page))
 
-    def on_device_data(self, page: int, page_name: str, data):
-        print(f"Data received: {data}")
-        if isinstance(data, BikeCadenceData):
-            cadence = data.cadence
-            if cadence:
-                self.last_cadence_value = cadence
-                print(f"cadence: {cadence} rpm")
-        elif isinstance(data, BikeSpeedData):
-            speed = data.calculate_speed(WHEEL_CIRCUMFERENCE_M_700CX25)
-            if speed:
-                self.last_speed_value = speed
-                print(f"speed: {speed:.2f} km/h")
-        elif isinstance(data, PowerData):
-            power = data.instantaneous_power
-            if power:
-                self.last_power_value = power
-                print(f"power: {power} W")
-        elif isinstance(data, HeartRateData):
-            hr = data.heart_rate
-            if hr:
-                self.last_hr_value = hr
-                print(f"HR: {hr} bpm")
-
-    # def store_csc_values(self, data: ):
-    #     print(f"CSC DATA: {data}")
-    #     cwr_data = data[1:5]
-    #     cwr_time_data = data[5:7]
-    #     ccr_data = data[7:9]
-    #     ccr_time_data = data[9:11]
-    #
-    #     new_cwr_reading = int.from_bytes(cwr_data, 'little')
-    #     new_cwr_time_reading = int.from_bytes(cwr_time_data, 'little')
-    #     self.last_total_distance_value = new_cwr_reading*2109/1000000
-    #     self.last_speed_value = (new_cwr_reading - self.last_cwr_reading)*2109/(new_cwr_time_reading - self.last_cwr_time_reading)*3.6
-    #     self.last_cwr_reading = new_cwr_reading
-    #     self.last_cwr_time_reading = new_cwr_time_reading
-    #     print(f"Dist: {self.last_total_distance_value}")
-    #     print(f"Speed: {self.last_speed_value}")
-    #
-    #     new_ccr_reading = int.from_bytes(ccr_data, 'little')
-    #     new_ccr_time_reading = int.from_bytes(ccr_time_data, 'little')
-    #     self.last_cadence_value = (new_ccr_reading - self.last_ccr_reading)/(new_ccr_time_reading - self.last_ccr_time_reading)*60000
-    #     self.last_ccr_reading = new_ccr_reading
-    #     self.last_ccr_time_reading = new_ccr_time_reading
-    #     print(f"Cadence: {self.last_cadence_value}")
+    def capture_page(self, data):
+        # raw data page as received, called on the node thread so the journal timestamp is the arrival time
+        if self.journal is not None:
+            self.journal.append(self.journal_sensor_id, JOURNAL_KIND_ANT_PAGE, data)
@@ -1,21 +1,108 @@
+import asyncio
+import time
+
+from DataPoints import (
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+from Instrumentation import METRICS
+from SensorDataBus import SensorDataBus
+
+LAST_VALUE_ATTRIBUTES = {
+    DATA_POINT_HEART_RATE: 'last_hr_value',
+    DATA_POINT_POWER: 'last_power_value',
+    DATA_POINT_CADENCE: 'last_cadence_value',
+    DATA_POINT_SPEED: 'last_speed_value',
+    DATA_POINT_DISTANCE: 'last_total_distance_value',
+}
+
+# every sensor profile used here notifies at least once a second, a longer gap means the sensor dropped out
+DROPOUT_GAP_S = 5.0
+
+
 class AbstractSensorProxy:
-    def __init__(self, connection_retries=3):
+    def __init__(self, connection_retries=3, data_bus: SensorDataBus = None, name=None):
         self.connection_retries = connection_retries
         self.running = False
+        self.connected = False
+        self.connected_event = None
+        self.loop = None
+        self.data_bus = data_bus if data_bus is not None else SensorDataBus()
 
         self.last_hr_value = 0
         self.last_power_value = 0
         self.last_speed_value = 0
         self.last_cadence_value = 0
         self.last_total_distance_value = 0
+        # speed and cadence sensors keep their revolution counters in a CSCEngine, see expire_rates()
+        self.csc_engine = None
+
+        # metrics are labelled with the sensor's name, e.g. "BLE C9:8B:..."
+        self.name = type(self).__name__ if name is None else name
+        self.notifications = METRICS.counter("sensor_notifications", self.name)
+        self.invalid_notifications = METRICS.counter("sensor_invalid_notifications", self.name)
+        self.dropouts = METRICS.counter("sensor_dropouts", self.name)
+        self.handler_time = METRICS.histogram("sensor_handler_seconds", self.name)
+        self.last_notification_time = None
+        # opt-in raw packet capture, see set_journal()
+        self.journal = None
+        self.journal_sensor_id = None
+
+    def publish(self, data_point, value):
+        setattr(self, LAST_VALUE_ATTRIBUTES[data_point], value)
+        self.data_bus.publish(data_point, value, self)
 
-        self.last_cwr_reading = 0
-        self.last_cwr_time_reading = 0
-        self.last_ccr_reading = 0
-        self.last_ccr_time_reading = 0
+    def expire_rates(self, now=None):
+        # Called periodically by the SensorRuntime: speed and cadence drop to zero once the sensor stops sending new
+        # revolutions, instead of freezing at the last rate
+        if self.csc_engine is None:
+            return
+        speed, cadence = self.csc_engine.speed, self.csc_engine.cadence
+        self.csc_engine.expire(now)
+        if self.csc_engine.speed != speed:
+            self.publish(DATA_POINT_SPEED, self.csc_engine.speed)
+        if self.csc_engine.cadence != cadence:
+            self.publish(DATA_POINT_CADENCE, self.csc_engine.cadence)
+
+    def set_journal(self, journal):
+        # Raw packets are appended to the CaptureJournal from now on
+        self.journal_sensor_id = journal.register_sensor(self.name)
+        self.journal = journal
+
+    def set_device_cache(self, device_cache):
+        # Sensors that can use a DeviceCache override this, see BLESensorProxy
+        pass
+
+    def instrument_handler(self, handler, journal_kind=None):
+        # Counts the notifications handled by `handler`, times parsing and publishing them and counts gaps longer than
+        # DROPOUT_GAP_S between them as dropouts. With a journal_kind the raw payload, the handler's last argument, is
+        # captured to the journal first.
+        def instrumented_handler(*args):
+            if journal_kind is not None and self.journal is not None:
+                self.journal.append(self.journal_sensor_id, journal_kind, args[-1])
+            t0 = time.perf_counter()
+            if self.last_notification_time is not None and t0 - self.last_notification_time > DROPOUT_GAP_S:
+                self.dropouts.add()
+            self.last_notification_time = t0
+            handler(*args)
+            self.handler_time.add(time.perf_counter() - t0)
+            self.notifications.add()
+        return instrumented_handler
+
+    def set_connected(self, connected):
+        self.connected = connected
+        if connected and self.connected_event is not None:
+            self.loop.call_soon_threadsafe(self.connected_event.set)
 
     def start(self):
         pass
 
+    async def run(self):
+        # Blocking proxies run their start() on an executor thread of the shared sensor loop
+        await asyncio.get_running_loop().run_in_executor(None, self.start)
+
     def stop(self):
         pass
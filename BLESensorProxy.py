@@ -1,86 +1,283 @@
 import asyncio
-from bleak import BleakClient, BleakError, BleakGATTCharacteristic
+import logging
+import random
+import time
 
 from AbstractSensorProxy import AbstractSensorProxy
+from CaptureJournal import (
+    JOURNAL_KIND_BLE_HEART_RATE,
+    JOURNAL_KIND_BLE_POWER,
+    JOURNAL_KIND_BLE_CSC,
+    JOURNAL_KIND_BLE_FEC,
+)
+from CSCEngine import CSCEngine, WHEEL_CIRCUMFERENCE_M_700CX25
+from FECPages import (
+    FEC_PAGE_TRAINER_DATA,
+    FEC_PAGE_COMMAND_STATUS,
+    FECTrainerSample,
+    FECCommandStatus,
+    encode_ant_message,
+    parse_ant_message,
+    parse_trainer_data_page,
+    parse_command_status_page,
+)
+from GattParsers import (
+    HeartRateSample,
+    CyclingPowerSample,
+    CSCSample,
+    parse_heart_rate,
+    parse_cycling_power,
+    parse_csc,
+)
+from DataPoints import (
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
 
 GATT_CHAR_UUID_HEART_RATE = 1
 GATT_CHAR_UUID_POWER = 2
 GATT_CHAR_UUID_CSC = 3
+# FE-C over BLE: pages from the trainer are notified on RX, pages to the trainer are written to TX
+GATT_CHAR_UUID_FEC_RX = 4
+GATT_CHAR_UUID_FEC_TX = 5
 
+# how notifications of each characteristic are stored in a capture journal
+JOURNAL_KINDS = {
+    GATT_CHAR_UUID_HEART_RATE: JOURNAL_KIND_BLE_HEART_RATE,
+    GATT_CHAR_UUID_POWER: JOURNAL_KIND_BLE_POWER,
+    GATT_CHAR_UUID_CSC: JOURNAL_KIND_BLE_CSC,
+    GATT_CHAR_UUID_FEC_RX: JOURNAL_KIND_BLE_FEC,
+}
 
-class BLESensorProxy(AbstractSensorProxy):
-    def __init__(self, sensor_address, gatt_char_uuids_map: dict, pair=False, connection_retries=3):
-        super().__init__(connection_retries)
+DEFAULT_CONNECT_TIMEOUT_S = 10
+RECONNECT_BACKOFF_INITIAL_S = 0.05
+RECONNECT_BACKOFF_MAX_S = 10
+RECONNECT_BACKOFF_JITTER = 0.25
+
+LOG = logging.getLogger(__name__)
+
+
+def get_reconnect_delay(n_failures):
+    delay = min(RECONNECT_BACKOFF_MAX_S, RECONNECT_BACKOFF_INITIAL_S * 2 ** n_failures)
+    return delay * (1 + random.uniform(-RECONNECT_BACKOFF_JITTER, RECONNECT_BACKOFF_JITTER))
+
+
+class BLENotificationHandlers:
+    # Parses BLE notifications and publishes their values, shared by BLESensorProxy and ReplaySensorProxy. Used with
+    # AbstractSensorProxy, whose subclasses call init_notification_state() from their __init__.
+    def init_notification_state(self, wheel_circumference_m=WHEEL_CIRCUMFERENCE_M_700CX25):
+        self.hr_sample = HeartRateSample()
+        self.power_sample = CyclingPowerSample()
+        self.csc_sample = CSCSample()
+        self.csc_engine = CSCEngine(wheel_circumference_m)
+        self.last_rr_intervals = ()
+        self.fec_trainer_sample = FECTrainerSample()
+        self.fec_command_status = FECCommandStatus()
+
+    # Notification handlers: sender is the notifying BleakGATTCharacteristic (None when replayed), data the raw value
+    def store_hr_value(self, sender, data: bytearray):
+        try:
+            parse_heart_rate(data, self.hr_sample)
+        except ValueError as e:
+            self.invalid_notifications.add()
+            LOG.warning("%s| invalid heart rate measurement: %s", self.name, e)
+            return
+        self.last_rr_intervals = self.hr_sample.rr_intervals
+        self.publish(DATA_POINT_HEART_RATE, self.hr_sample.heart_rate)
+        LOG.debug("HR: %s", self.last_hr_value)
+
+    def store_power_value(self, sender, data: bytearray):
+        try:
+            parse_cycling_power(data, self.power_sample)
+        except ValueError as e:
+            self.invalid_notifications.add()
+            LOG.warning("%s| invalid cycling power measurement: %s", self.name, e)
+            return
+        self.publish(DATA_POINT_POWER, self.power_sample.instantaneous_power)
+        LOG.debug("Power: %s", self.last_power_value)
+
+    def store_csc_values(self, sender, data: bytearray):
+        LOG.debug("CSC DATA: %s", bytes(data))
+        try:
+            csc = parse_csc(data, self.csc_sample)
+        except ValueError as e:
+            self.invalid_notifications.add()
+            LOG.warning("%s| invalid CSC measurement: %s", self.name, e)
+            return
+
+        now = time.monotonic()
+        if csc.cumulative_wheel_revs is not None:
+            self.csc_engine.update_wheel(csc.cumulative_wheel_revs, csc.last_wheel_event_time, now)
+            self.publish(DATA_POINT_DISTANCE, self.csc_engine.distance)
+            self.publish(DATA_POINT_SPEED, self.csc_engine.speed)
+            LOG.debug("Dist: %s, speed: %s", self.last_total_distance_value, self.last_speed_value)
+
+        if csc.cumulative_crank_revs is not None:
+            self.csc_engine.update_crank(csc.cumulative_crank_revs, csc.last_crank_event_time, now)
+            self.publish(DATA_POINT_CADENCE, self.csc_engine.cadence)
+            LOG.debug("Cadence: %s", self.last_cadence_value)
+
+    def store_fec_page(self, sender, data: bytearray):
+        try:
+            page = parse_ant_message(data)
+        except ValueError as e:
+            self.invalid_notifications.add()
+            LOG.warning("%s| invalid FE-C message: %s", self.name, e)
+            return
+        if page[0] == FEC_PAGE_TRAINER_DATA:
+            trainer_sample = parse_trainer_data_page(page, self.fec_trainer_sample)
+            if trainer_sample.instantaneous_power is not None:
+                self.publish(DATA_POINT_POWER, trainer_sample.instantaneous_power)
+            if trainer_sample.cadence is not None:
+                self.publish(DATA_POINT_CADENCE, trainer_sample.cadence)
+        elif page[0] == FEC_PAGE_COMMAND_STATUS:
+            parse_command_status_page(page, self.fec_command_status)
+
+
+class BLESensorProxy(BLENotificationHandlers, AbstractSensorProxy):
+    def __init__(self, sensor_address, gatt_char_uuids_map: dict, pair=False, connection_retries=3, data_bus=None,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT_S, wheel_circumference_m=WHEEL_CIRCUMFERENCE_M_700CX25):
+        super().__init__(connection_retries, data_bus, f"BLE {sensor_address}")
         self.sensor_address = sensor_address
         self.gatt_char_uuids_map = gatt_char_uuids_map
         self.pair = pair
+        self.connect_timeout = connect_timeout
+        self.service_uuids = None
+        self.wake_event = None
+
+        self.init_notification_state(wheel_circumference_m)
+        self.ble_client = None
+        # characteristic key -> what notifications and writes address it by: the uuid, or its handle once known
+        self.char_specifiers = dict(gatt_char_uuids_map)
+        # opt-in, see set_device_cache()
+        self.device_cache = None
+
+        self.reconnect_count = 0
+        self.data_gaps = []
+        self.disconnected_at = None
+
+    def get_notification_handlers(self):
+        return [
+            (GATT_CHAR_UUID_HEART_RATE, "heart rate", self.store_hr_value),
+            (GATT_CHAR_UUID_POWER, "power", self.store_power_value),
+            (GATT_CHAR_UUID_CSC, "speed & cadence", self.store_csc_values),
+            (GATT_CHAR_UUID_FEC_RX, "FE-C", self.store_fec_page),
+        ]
 
     async def start(self):
+        # Supervises the connection: reconnects after every disconnect with jittered exponential backoff and only
+        # gives up after connection_retries consecutive failed attempts.
         if self.running:
             pass
+        # bleak is imported once a BLE sensor starts, not when the module is loaded
+        from bleak import BleakError
         self.running = True
-        n_tries = 0
+        self.loop = asyncio.get_running_loop()
+        self.wake_event = asyncio.Event()
+        n_failures = 0
+        while self.running and n_failures <= self.connection_retries:
+            if n_failures > 0:
+                LOG.info("BLE sensor %s| retrying connection (%d)", self.sensor_address, n_failures)
+            try:
+                await self.connect_and_stream()
+                n_failures = 0
+            except (BleakError, asyncio.TimeoutError, OSError) as e:
+                n_failures += 1
+                LOG.warning("BLE sensor %s| connection error: %s", self.sensor_address, e)
+            self.set_connected(False)
+            if self.running:
+                await asyncio.sleep(get_reconnect_delay(n_failures))
+
+    def set_device_cache(self, device_cache):
+        # Characteristic handles are taken from and stored in the DeviceCache from now on
+        self.device_cache = device_cache
+
+    async def connect_and_stream(self):
+        from bleak import BleakClient
+        self.wake_event.clear()
+        handles = self.device_cache.get_handles(self.sensor_address) if self.device_cache is not None else {}
+        device = self.device_cache.get_ble_device(self.sensor_address) if self.device_cache is not None else \
+            self.sensor_address
+        # With handles from an earlier launch the GATT database cached by BlueZ or Windows is used as it is instead of
+        # discovering the services again
+        ble_client = BleakClient(device, disconnected_callback=self.on_disconnected, services=self.service_uuids,
+                                 timeout=self.connect_timeout, winrt={"use_cached_services": True} if handles else {})
+        await ble_client.connect(dangerous_use_bleak_cache=bool(handles))
         try:
-            while n_tries <= self.connection_retries and self.running:
-                if n_tries > 0:
-                    print(f"BLE sensor {self.sensor_address}| retrying connection ({n_tries})")
-                n_tries += 1
-                async with BleakClient(self.sensor_address) as ble_client:
-                    print(f"BLE sensor {self.sensor_address}| connected")
-                    if self.pair:
-                        paired = await ble_client.pair()
-                        print(f"BLE sensor {self.sensor_address}| paired = {paired}")
-                    if GATT_CHAR_UUID_HEART_RATE in self.gatt_char_uuids_map:
-                        print(f"BLE sensor {self.sensor_address}| reading heart rate data")
-                        await ble_client.start_notify(self.gatt_char_uuids_map[GATT_CHAR_UUID_HEART_RATE], self.store_hr_value)
-                    if GATT_CHAR_UUID_POWER in self.gatt_char_uuids_map:
-                        print(f"BLE sensor {self.sensor_address}| reading power data")
-                        await ble_client.start_notify(self.gatt_char_uuids_map[GATT_CHAR_UUID_POWER], self.store_power_value)
-                    if GATT_CHAR_UUID_CSC in self.gatt_char_uuids_map:
-                        print(f"BLE sensor {self.sensor_address}| reading speed & cadence data")
-                        await ble_client.start_notify(self.gatt_char_uuids_map[GATT_CHAR_UUID_CSC], self.store_csc_values)
-                    while self.running:
-                        await asyncio.sleep(0.5)
-        except BleakError as e:
-            print(f"BLE sensor {self.sensor_address}| connection error: {e}")
+            LOG.info("BLE sensor %s| connected%s", self.sensor_address, " (cached services)" if handles else "")
+            if self.pair:
+                paired = await ble_client.pair()
+                LOG.info("BLE sensor %s| paired = %s", self.sensor_address, paired)
+            self.char_specifiers = self.get_char_specifiers(ble_client, handles)
+            for char_key, name, handler in self.get_notification_handlers():
+                if char_key in self.gatt_char_uuids_map:
+                    LOG.info("BLE sensor %s| reading %s data", self.sensor_address, name)
+                    await ble_client.start_notify(self.char_specifiers[char_key],
+                                                  self.instrument_handler(handler, JOURNAL_KINDS[char_key]))
+            if self.service_uuids is None:
+                # Only discover the services we actually use on reconnects, a characteristic the device does not
+                # have is left out
+                characteristics = [ble_client.services.get_characteristic(uuid)
+                                   for uuid in self.gatt_char_uuids_map.values()]
+                self.service_uuids = list({characteristic.service_uuid for characteristic in characteristics
+                                           if characteristic is not None}) or None
+            if self.device_cache is not None:
+                self.device_cache.set_handles(self.sensor_address, {
+                    uuid: self.char_specifiers[char_key] for char_key, uuid in self.gatt_char_uuids_map.items()
+                    if isinstance(self.char_specifiers[char_key], int)})
+            if self.disconnected_at is not None:
+                self.reconnect_count += 1
+                self.data_gaps.append(time.monotonic() - self.disconnected_at)
+                LOG.info("BLE sensor %s| reconnected after %.2fs", self.sensor_address, self.data_gaps[-1])
+                self.disconnected_at = None
+            self.ble_client = ble_client
+            self.set_connected(True)
+            try:
+                await self.wake_event.wait()
+            finally:
+                self.ble_client = None
+        finally:
+            await ble_client.disconnect()
+
+    def get_char_specifiers(self, ble_client, handles):
+        # Characteristic key -> handle. A uuid is resolved once per connection, so a device that characteristic uuid
+        # appears in twice (e.g. in two services) always uses the same one; a cached handle that no longer belongs to
+        # the uuid, e.g. after a firmware update, is replaced.
+        char_specifiers = {}
+        for char_key, uuid in self.gatt_char_uuids_map.items():
+            characteristic = ble_client.services.get_characteristic(handles[uuid]) if uuid in handles else None
+            if characteristic is None or characteristic.uuid != uuid.lower():
+                characteristic = ble_client.services.get_characteristic(uuid)
+            if characteristic is None:
+                LOG.warning("BLE sensor %s| no characteristic %s", self.sensor_address, uuid)
+            char_specifiers[char_key] = characteristic.handle if characteristic is not None else uuid
+        return char_specifiers
+
+    def on_disconnected(self, ble_client):
+        LOG.warning("BLE sensor %s| disconnected", self.sensor_address)
+        self.disconnected_at = time.monotonic()
+        self.wake_event.set()
+
+    async def run(self):
+        await self.start()
 
     def stop(self):
-        print(f"BLE sensor {self.sensor_address}| stopping")
+        LOG.info("BLE sensor %s| stopping", self.sensor_address)
         self.running = False
+        if self.loop is not None and self.wake_event is not None:
+            self.loop.call_soon_threadsafe(self.wake_event.set)
 
-    def store_hr_value(self, sender: BleakGATTCharacteristic, data: bytearray):
-        relevant_data = data[:2]
-        relevant_data[0] = 0
-        self.last_hr_value = int.from_bytes(relevant_data, 'big')
-        print(f"HR: {self.last_hr_value}")
-
-    def store_power_value(self, sender: BleakGATTCharacteristic, data: bytearray):
-        relevant_data = data[2:4]
-        self.last_power_value = int.from_bytes(relevant_data, 'little')
-        print(f"Power: {self.last_power_value}")
-
-    def store_csc_values(self, sender: BleakGATTCharacteristic, data: bytearray):
-        print(f"CSC DATA: {data}")
-        cwr_data = data[1:5]
-        cwr_time_data = data[5:7]
-        ccr_data = data[7:9]
-        ccr_time_data = data[9:11]
-
-        new_cwr_reading = int.from_bytes(cwr_data, 'little')
-        new_cwr_time_reading = int.from_bytes(cwr_time_data, 'little')
-        self.last_total_distance_value = new_cwr_reading*2109/1000000
-        self.last_speed_value = (new_cwr_reading - self.last_cwr_reading)*2109/(new_cwr_time_reading - self.last_cwr_time_reading)*3.6
-        self.last_cwr_reading = new_cwr_reading
-        self.last_cwr_time_reading = new_cwr_time_reading
-        print(f"Dist: {self.last_total_distance_value}")
-        print(f"Speed: {self.last_speed_value}")
-
-        new_ccr_reading = int.from_bytes(ccr_data, 'little')
-        new_ccr_time_reading = int.from_bytes(ccr_time_data, 'little')
-        self.last_cadence_value = (new_ccr_reading - self.last_ccr_reading)/(new_ccr_time_reading - self.last_ccr_time_reading)*60000
-        self.last_ccr_reading = new_ccr_reading
-        self.last_ccr_time_reading = new_ccr_time_reading
-        print(f"Cadence: {self.last_cadence_value}")
+    async def write_fec_page(self, page):
+        # Sends an FE-C control page to the trainer, acknowledged like ANT+ acknowledged data
+        if GATT_CHAR_UUID_FEC_TX not in self.gatt_char_uuids_map:
+            raise ValueError(f"BLE sensor {self.sensor_address} has no FE-C characteristic")
+        if self.ble_client is None:
+            raise ConnectionError(f"BLE sensor {self.sensor_address} is not connected")
+        await self.ble_client.write_gatt_char(self.char_specifiers[GATT_CHAR_UUID_FEC_TX], encode_ant_message(page),
+                                              response=True)
 
 
 # async def testrun():
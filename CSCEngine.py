@@ -0,0 +1,140 @@
+import time
+from collections import deque
+
+WHEEL_CIRCUMFERENCE_M_700CX23 = 2.096
+WHEEL_CIRCUMFERENCE_M_700CX25 = 2.109
+WHEEL_CIRCUMFERENCE_M_700CX28 = 2.127
+
+DEFAULT_SMOOTHING_WINDOW = 4
+DEFAULT_ZERO_SPEED_TIMEOUT_S = 3.0
+# revolutions per second no wheel or crank reaches (about 300 km/h on a 2.1 m wheel, 2400 rpm); a faster event means
+# the counter was reset, e.g. by a sensor reboot
+DEFAULT_MAX_REVOLUTION_RATE = 40.0
+
+# (revolution counter bits, event time bits, event time ticks per second)
+BLE_CSC_WHEEL_FORMAT = (32, 16, 1024)
+BLE_CSC_CRANK_FORMAT = (16, 16, 1024)
+BLE_CP_WHEEL_FORMAT = (32, 16, 2048)
+BLE_CP_CRANK_FORMAT = (16, 16, 1024)
+ANT_WHEEL_FORMAT = (16, 16, 1024)
+ANT_CRANK_FORMAT = (16, 16, 1024)
+
+
+class RevolutionCounter:
+    # Turns one cumulative revolution counter and its last event time into a smoothed revolution rate. Both counters
+    # are unwrapped modulo their bit width; repeated events, events with no elapsed event time and gaps longer than
+    # the event time rollover period are not used for the rate. An event faster than max_rate (revolutions per
+    # second) is a reset counter: it becomes the new baseline and does not count towards total_revs.
+    __slots__ = ('revs_mask', 'time_mask', 'ticks_per_second', 'rollover_s', 'window', 'zero_timeout', 'max_rate',
+                 'last_revs', 'last_time', 'last_event_at', 'total_revs', 'events', 'window_revs', 'window_ticks',
+                 'rate')
+
+    def __init__(self, counter_format, window=DEFAULT_SMOOTHING_WINDOW, zero_timeout=DEFAULT_ZERO_SPEED_TIMEOUT_S,
+                 max_rate=DEFAULT_MAX_REVOLUTION_RATE):
+        revs_bits, time_bits, ticks_per_second = counter_format
+        self.revs_mask = (1 << revs_bits) - 1
+        self.time_mask = (1 << time_bits) - 1
+        self.ticks_per_second = ticks_per_second
+        self.rollover_s = (1 << time_bits) / ticks_per_second
+        self.window = window
+        self.zero_timeout = zero_timeout
+        self.max_rate = max_rate
+        self.total_revs = 0
+        self.reset()
+
+    def reset(self):
+        self.last_revs = None
+        self.last_time = None
+        self.last_event_at = None
+        self.events = deque()
+        self.window_revs = 0
+        self.window_ticks = 0
+        self.rate = 0.0
+
+    def clear_window(self):
+        self.events.clear()
+        self.window_revs = 0
+        self.window_ticks = 0
+        self.rate = 0.0
+
+    def set_baseline(self, revs, event_time, now):
+        self.clear_window()
+        self.last_revs = revs
+        self.last_time = event_time
+        self.last_event_at = now
+        return self.rate
+
+    def update(self, revs, event_time, now=None):
+        # Returns the smoothed rate in revolutions per second
+        if now is None:
+            now = time.monotonic()
+        if self.last_revs is None or now - self.last_event_at > self.rollover_s:
+            # first event, or the event time may have rolled over more than once since the last one
+            return self.set_baseline(revs, event_time, now)
+        delta_revs = (revs - self.last_revs) & self.revs_mask
+        delta_ticks = (event_time - self.last_time) & self.time_mask
+        if delta_ticks == 0:
+            # repeated event: no new revolution since the last notification
+            if now - self.last_event_at > self.zero_timeout:
+                self.clear_window()
+            return self.rate
+        if delta_revs * self.ticks_per_second > self.max_rate * delta_ticks:
+            # the counter was reset, the revolutions since the last event are unknown
+            return self.set_baseline(revs, event_time, now)
+        self.last_revs = revs
+        self.last_time = event_time
+        self.last_event_at = now
+        self.total_revs += delta_revs
+        self.events.append((delta_revs, delta_ticks))
+        self.window_revs += delta_revs
+        self.window_ticks += delta_ticks
+        if len(self.events) > self.window:
+            old_revs, old_ticks = self.events.popleft()
+            self.window_revs -= old_revs
+            self.window_ticks -= old_ticks
+        self.rate = self.window_revs * self.ticks_per_second / self.window_ticks
+        return self.rate
+
+    def expire(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        if self.last_event_at is not None and now - self.last_event_at > self.zero_timeout:
+            self.clear_window()
+        return self.rate
+
+
+class CSCEngine:
+    def __init__(self, wheel_circumference_m=WHEEL_CIRCUMFERENCE_M_700CX25, wheel_format=BLE_CSC_WHEEL_FORMAT,
+                 crank_format=BLE_CSC_CRANK_FORMAT, window=DEFAULT_SMOOTHING_WINDOW,
+                 zero_timeout=DEFAULT_ZERO_SPEED_TIMEOUT_S, max_rate=DEFAULT_MAX_REVOLUTION_RATE):
+        self.wheel_circumference_m = wheel_circumference_m
+        self.wheel = RevolutionCounter(wheel_format, window, zero_timeout, max_rate)
+        self.crank = RevolutionCounter(crank_format, window, zero_timeout, max_rate)
+
+    @property
+    def speed(self):
+        # km/h
+        return self.wheel.rate * self.wheel_circumference_m * 3.6
+
+    @property
+    def distance(self):
+        # km since the first wheel event
+        return self.wheel.total_revs * self.wheel_circumference_m / 1000
+
+    @property
+    def cadence(self):
+        # rpm
+        return self.crank.rate * 60
+
+    def update_wheel(self, revs, event_time, now=None):
+        self.wheel.update(revs, event_time, now)
+        return self.speed
+
+    def update_crank(self, revs, event_time, now=None):
+        self.crank.update(revs, event_time, now)
+        return self.cadence
+
+    def expire(self, now=None):
+        self.wheel.expire(now)
+        self.crank.expire(now)
+
@@ -0,0 +1,274 @@
+import argparse
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+
+JOURNAL_MAGIC = b"FTJRNL01"
+# magic, then time.time_ns() and time.monotonic_ns() taken together when the journal was opened, so entry timestamps
+# (monotonic ns) can be put on the wall clock
+JOURNAL_HEADER = struct.Struct('<8sqq')
+# codec, size of the decoded block, size of the block as stored
+BLOCK_HEADER = struct.Struct('<BII')
+# monotonic ns, sensor id, kind, payload size; followed by the payload
+ENTRY_HEADER = struct.Struct('<qHBH')
+
+JOURNAL_KIND_SENSOR = 0
+JOURNAL_KIND_BLE_HEART_RATE = 1
+JOURNAL_KIND_BLE_POWER = 2
+JOURNAL_KIND_BLE_CSC = 3
+JOURNAL_KIND_BLE_FEC = 4
+JOURNAL_KIND_ANT_PAGE = 5
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODEC_LZ4 = 3
+# compression names, as used in the "journal_compression" config key
+JOURNAL_CODECS = {
+    None: CODEC_NONE,
+    "zlib": CODEC_ZLIB,
+    "zstd": CODEC_ZSTD,
+    "lz4": CODEC_LZ4,
+}
+
+DEFAULT_BLOCK_SIZE = 1 << 18
+DEFAULT_FLUSH_INTERVAL_S = 2.0
+
+LOG = logging.getLogger(__name__)
+
+
+def get_compressor(codec):
+    # zstd and lz4 are optional dependencies, only imported when a journal uses them
+    if codec == CODEC_NONE:
+        return None
+    if codec == CODEC_ZLIB:
+        return lambda data: zlib.compress(data, 1)
+    if codec == CODEC_ZSTD:
+        import zstandard
+        return zstandard.ZstdCompressor(level=3).compress
+    if codec == CODEC_LZ4:
+        import lz4.frame
+        return lz4.frame.compress
+    raise ValueError(f"unknown journal codec {codec}")
+
+
+def get_decompressor(codec):
+    if codec == CODEC_NONE:
+        return None
+    if codec == CODEC_ZLIB:
+        return zlib.decompress
+    if codec == CODEC_ZSTD:
+        import zstandard
+        return zstandard.ZstdDecompressor().decompress
+    if codec == CODEC_LZ4:
+        import lz4.frame
+        return lz4.frame.decompress
+    raise ValueError(f"unknown journal codec {codec}")
+
+
+class CaptureJournal:
+    # Append-only journal of raw sensor packets: every BLE notification and ANT+ data page as it arrived, so computed
+    # values can be checked and reprocessed later. Callbacks pack their entry into a preallocated block buffer under
+    # a short lock; full blocks, and partial ones every flush_interval seconds, are swapped for a free buffer and
+    # compressed and written by a background thread. A crash loses at most the blocks not written yet.
+    def __init__(self, file_name, compression=None, block_size=DEFAULT_BLOCK_SIZE,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL_S):
+        if compression not in JOURNAL_CODECS:
+            raise ValueError(f"unknown journal compression {compression}, expected one of "
+                             f"{', '.join(str(name) for name in JOURNAL_CODECS)}")
+        self.file_name = file_name
+        self.codec = JOURNAL_CODECS[compression]
+        self.compress = get_compressor(self.codec)
+        self.block_size = block_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.buffer = bytearray(block_size)
+        self.length = 0
+        self.free_buffers = queue.SimpleQueue()
+        self.free_buffers.put(bytearray(block_size))
+        self.blocks = queue.SimpleQueue()
+        self.sensor_ids = {}
+
+        self.entries = 0
+        self.allocated_buffers = 2
+        self.written_bytes = 0
+        self.raw_bytes = 0
+
+        self.output = open(file_name, "wb")
+        self.output.write(JOURNAL_HEADER.pack(JOURNAL_MAGIC, time.time_ns(), time.monotonic_ns()))
+        self.thread = threading.Thread(target=self.run, name="CaptureJournal", daemon=True)
+        self.thread.start()
+
+    def register_sensor(self, name):
+        # Returns the id entries of this sensor are appended with, the name is stored in the journal
+        with self.lock:
+            sensor_id = self.sensor_ids.get(name)
+            new_sensor = sensor_id is None
+            if new_sensor:
+                sensor_id = len(self.sensor_ids)
+                self.sensor_ids[name] = sensor_id
+        if new_sensor:
+            self.append(sensor_id, JOURNAL_KIND_SENSOR, name.encode())
+        return sensor_id
+
+    def append(self, sensor_id, kind, data):
+        timestamp = time.monotonic_ns()
+        size = len(data)
+        with self.lock:
+            if self.length + ENTRY_HEADER.size + size > len(self.buffer):
+                self.swap_buffer(ENTRY_HEADER.size + size)
+            start = self.length + ENTRY_HEADER.size
+            ENTRY_HEADER.pack_into(self.buffer, self.length, timestamp, sensor_id, kind, size)
+            self.buffer[start:start + size] = data
+            self.length = start + size
+            self.entries += 1
+
+    def swap_buffer(self, min_size=0):
+        # With the lock held: queues the filled part of the current buffer for writing and continues in a free one
+        if self.length:
+            self.blocks.put((self.buffer, self.length))
+        elif len(self.buffer) >= min_size:
+            return
+        try:
+            buffer = self.free_buffers.get_nowait()
+        except queue.Empty:
+            # the writer is behind, grow the pool rather than block the callback
+            buffer = bytearray(self.block_size)
+            self.allocated_buffers += 1
+        if len(buffer) < min_size:
+            buffer = bytearray(min_size)
+        self.buffer = buffer
+        self.length = 0
+
+    def run(self):
+        while True:
+            try:
+                block = self.blocks.get(timeout=self.flush_interval)
+            except queue.Empty:
+                with self.lock:
+                    self.swap_buffer()
+                continue
+            if block is None:
+                break
+            buffer, length = block
+            try:
+                self.write_block(buffer, length)
+            except OSError as e:
+                LOG.error("Capture journal %s| writing failed: %s", self.file_name, e)
+            self.free_buffers.put(buffer)
+
+    def write_block(self, buffer, length):
+        with memoryview(buffer)[:length] as view:
+            data = view if self.compress is None else self.compress(view)
+            stored_size = len(data)
+            self.output.write(BLOCK_HEADER.pack(self.codec, length, stored_size))
+            self.output.write(data)
+        self.output.flush()
+        self.raw_bytes += length
+        self.written_bytes += BLOCK_HEADER.size + stored_size
+
+    def close(self):
+        if self.output is None:
+            return
+        with self.lock:
+            self.swap_buffer()
+        self.blocks.put(None)
+        self.thread.join()
+        self.output.close()
+        self.output = None
+
+    def get_stats(self):
+        return {
+            "entries": self.entries,
+            "raw_bytes": self.raw_bytes,
+            "written_bytes": self.written_bytes,
+            "buffers": self.allocated_buffers,
+        }
+
+
+def read_journal(file_name):
+    # Bulk-decodes a journal into ({sensor id: name}, [(monotonic ns, sensor id, kind, payload), ...], header times).
+    # A block cut short by a crash ends the journal.
+    with open(file_name, "rb") as journal_file:
+        data = journal_file.read()
+    if len(data) < JOURNAL_HEADER.size:
+        raise ValueError(f"{file_name} is not a capture journal")
+    magic, wall_ns, monotonic_ns = JOURNAL_HEADER.unpack_from(data)
+    if magic != JOURNAL_MAGIC:
+        raise ValueError(f"{file_name} is not a capture journal")
+    sensors = {}
+    entries = []
+    decompressors = {}
+    unpack_entry = ENTRY_HEADER.unpack_from
+    entry_header_size = ENTRY_HEADER.size
+    offset = JOURNAL_HEADER.size
+    while offset + BLOCK_HEADER.size <= len(data):
+        codec, raw_size, stored_size = BLOCK_HEADER.unpack_from(data, offset)
+        offset += BLOCK_HEADER.size
+        if offset + stored_size > len(data):
+            break
+        if codec not in decompressors:
+            decompressors[codec] = get_decompressor(codec)
+        block = data[offset:offset + stored_size]
+        offset += stored_size
+        if decompressors[codec] is not None:
+            block = decompressors[codec](block)
+        position = 0
+        while position < raw_size:
+            timestamp, sensor_id, kind, size = unpack_entry(block, position)
+            position += entry_header_size
+            payload = block[position:position + size]
+            position += size
+            if kind == JOURNAL_KIND_SENSOR:
+                sensors[sensor_id] = payload.decode()
+            else:
+                entries.append((timestamp, sensor_id, kind, payload))
+    return sensors, entries, (wall_ns, monotonic_ns)
+
+
+def get_replay_events(entries, sensor_id):
+    # The entries of one sensor as ReplaySensorProxy events, timed from the sensor's first entry
+    from ReplaySensorProxy import REPLAY_BLE_HEART_RATE, REPLAY_BLE_POWER, REPLAY_BLE_CSC, REPLAY_ANT_PAGE
+    replay_kinds = {
+        JOURNAL_KIND_BLE_HEART_RATE: REPLAY_BLE_HEART_RATE,
+        JOURNAL_KIND_BLE_POWER: REPLAY_BLE_POWER,
+        JOURNAL_KIND_BLE_CSC: REPLAY_BLE_CSC,
+        JOURNAL_KIND_ANT_PAGE: REPLAY_ANT_PAGE,
+    }
+    events = []
+    first_timestamp = None
+    for timestamp, entry_sensor_id, kind, payload in entries:
+        if entry_sensor_id != sensor_id or kind not in replay_kinds:
+            continue
+        if first_timestamp is None:
+            first_timestamp = timestamp
+        events.append(((timestamp - first_timestamp) / 1e9, replay_kinds[kind], payload))
+    return events
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize a capture journal or export it as replay files")
+    parser.add_argument("journal", help="capture journal file")
+    parser.add_argument("--replay-dir", help="write one <sensor>.replay file per sensor to this directory")
+    args = parser.parse_args()
+    t0 = time.perf_counter()
+    sensors, entries, _ = read_journal(args.journal)
+    decode_time = time.perf_counter() - t0
+    print(f"{len(entries)} entries of {len(sensors)} sensors decoded in {decode_time * 1000:.1f}ms")
+    for sensor_id, name in sorted(sensors.items()):
+        timestamps = [entry[0] for entry in entries if entry[1] == sensor_id]
+        duration = (timestamps[-1] - timestamps[0]) / 1e9 if timestamps else 0
+        print(f"  {name}: {len(timestamps)} entries over {duration:.1f}s")
+        if args.replay_dir:
+            from ReplaySensorProxy import save_replay
+            os.makedirs(args.replay_dir, exist_ok=True)
+            save_replay(os.path.join(args.replay_dir, f"{name.replace(':', '').replace(' ', '_')}.replay"),
+                        get_replay_events(entries, sensor_id))
+
+
+if __name__ == '__main__':
+    main()
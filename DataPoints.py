@@ -0,0 +1,8 @@
+# Ids of the recorded channels, shared by the sensor proxies, the data bus, the FIT writer and the telemetry frames.
+# They live apart from FitWriter so that using them does not load fit_tool.
+DATA_POINT_TIME = 1
+DATA_POINT_HEART_RATE = 2
+DATA_POINT_POWER = 3
+DATA_POINT_CADENCE = 4
+DATA_POINT_SPEED = 5
+DATA_POINT_DISTANCE = 6
@@ -0,0 +1,307 @@
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os
+import threading
+import time
+
+import Instrumentation
+import SensorConfig
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_DEVICE_CACHE_NAME = "devices.json"
+DEVICE_CACHE_VERSION = 1
+# devices not seen or connected to for this long are dropped from the cache
+DEFAULT_DEVICE_TTL_S = 30 * 24 * 3600
+DEFAULT_SCAN_TIMEOUT_S = 5.0
+
+# what a device can be used as, named like the sensor config's ANT+ device types
+CAPABILITY_HEART_RATE = "heart_rate"
+CAPABILITY_POWER = "power"
+CAPABILITY_CSC = "csc"
+CAPABILITY_FITNESS_EQUIPMENT = "fitness_equipment"
+
+# advertised BLE service -> capability
+BLE_SERVICE_CAPABILITIES = {
+    "0000180d-0000-1000-8000-00805f9b34fb": CAPABILITY_HEART_RATE,
+    "00001818-0000-1000-8000-00805f9b34fb": CAPABILITY_POWER,
+    "00001816-0000-1000-8000-00805f9b34fb": CAPABILITY_CSC,
+    "6e40fec1-b5a3-f393-e0a9-e50e24dcca9e": CAPABILITY_FITNESS_EQUIPMENT,
+}
+# capability -> the "characteristics" of a BLE sensor config using it, see SensorConfig.create_ble_sensor()
+BLE_CAPABILITY_CHARACTERISTICS = {
+    CAPABILITY_HEART_RATE: {"heart_rate": "00002a37-0000-1000-8000-00805f9b34fb"},
+    CAPABILITY_POWER: {"power": "00002a63-0000-1000-8000-00805f9b34fb"},
+    CAPABILITY_CSC: {"csc": "00002a5b-0000-1000-8000-00805f9b34fb"},
+    CAPABILITY_FITNESS_EQUIPMENT: {"fec_rx": "6e40fec2-b5a3-f393-e0a9-e50e24dcca9e",
+                                   "fec_tx": "6e40fec3-b5a3-f393-e0a9-e50e24dcca9e"},
+}
+# ANT+ device type number -> capability; cadence-only (122) and speed-only (123) sensors are not supported
+ANT_DEVICE_TYPE_CAPABILITIES = {
+    120: CAPABILITY_HEART_RATE,
+    11: CAPABILITY_POWER,
+    121: CAPABILITY_CSC,
+    17: CAPABILITY_FITNESS_EQUIPMENT,
+}
+
+
+class DeviceCache:
+    # The BLE and ANT+ devices found by discovery or connected to, kept in a JSON file across launches: per device its
+    # capabilities, name, signal strength and when it was last seen, and for BLE devices the handles of the
+    # characteristics a BLESensorProxy subscribed to. With a device in the cache a sensor config can leave out its
+    # address or device id, and a BLE sensor with known handles connects on the GATT services cached by the OS instead
+    # of discovering them again. Devices not seen for `ttl` seconds are evicted.
+    def __init__(self, file_name=DEFAULT_DEVICE_CACHE_NAME, ttl=DEFAULT_DEVICE_TTL_S):
+        self.file_name = file_name
+        self.ttl = ttl
+        # "ble:<address>" / "ant:<device type>:<device id>" -> entry
+        self.devices = {}
+        # BLEDevice per address from scans of this process, lets bleak connect without scanning for the address again
+        self.ble_devices = {}
+        # updated from the scanner callbacks, the ANT+ search thread and the sensor loop
+        self.lock = threading.Lock()
+        self.dirty = False
+        if os.path.exists(file_name):
+            try:
+                with open(file_name) as cache_file:
+                    data = json.load(cache_file)
+            except (OSError, ValueError) as e:
+                LOG.warning("Device cache| ignoring unreadable %s: %s", file_name, e)
+                data = {}
+            if data.get("version") == DEVICE_CACHE_VERSION:
+                self.devices = data.get("devices", {})
+        self.evict()
+
+    def evict(self, now=None):
+        oldest = (time.time() if now is None else now) - self.ttl
+        with self.lock:
+            expired = [key for key, entry in self.devices.items() if entry["last_seen"] < oldest]
+            for key in expired:
+                del self.devices[key]
+            if expired:
+                self.dirty = True
+        if expired:
+            LOG.info("Device cache| evicted %d devices not seen for %ds", len(expired), self.ttl)
+        return len(expired)
+
+    def add(self, transport, device_id, capabilities, name=None, rssi=None, device_type=None):
+        # A device seen by a scan, merged with what is known about it
+        if transport == SensorConfig.SENSOR_TYPE_BLE:
+            device_id = device_id.upper()
+        key = get_device_key(transport, device_id, device_type)
+        with self.lock:
+            entry = self.devices.setdefault(key, {"transport": transport, "id": device_id, "capabilities": [],
+                                                  "handles": {}})
+            entry["capabilities"] = sorted(set(entry["capabilities"]) | set(capabilities))
+            if device_type is not None:
+                entry["device_type"] = device_type
+            if name:
+                entry["name"] = name
+            if rssi is not None:
+                entry["rssi"] = rssi
+            entry["last_seen"] = time.time()
+            self.dirty = True
+        return entry
+
+    def get(self, transport, device_id, device_type=None):
+        return self.devices.get(get_device_key(transport, device_id, device_type))
+
+    def find(self, transport, capability):
+        # The devices with a capability, the ones connected to most recently first, then by signal strength
+        with self.lock:
+            entries = [entry for entry in self.devices.values()
+                       if entry["transport"] == transport and capability in entry["capabilities"]]
+        return sorted(entries, key=lambda entry: (entry.get("last_connected", 0), entry.get("rssi", -1000)),
+                      reverse=True)
+
+    def get_handles(self, address):
+        # characteristic uuid -> handle of a BLE device, empty before the first connection
+        entry = self.get(SensorConfig.SENSOR_TYPE_BLE, address)
+        return dict(entry["handles"]) if entry is not None else {}
+
+    def set_handles(self, address, handles):
+        # Called by BLESensorProxy after every connection; written to disk at once when the handles changed, as the
+        # next launch depends on them
+        key = get_device_key(SensorConfig.SENSOR_TYPE_BLE, address)
+        with self.lock:
+            entry = self.devices.setdefault(key, {"transport": SensorConfig.SENSOR_TYPE_BLE, "id": address.upper(),
+                                                  "capabilities": [], "handles": {}})
+            changed = entry["handles"] != handles
+            entry["handles"] = dict(handles)
+            entry["last_seen"] = entry["last_connected"] = time.time()
+            self.dirty = True
+        if changed:
+            self.save()
+
+    def get_ble_device(self, address):
+        # what BleakClient should be given: the scanned BLEDevice when there is one, the address otherwise
+        return self.ble_devices.get(address.upper(), address)
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps({"version": DEVICE_CACHE_VERSION, "devices": self.devices}, indent=1)
+            self.dirty = False
+        # written to a temporary file first, so a crash never leaves a truncated cache behind
+        os.makedirs(os.path.dirname(self.file_name) or ".", exist_ok=True)
+        tmp_file_name = f"{self.file_name}.tmp"
+        with open(tmp_file_name, "w") as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_file_name, self.file_name)
+
+
+def get_device_key(transport, device_id, device_type=None):
+    # an ANT+ device number is only unique per device type, a trainer often uses the same one for FE-C, power and CSC
+    if transport == SensorConfig.SENSOR_TYPE_ANT:
+        return f"{transport}:{device_type}:{device_id}"
+    return f"{transport}:{str(device_id).upper()}"
+
+
+async def discover_ble(cache: DeviceCache, timeout=DEFAULT_SCAN_TIMEOUT_S):
+    # Scans for devices advertising one of BLE_SERVICE_CAPABILITIES; returns the number of devices found
+    from bleak import BleakScanner
+    found = set()
+
+    def on_detected(device, advertisement_data):
+        capabilities = {BLE_SERVICE_CAPABILITIES[uuid] for uuid in advertisement_data.service_uuids
+                        if uuid in BLE_SERVICE_CAPABILITIES}
+        if capabilities:
+            cache.ble_devices[device.address.upper()] = device
+            cache.add(SensorConfig.SENSOR_TYPE_BLE, device.address, capabilities,
+                      name=advertisement_data.local_name or device.name, rssi=advertisement_data.rssi)
+            found.add(device.address)
+
+    async with BleakScanner(on_detected, service_uuids=list(BLE_SERVICE_CAPABILITIES)):
+        await asyncio.sleep(timeout)
+    LOG.info("Discovery| %d BLE devices found", len(found))
+    return len(found)
+
+
+def discover_ant(cache: DeviceCache, timeout=DEFAULT_SCAN_TIMEOUT_S):
+    # Runs an ANT+ wildcard search for `timeout` seconds on a node of its own, so it has to happen before the sensors'
+    # ANTNodeManager opens the USB stick; returns the number of devices found
+    from openant.devices.scanner import Scanner
+    import ANTSensorProxy
+    node = ANTSensorProxy.create_node()
+    scanner = Scanner(node, device_id=0, device_type=0)
+    found = set()
+
+    def on_found(device):
+        device_id, device_type, _ = device
+        capability = ANT_DEVICE_TYPE_CAPABILITIES.get(device_type)
+        if capability is not None:
+            cache.add(SensorConfig.SENSOR_TYPE_ANT, device_id, [capability], device_type=capability)
+            found.add(device)
+
+    def stop():
+        scanner.close_channel()
+        node.stop()
+
+    scanner.on_found = on_found
+    timer = threading.Timer(timeout, stop)
+    timer.start()
+    try:
+        node.start()
+    finally:
+        timer.cancel()
+    LOG.info("Discovery| %d ANT+ devices found", len(found))
+    return len(found)
+
+
+async def discover_devices(cache: DeviceCache, timeout=DEFAULT_SCAN_TIMEOUT_S, ble=True, ant=True):
+    # The BLE scan on the loop and the ANT+ search on a thread run at the same time, so discovery takes `timeout`
+    # seconds however many devices are around. A transport without an adapter or stick is skipped.
+    loop = asyncio.get_running_loop()
+    searches = {}
+    if ble:
+        searches["BLE"] = discover_ble(cache, timeout)
+    if ant:
+        searches["ANT+"] = loop.run_in_executor(None, discover_ant, cache, timeout)
+    results = await asyncio.gather(*searches.values(), return_exceptions=True)
+    for transport, result in zip(searches, results):
+        if isinstance(result, Exception):
+            LOG.warning("Discovery| %s search failed: %s", transport, result)
+    cache.save()
+
+
+def resolve_sensor_config(config, cache: DeviceCache, timeout=DEFAULT_SCAN_TIMEOUT_S):
+    # A copy of the config where every BLE sensor without "address" got the best cached device with its "capability",
+    # and every ANT+ sensor without "device_id" the best cached device of its device_type; no two sensors get the same
+    # device. Only when the cache cannot fill in all of them, devices are discovered (on the transports missing one),
+    # so later launches start without scanning. Raises ValueError when a sensor still has no device.
+    config = copy.deepcopy(config)
+    unresolved = assign_devices(config, cache)
+    if unresolved:
+        transports = {SensorConfig.get_missing_transport(sensor_config) for sensor_config in unresolved}
+        LOG.info("Discovery| no cached device for %s, scanning", ", ".join(sensor_config["name"]
+                                                                         for sensor_config in unresolved))
+        asyncio.run(discover_devices(cache, timeout, ble=SensorConfig.SENSOR_TYPE_BLE in transports,
+                                     ant=SensorConfig.SENSOR_TYPE_ANT in transports))
+        unresolved = assign_devices(config, cache)
+    if unresolved:
+        raise ValueError(f"no device found for sensor {unresolved[0]['name']}")
+    for sensor_config in config["sensors"]:
+        if sensor_config["type"] == SensorConfig.SENSOR_TYPE_BLE and "characteristics" not in sensor_config:
+            sensor_config["characteristics"] = dict(BLE_CAPABILITY_CHARACTERISTICS[sensor_config["capability"]])
+    return config
+
+
+def assign_devices(config, cache: DeviceCache):
+    # Fills in the devices the cache has, returns the sensor configs still without one
+    taken = {get_device_key(SensorConfig.SENSOR_TYPE_BLE, sensor_config["address"])
+             for sensor_config in config["sensors"] if "address" in sensor_config}
+    taken |= {get_device_key(SensorConfig.SENSOR_TYPE_ANT, sensor_config["device_id"], sensor_config["device_type"])
+              for sensor_config in config["sensors"] if "device_id" in sensor_config}
+    unresolved = []
+    for sensor_config in config["sensors"]:
+        transport = SensorConfig.get_missing_transport(sensor_config)
+        if transport is None:
+            continue
+        capability = sensor_config["capability"] if transport == SensorConfig.SENSOR_TYPE_BLE else \
+            sensor_config["device_type"]
+        for entry in cache.find(transport, capability):
+            key = get_device_key(transport, entry["id"], entry.get("device_type"))
+            if key not in taken:
+                taken.add(key)
+                sensor_config["address" if transport == SensorConfig.SENSOR_TYPE_BLE else "device_id"] = entry["id"]
+                LOG.info("Discovery| %s uses %s %s", sensor_config["name"], entry.get("name", ""), entry["id"])
+                break
+        else:
+            unresolved.append(sensor_config)
+    return unresolved
+
+
+def setup_device_cache(config):
+    # (DeviceCache, config with all devices filled in) for Recorder and SessionManager
+    cache = DeviceCache(config.get("device_cache", DEFAULT_DEVICE_CACHE_NAME),
+                        config.get("device_cache_ttl", DEFAULT_DEVICE_TTL_S))
+    return cache, resolve_sensor_config(config, cache, config.get("scan_timeout", DEFAULT_SCAN_TIMEOUT_S))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Find BLE and ANT+ sensors and trainers and cache them for recording")
+    parser.add_argument("--cache", default=DEFAULT_DEVICE_CACHE_NAME, help="device cache file")
+    parser.add_argument("--timeout", type=float, default=DEFAULT_SCAN_TIMEOUT_S, help="scan time in seconds")
+    parser.add_argument("--no-ble", action="store_true", help="do not scan for BLE devices")
+    parser.add_argument("--no-ant", action="store_true", help="do not search for ANT+ devices")
+    args = parser.parse_args()
+    log_listener = Instrumentation.setup_logging()
+    try:
+        cache = DeviceCache(args.cache)
+        asyncio.run(discover_devices(cache, args.timeout, ble=not args.no_ble, ant=not args.no_ant))
+    finally:
+        log_listener.stop()
+    entries = sorted(cache.devices.values(), key=lambda entry: (entry["transport"], -entry.get("rssi", -1000)))
+    print(f"{'transport':9} {'device':18} {'name':24} {'rssi':>5} {'handles':>7}  capabilities")
+    for entry in entries:
+        rssi = entry.get("rssi")
+        print(f"{entry['transport']:9} {str(entry['id']):18} {entry.get('name', '')[:24]:24} "
+              f"{'' if rssi is None else rssi:>5} {len(entry['handles']):>7}  {', '.join(entry['capabilities'])}")
+
+
+if __name__ == '__main__':
+    main()
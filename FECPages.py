@@ -0,0 +1,140 @@
+import struct
+
+# ANT message framing, as used by FE-C over BLE (doc/How-to FE-C over BLE v1_0_0.pdf)
+ANT_SYNC = 0xA4
+ANT_MESSAGE_BROADCAST_DATA = 0x4E
+ANT_MESSAGE_ACKNOWLEDGED_DATA = 0x4F
+# the trainer sends on channel 5 and ignores the channel of messages written to it
+FEC_BLE_CHANNEL = 5
+FEC_PAGE_SIZE = 8
+
+# FE-C data pages
+FEC_PAGE_GENERAL_FE = 0x10
+FEC_PAGE_TRAINER_DATA = 0x19
+FEC_PAGE_BASIC_RESISTANCE = 0x30
+FEC_PAGE_TARGET_POWER = 0x31
+FEC_PAGE_WIND_RESISTANCE = 0x32
+FEC_PAGE_TRACK_RESISTANCE = 0x33
+FEC_PAGE_USER_CONFIGURATION = 0x37
+FEC_PAGE_COMMAND_STATUS = 0x47
+
+# pages that set the trainer's resistance mode, the trainer is only ever in one of them
+FEC_CONTROL_PAGES = frozenset((FEC_PAGE_BASIC_RESISTANCE, FEC_PAGE_TARGET_POWER, FEC_PAGE_WIND_RESISTANCE,
+                               FEC_PAGE_TRACK_RESISTANCE))
+
+FEC_MAX_TARGET_POWER_W = 4000
+FEC_MIN_GRADE = -200.0
+FEC_MAX_GRADE = 200.0
+FEC_DEFAULT_ROLLING_RESISTANCE = 0.004
+
+# Command Status (page 71) status byte
+FEC_COMMAND_PASS = 0
+FEC_COMMAND_FAIL = 1
+FEC_COMMAND_NOT_SUPPORTED = 2
+FEC_COMMAND_REJECTED = 3
+FEC_COMMAND_PENDING = 4
+FEC_COMMAND_UNINITIALIZED = 255
+
+
+class FECTrainerSample:
+    __slots__ = ('cadence', 'instantaneous_power', 'accumulated_power', 'event_count')
+
+    def __init__(self):
+        self.cadence = None
+        self.instantaneous_power = None
+        self.accumulated_power = None
+        self.event_count = None
+
+
+class FECCommandStatus:
+    __slots__ = ('last_command', 'sequence', 'status')
+
+    def __init__(self):
+        self.last_command = None
+        self.sequence = None
+        self.status = FEC_COMMAND_UNINITIALIZED
+
+
+def encode_basic_resistance_page(resistance):
+    # resistance in % of the trainer's maximum, 0.5% steps
+    if not 0 <= resistance <= 100:
+        raise ValueError(f"resistance must be between 0 and 100%, got {resistance}")
+    return bytes((FEC_PAGE_BASIC_RESISTANCE, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, round(resistance * 2)))
+
+
+def encode_target_power_page(power):
+    # ERG mode target in W, 0.25 W steps
+    if not 0 <= power <= FEC_MAX_TARGET_POWER_W:
+        raise ValueError(f"target power must be between 0 and {FEC_MAX_TARGET_POWER_W} W, got {power}")
+    return struct.pack('<B5BH', FEC_PAGE_TARGET_POWER, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, round(power * 4))
+
+
+def encode_track_resistance_page(grade, rolling_resistance=None):
+    # Simulation mode: grade in % (0.01% steps, offset by -200%), coefficient of rolling resistance in 5e-5 steps,
+    # None leaves it to the trainer's default of FEC_DEFAULT_ROLLING_RESISTANCE
+    grade = min(FEC_MAX_GRADE, max(FEC_MIN_GRADE, grade))
+    crr = 0xFF if rolling_resistance is None else min(0xFE, round(rolling_resistance / 5e-5))
+    return struct.pack('<B4BHB', FEC_PAGE_TRACK_RESISTANCE, 0xFF, 0xFF, 0xFF, 0xFF,
+                       round((grade - FEC_MIN_GRADE) * 100), crr)
+
+
+def encode_user_configuration_page(user_weight_kg, bike_weight_kg, wheel_diameter_m):
+    # Lets the trainer turn grades into the resistance this rider and bike would feel
+    bike_weight = min(0xFFF, round(bike_weight_kg / 0.05))
+    wheel_diameter_mm = round(wheel_diameter_m * 1000)
+    wheel_diameter, wheel_diameter_offset = divmod(wheel_diameter_mm, 10)
+    return struct.pack('<BHBBBBB', FEC_PAGE_USER_CONFIGURATION, round(user_weight_kg * 100), 0xFF,
+                       wheel_diameter_offset | (bike_weight & 0x0F) << 4, bike_weight >> 4, min(0xFF, wheel_diameter),
+                       0x00)
+
+
+def encode_ant_message(page, message_id=ANT_MESSAGE_ACKNOWLEDGED_DATA, channel=FEC_BLE_CHANNEL):
+    # Wraps a data page in a complete ANT message: sync, length, message id, channel, page and XOR checksum
+    if len(page) != FEC_PAGE_SIZE:
+        raise ValueError(f"FE-C pages are {FEC_PAGE_SIZE} bytes, got {len(page)}")
+    message = bytearray((ANT_SYNC, FEC_PAGE_SIZE + 1, message_id, channel))
+    message += page
+    checksum = 0
+    for byte in message:
+        checksum ^= byte
+    message.append(checksum)
+    return bytes(message)
+
+
+def parse_ant_message(data):
+    # Returns the data page of a broadcast or acknowledged ANT message
+    if len(data) < 4 or data[0] != ANT_SYNC:
+        raise ValueError("missing ANT sync byte")
+    length = data[1]
+    if len(data) != length + 4:
+        raise ValueError(f"ANT message length {length} does not match {len(data)} bytes")
+    checksum = 0
+    for byte in data:
+        checksum ^= byte
+    if checksum:
+        raise ValueError("ANT message checksum mismatch")
+    if data[2] not in (ANT_MESSAGE_BROADCAST_DATA, ANT_MESSAGE_ACKNOWLEDGED_DATA) or length != FEC_PAGE_SIZE + 1:
+        raise ValueError(f"not an ANT data message: {bytes(data).hex()}")
+    return bytes(data[4:4 + FEC_PAGE_SIZE])
+
+
+def parse_trainer_data_page(page, sample: FECTrainerSample = None):
+    # Specific Trainer/Stationary Bike Data (page 25)
+    if sample is None:
+        sample = FECTrainerSample()
+    sample.event_count = page[1]
+    sample.cadence = None if page[2] == 0xFF else page[2]
+    sample.accumulated_power = page[3] | page[4] << 8
+    power = page[5] | (page[6] & 0x0F) << 8
+    sample.instantaneous_power = None if power == 0xFFF else power
+    return sample
+
+
+def parse_command_status_page(page, status: FECCommandStatus = None):
+    # Command Status (page 71), the trainer's answer to the last control page
+    if status is None:
+        status = FECCommandStatus()
+    status.last_command = None if page[1] == 0xFF else page[1]
+    status.sequence = page[2]
+    status.status = page[3]
+    return status
@@ -0,0 +1,450 @@
+import argparse
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+
+import CSCEngine
+import FitReader
+import SensorConfig
+from DataPoints import (
+    DATA_POINT_TIME,
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+from FitProtocol import RECORD_FIELDS
+from SummaryAccumulator import SummaryAccumulator
+
+DEFAULT_BATCH_CHUNK_SIZE = 3600
+DEFAULT_MANIFEST_NAME = "manifest.jsonl"
+PROGRESS_INTERVAL_S = 1.0
+# records of distance used to recompute speed, records keep distance to the centimetre so shorter windows get jumpy
+SPEED_WINDOW_RECORDS = 10
+# RevolutionCounter format of recorded distance: centimetres, millisecond event times
+RECORDED_DISTANCE_FORMAT = (32, 32, 1000)
+CM_PER_KM = 100000
+# centimetres per second no ride reaches (300 km/h), a faster jump in recorded distance is not counted
+RECORDED_DISTANCE_MAX_RATE = 300 * CM_PER_KM / 3600
+
+FORMAT_FIT = "fit"
+FORMAT_CSV = "csv"
+FORMAT_PARQUET = "parquet"
+FORMAT_TCX = "tcx"
+
+COLUMN_NAMES = {DATA_POINT_TIME: "time"}
+COLUMN_NAMES.update({data_point: channel for channel, data_point in SensorConfig.CHANNEL_DATA_POINTS.items()})
+
+ROW_TIME, ROW_HEART_RATE, ROW_POWER, ROW_CADENCE, ROW_SPEED, ROW_DISTANCE = range(len(FitReader.RECORD_DATA_POINTS))
+
+# (row column, highest value) the FIT record fields FitWriter writes can hold, below their invalid values; values
+# outside [0, highest] are clamped instead of failing the ride
+ROW_LIMITS = tuple((FitReader.RECORD_DATA_POINTS.index(data_point), (256 ** size - 2) / scale if scale != 1 else
+                    256 ** size - 2)
+                   for data_point, _, size, _, _, _ in RECORD_FIELDS
+                   for _, scale in (FitReader.DATA_POINT_FIELDS[data_point],))
+# exports are written next to their final name and only moved there once the ride is complete
+TEMP_SUFFIX = ".tmp"
+
+
+class RecordFixer:
+    # Streaming repairs of decoded record rows (FitReader.RECORD_DATA_POINTS order).
+    # Timestamps: a timestamp that does not move forward gets the previous one plus a second, which also re-spaces
+    # the duplicate-then-skipped seconds the old wall-clock recording loop produced.
+    # Speed: recorded distance goes through a CSCEngine.RevolutionCounter as a centimetre counter with millisecond
+    # event times. Distance running backwards (the sensor's counter restarted, the old code recorded it raw) resets
+    # the counter like a reconnect, so the distance stays continuous, and speed is the counter's rate over the last
+    # SPEED_WINDOW_RECORDS records.
+    def __init__(self, fix_timestamps=False, fix_speed=False):
+        self.fix_timestamps = fix_timestamps
+        self.fix_speed = fix_speed
+        self.last_time = None
+        self.first_distance_cm = None
+        self.distance_counter = CSCEngine.RevolutionCounter(RECORDED_DISTANCE_FORMAT, SPEED_WINDOW_RECORDS,
+                                                             max_rate=RECORDED_DISTANCE_MAX_RATE)
+        self.fixed_timestamps = 0
+        self.fixed_distances = 0
+
+    def fix(self, row):
+        if self.fix_timestamps and self.last_time is not None and (row[ROW_TIME] is None or
+                                                                   row[ROW_TIME] <= self.last_time):
+            row[ROW_TIME] = self.last_time + 1
+            self.fixed_timestamps += 1
+        self.last_time = row[ROW_TIME]
+        if self.fix_speed and row[ROW_DISTANCE] is not None and row[ROW_TIME] is not None:
+            counter = self.distance_counter
+            distance_cm = round(row[ROW_DISTANCE] * CM_PER_KM)
+            if self.first_distance_cm is None:
+                self.first_distance_cm = distance_cm
+            elif counter.last_revs is not None and distance_cm < counter.last_revs:
+                counter.reset()
+                self.fixed_distances += 1
+            counter.update(distance_cm, round(row[ROW_TIME] * 1000), row[ROW_TIME])
+            # distance in km, speed in km/h
+            row[ROW_DISTANCE] = (self.first_distance_cm + counter.total_revs) / CM_PER_KM
+            row[ROW_SPEED] = counter.rate * 3600 / CM_PER_KM
+        return row
+
+
+class CsvExporter:
+    def __init__(self, file_name, start_time, lap_ends, data_points):
+        self.output = open(file_name, "w", newline="")
+        self.writer = csv.writer(self.output)
+        self.writer.writerow([COLUMN_NAMES[data_point] for data_point in FitReader.RECORD_DATA_POINTS])
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self, stop_time):
+        self.output.close()
+
+
+class ParquetExporter:
+    # One row group per chunk of rows
+    def __init__(self, file_name, start_time, lap_ends, data_points):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.schema = pyarrow.schema([
+            (COLUMN_NAMES[DATA_POINT_TIME], pyarrow.float64()),
+            (COLUMN_NAMES[DATA_POINT_HEART_RATE], pyarrow.uint8()),
+            (COLUMN_NAMES[DATA_POINT_POWER], pyarrow.uint16()),
+            (COLUMN_NAMES[DATA_POINT_CADENCE], pyarrow.uint8()),
+            (COLUMN_NAMES[DATA_POINT_SPEED], pyarrow.float64()),
+            (COLUMN_NAMES[DATA_POINT_DISTANCE], pyarrow.float64()),
+        ])
+        self.writer = pyarrow.parquet.ParquetWriter(file_name, self.schema)
+
+    def write_rows(self, rows):
+        columns = [list(column) for column in zip(*rows)]
+        self.writer.write_table(self.pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self, stop_time):
+        self.writer.close()
+
+
+class TcxExporter:
+    # Training Center XML without positions. Lap totals come before a lap's track points in TCX, so each lap's track
+    # points are spooled to a temporary file and copied out when the lap closes.
+    def __init__(self, file_name, start_time, lap_ends, data_points):
+        self.output = open(file_name, "w")
+        self.lap_ends = deque(lap_ends)
+        self.track = None
+        self.lap_summary = None
+        self.output.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                          '<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2" '
+                          'xmlns:ns3="http://www.garmin.com/xmlschemas/ActivityExtension/v2">\n'
+                          '<Activities>\n<Activity Sport="Biking">\n'
+                          f'<Id>{format_tcx_time(start_time)}</Id>\n')
+        self.start_lap(start_time)
+
+    def start_lap(self, lap_start):
+        self.track = tempfile.TemporaryFile("w+")
+        self.lap_summary = SummaryAccumulator(round(lap_start * 1000))
+
+    def close_lap(self, lap_end):
+        summary = self.lap_summary.get_summary(round(lap_end * 1000))
+        self.output.write(f'<Lap StartTime="{format_tcx_time(self.lap_summary.start_time / 1000)}">\n'
+                          f'<TotalTimeSeconds>{summary["total_elapsed_time"]:.1f}</TotalTimeSeconds>\n'
+                          f'<DistanceMeters>{summary.get("total_distance", 0) * 1000:.1f}</DistanceMeters>\n'
+                          '<Calories>0</Calories>\n')
+        if "avg_heart_rate" in summary:
+            self.output.write(f'<AverageHeartRateBpm><Value>{summary["avg_heart_rate"]}</Value>'
+                              '</AverageHeartRateBpm>\n'
+                              f'<MaximumHeartRateBpm><Value>{summary["max_heart_rate"]}</Value>'
+                              '</MaximumHeartRateBpm>\n')
+        self.output.write('<Intensity>Active</Intensity>\n')
+        if "avg_cadence" in summary:
+            self.output.write(f'<Cadence>{summary["avg_cadence"]}</Cadence>\n')
+        self.output.write('<TriggerMethod>Manual</TriggerMethod>\n<Track>\n')
+        self.track.seek(0)
+        shutil.copyfileobj(self.track, self.output)
+        self.track.close()
+        self.output.write('</Track>\n</Lap>\n')
+
+    def write_rows(self, rows):
+        for row in rows:
+            while self.lap_ends and row[ROW_TIME] >= self.lap_ends[0]:
+                lap_end = self.lap_ends.popleft()
+                self.close_lap(lap_end)
+                self.start_lap(lap_end)
+            self.lap_summary.add(row[ROW_TIME], row[ROW_HEART_RATE], row[ROW_POWER], row[ROW_CADENCE],
+                                 row[ROW_SPEED], row[ROW_DISTANCE])
+            point = [f'<Trackpoint><Time>{format_tcx_time(row[ROW_TIME])}</Time>']
+            if row[ROW_DISTANCE] is not None:
+                point.append(f'<DistanceMeters>{row[ROW_DISTANCE] * 1000:.2f}</DistanceMeters>')
+            if row[ROW_HEART_RATE]:
+                point.append(f'<HeartRateBpm><Value>{row[ROW_HEART_RATE]}</Value></HeartRateBpm>')
+            if row[ROW_CADENCE] is not None:
+                point.append(f'<Cadence>{min(254, round(row[ROW_CADENCE]))}</Cadence>')
+            if row[ROW_SPEED] is not None or row[ROW_POWER] is not None:
+                point.append('<Extensions><ns3:TPX>')
+                if row[ROW_SPEED] is not None:
+                    point.append(f'<ns3:Speed>{row[ROW_SPEED] / 3.6:.3f}</ns3:Speed>')
+                if row[ROW_POWER] is not None:
+                    point.append(f'<ns3:Watts>{row[ROW_POWER]}</ns3:Watts>')
+                point.append('</ns3:TPX></Extensions>')
+            point.append('</Trackpoint>\n')
+            self.track.write(''.join(point))
+
+    def close(self, stop_time):
+        self.close_lap(stop_time)
+        self.output.write('</Activity>\n</Activities>\n</TrainingCenterDatabase>\n')
+        self.output.close()
+
+
+class FitExporter:
+    # Rewrites the ride with FitWriter, which recomputes the lap and session summaries. The records get every field
+    # the ride has, missing values are written as invalid.
+    def __init__(self, file_name, start_time, lap_ends, data_points):
+        import FitWriter
+        self.fit_writer = FitWriter.FitWriter(streaming=True)
+        self.fit_writer.start_writing(file_name, round(start_time * 1000))
+        self.lap_ends = deque(lap_ends)
+        self.columns = [(data_point, column) for column, data_point in enumerate(FitReader.RECORD_DATA_POINTS)
+                        if data_point in data_points or column == ROW_TIME]
+
+    def write_rows(self, rows):
+        data_maps = []
+        for row in rows:
+            while self.lap_ends and row[ROW_TIME] >= self.lap_ends[0]:
+                self.fit_writer.add_records(data_maps)
+                data_maps = []
+                self.fit_writer.add_lap(round(self.lap_ends.popleft() * 1000))
+            data_maps.append({data_point: row[column] for data_point, column in self.columns})
+        self.fit_writer.add_records(data_maps)
+
+    def close(self, stop_time):
+        self.fit_writer.stop_writing(round(stop_time * 1000))
+
+
+EXPORTERS = {
+    FORMAT_FIT: (".fit", FitExporter),
+    FORMAT_CSV: (".csv", CsvExporter),
+    FORMAT_PARQUET: (".parquet", ParquetExporter),
+    FORMAT_TCX: (".tcx", TcxExporter),
+}
+
+
+def format_tcx_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def clamp_row(row):
+    # Returns the number of values clamped to ROW_LIMITS
+    n_clamped = 0
+    for column, highest in ROW_LIMITS:
+        value = row[column]
+        if value is not None and not 0 <= value <= highest:
+            row[column] = min(highest, max(0, value))
+            n_clamped += 1
+    return n_clamped
+
+
+def process_fit_file(file_name, output_base, formats, fix_timestamps=False, fix_speed=False,
+                     chunk_size=DEFAULT_BATCH_CHUNK_SIZE):
+    # Decodes, repairs and exports one ride chunk by chunk; runs in a worker process
+    t0 = time.perf_counter()
+    laps, data_points = FitReader.read_laps_and_data_points(file_name)
+    lap_ends = [lap_end for _, lap_end in laps[:-1]]
+    fixer = RecordFixer(fix_timestamps, fix_speed)
+    exporters = []
+    session_summary = None
+    outputs = [output_base + EXPORTERS[output_format][0] for output_format in formats]
+    temp_outputs = [output + TEMP_SUFFIX for output in outputs]
+    n_records = n_clamped = 0
+    last_time = None
+    chunk = []
+    try:
+        for row in FitReader.iter_records(file_name):
+            row = fixer.fix(row)
+            if row[ROW_TIME] is None:
+                continue
+            n_clamped += clamp_row(row)
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                last_time = chunk[-1][ROW_TIME]
+                session_summary = write_chunk(chunk, exporters, session_summary, temp_outputs, formats, lap_ends,
+                                              data_points)
+                n_records += len(chunk)
+                chunk = []
+        if chunk:
+            last_time = chunk[-1][ROW_TIME]
+            session_summary = write_chunk(chunk, exporters, session_summary, temp_outputs, formats, lap_ends,
+                                          data_points)
+            n_records += len(chunk)
+        if laps and last_time is not None:
+            # the ride ends with the last lap, not with its last record
+            last_time = max(last_time, laps[-1][1])
+        while exporters:
+            exporters.pop(0).close(last_time)
+        for temp_output, output in zip(temp_outputs, outputs):
+            if os.path.exists(temp_output):
+                os.replace(temp_output, output)
+    finally:
+        # a ride that failed leaves no partial exports behind, the error it failed with is the one reported
+        for exporter in exporters:
+            with contextlib.suppress(Exception):
+                exporter.close(last_time)
+        for temp_output in temp_outputs:
+            if os.path.exists(temp_output):
+                os.remove(temp_output)
+    return {
+        "records": n_records,
+        "fixed_timestamps": fixer.fixed_timestamps,
+        "fixed_distances": fixer.fixed_distances,
+        "clamped_values": n_clamped,
+        "summary": session_summary.get_summary(round(last_time * 1000)) if session_summary is not None else None,
+        "outputs": outputs if n_records else [],
+        "seconds": time.perf_counter() - t0,
+    }
+
+
+def write_chunk(chunk, exporters, session_summary, outputs, formats, lap_ends, data_points):
+    if session_summary is None:
+        # exporters are opened with the first record, which is the start time of the ride
+        start_time = chunk[0][ROW_TIME]
+        session_summary = SummaryAccumulator(round(start_time * 1000))
+        for output_format, output in zip(formats, outputs):
+            os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+            exporters.append(EXPORTERS[output_format][1](output, start_time, lap_ends, data_points))
+    for row in chunk:
+        session_summary.add(row[ROW_TIME], row[ROW_HEART_RATE], row[ROW_POWER], row[ROW_CADENCE], row[ROW_SPEED],
+                            row[ROW_DISTANCE])
+    for exporter in exporters:
+        exporter.write_rows(chunk)
+    return session_summary
+
+
+def find_fit_files(inputs):
+    # (file name, path relative to its input) for every .fit file in the inputs, directories searched recursively
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            for directory, _, file_names in os.walk(input_path):
+                for file_name in sorted(file_names):
+                    if file_name.lower().endswith(".fit"):
+                        path = os.path.join(directory, file_name)
+                        yield path, os.path.relpath(path, input_path)
+        else:
+            yield input_path, os.path.basename(input_path)
+
+
+def load_manifest(manifest_name):
+    # The last entry of every file wins
+    entries = {}
+    if os.path.exists(manifest_name):
+        with open(manifest_name) as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut short by an interrupted run
+                    continue
+                entries[entry["file"]] = entry
+    return entries
+
+
+def get_job_key(file_name, options):
+    stat = os.stat(file_name)
+    return {"file": os.path.abspath(file_name), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "options": options}
+
+
+def run_batch(inputs, output_dir, formats, workers=None, fix_timestamps=False, fix_speed=False,
+              manifest_name=None, chunk_size=DEFAULT_BATCH_CHUNK_SIZE):
+    # Files already in the manifest with the same size, modification time and options are skipped, so an interrupted
+    # batch continues where it stopped. At most two files per worker are in flight, so memory stays bounded however
+    # large the archive is.
+    if manifest_name is None:
+        manifest_name = os.path.join(output_dir, DEFAULT_MANIFEST_NAME)
+    os.makedirs(output_dir, exist_ok=True)
+    workers = workers or os.cpu_count()
+    options = {"formats": sorted(formats), "fix_timestamps": fix_timestamps, "fix_speed": fix_speed}
+    done = load_manifest(manifest_name)
+    jobs = []
+    n_skipped = 0
+    for file_name, relative_path in find_fit_files(inputs):
+        key = get_job_key(file_name, options)
+        entry = done.get(key["file"])
+        if entry is not None and entry.get("status") == "ok" and \
+                all(entry.get(name) == value for name, value in key.items()):
+            n_skipped += 1
+            continue
+        jobs.append((file_name, os.path.join(output_dir, os.path.splitext(relative_path)[0]), key))
+    print(f"Batch| {len(jobs)} files to process, {n_skipped} already done, {workers} workers")
+
+    t0 = time.monotonic()
+    last_progress = t0
+    n_done = n_failed = n_records = 0
+    pending = {}
+    job_iterator = iter(jobs)
+    with open(manifest_name, "a") as manifest, \
+            concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        while True:
+            for file_name, output_base, key in job_iterator:
+                future = executor.submit(process_fit_file, file_name, output_base, formats, fix_timestamps,
+                                         fix_speed, chunk_size)
+                pending[future] = key
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            finished, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                entry = dict(pending.pop(future))
+                try:
+                    entry.update(future.result())
+                    entry["status"] = "ok"
+                    n_records += entry["records"]
+                except Exception as e:
+                    entry["status"] = "error"
+                    entry["error"] = f"{type(e).__name__}: {e}"
+                    n_failed += 1
+                n_done += 1
+                manifest.write(json.dumps(entry) + "\n")
+            manifest.flush()
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_INTERVAL_S or not pending:
+                last_progress = now
+                rate = n_done / max(now - t0, 1e-9)
+                eta = (len(jobs) - n_done) / rate if rate else 0
+                print(f"Batch| {n_done}/{len(jobs)} files ({n_failed} failed), {n_records} records, "
+                      f"{rate:.1f} files/s, ETA {eta:.0f}s")
+    print(f"Batch| done in {time.monotonic() - t0:.1f}s, manifest: {manifest_name}")
+    return n_failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reprocess FIT files recorded by FitWriter in parallel")
+    parser.add_argument("inputs", nargs="+", help="FIT files or directories searched recursively for .fit files")
+    parser.add_argument("-o", "--output-dir", required=True, help="directory the exports and the manifest go to")
+    parser.add_argument("-f", "--format", action="append", choices=sorted(EXPORTERS),
+                        help="export format, can be given more than once (default: fit)")
+    parser.add_argument("-j", "--workers", type=int, help="worker processes (default: all cores)")
+    parser.add_argument("--fix-timestamps", action="store_true", help="re-space duplicate and backwards timestamps")
+    parser.add_argument("--fix-speed", action="store_true",
+                        help="continue distance across counter restarts and recompute speed from distance")
+    parser.add_argument("--manifest", help=f"manifest file (default: OUTPUT_DIR/{DEFAULT_MANIFEST_NAME})")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_BATCH_CHUNK_SIZE, help="records per chunk")
+    args = parser.parse_args()
+    if FORMAT_PARQUET in (args.format or []):
+        try:
+            import pyarrow
+        except ImportError:
+            parser.error("parquet export needs pyarrow (pip install pyarrow)")
+    n_failed = run_batch(args.inputs, args.output_dir, args.format or [FORMAT_FIT], args.workers,
+                         args.fix_timestamps, args.fix_speed, args.manifest, args.chunk_size)
+    sys.exit(1 if n_failed else 0)
+
+
+if __name__ == '__main__':
+    main()
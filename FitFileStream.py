@@ -0,0 +1,244 @@
+import logging
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+from fit_tool.definition_message import DefinitionMessage
+from fit_tool.fit_file_header import FitFileHeader
+from fit_tool.record import Record
+from fit_tool.utils.crc import crc16
+
+from FitProtocol import (
+    FIT_HEADER_SIZE,
+    FIT_CRC_SIZE,
+    RECORD_HEADER_COMPRESSED_TIMESTAMP,
+    RECORD_HEADER_DEFINITION,
+    RECORD_HEADER_DEVELOPER_DATA,
+)
+from Instrumentation import METRICS
+
+DEFAULT_FLUSH_RECORDS = 30
+
+LOG = logging.getLogger(__name__)
+IO_WRITES = METRICS.counter("fit_io_writes")
+IO_ERRORS = METRICS.counter("fit_io_errors")
+# one drain of the I/O worker queue: all writes queued since the last drain and one fsync per file
+IO_DRAIN_TIME = METRICS.histogram("fit_io_drain_seconds")
+
+
+def write_records(output, data, fsync):
+    output.write(data)
+    output.flush()
+    if fsync:
+        os.fsync(output.fileno())
+
+
+def finish_output(output, trailer, header, fsync):
+    # appends the file CRC, patches the header and closes the file
+    output.write(trailer)
+    output.seek(0)
+    output.write(header)
+    output.flush()
+    if fsync:
+        os.fsync(output.fileno())
+    output.close()
+
+
+class FitIOWorker:
+    # One thread doing the writes of any number of FitFileStreams, so recording N files costs one I/O thread instead
+    # of N blocking writers. Jobs run in submission order; everything queued while the previous drain ran is written
+    # in one go and every file written to is fsynced once per drain instead of once per write.
+    def __init__(self):
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="FitIOWorker")
+        self.thread.start()
+
+    def submit_write(self, output, data, fsync):
+        self.queue.put((write_records, output, (data, False), fsync))
+
+    def submit_finish(self, output, trailer, header, fsync):
+        self.queue.put((finish_output, output, (trailer, header, fsync), False))
+
+    def run(self):
+        running = True
+        while running:
+            jobs = [self.queue.get()]
+            while True:
+                try:
+                    jobs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            t0 = time.perf_counter()
+            fsync_outputs = {}
+            for job in jobs:
+                if job is None:
+                    running = False
+                    continue
+                function, output, args, fsync = job
+                try:
+                    function(output, *args)
+                    IO_WRITES.add()
+                    if fsync:
+                        fsync_outputs[id(output)] = output
+                except (OSError, ValueError) as e:
+                    IO_ERRORS.add()
+                    LOG.error("FIT I/O| writing %s failed: %s", output.name, e)
+            for output in fsync_outputs.values():
+                try:
+                    if not output.closed:
+                        os.fsync(output.fileno())
+                except OSError as e:
+                    IO_ERRORS.add()
+                    LOG.error("FIT I/O| syncing %s failed: %s", output.name, e)
+            IO_DRAIN_TIME.add(time.perf_counter() - t0)
+
+    def stop(self):
+        # returns once every job submitted before the call is done
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+
+class FitFileStream:
+    # Writes a FIT file incrementally: header placeholder first, encoded records appended in batches, header size
+    # and file CRC patched on close. A 14-byte header carrying its own CRC resets the running file CRC to 0, so the
+    # file CRC only needs to cover the records section and can be computed batch by batch.
+    # With an io_worker, batches are encoded and checksummed on the caller's thread and written by the worker.
+    def __init__(self, file_name, flush_records=DEFAULT_FLUSH_RECORDS, min_string_size=0, fsync=True,
+                 io_worker: FitIOWorker = None):
+        self.file_name = file_name
+        self.flush_records = flush_records
+        self.min_string_size = min_string_size
+        self.fsync = fsync
+        self.io_worker = io_worker
+        self.definition_map = {}
+        self.buffer = bytearray()
+        self.buffered_records = 0
+        self.records_size = 0
+        self.crc = 0
+        self.output = open(file_name, 'wb')
+        self.output.write(FitFileHeader(records_size=0, gen_crc=True).to_bytes())
+        self.output.flush()
+
+    @property
+    def closed(self):
+        return self.output is None
+
+    def add(self, message):
+        definition = DefinitionMessage.from_data_message(message, min_string_size=self.min_string_size)
+        stored_definition = self.definition_map.get(message.local_id)
+        if not isinstance(stored_definition, DefinitionMessage) or not stored_definition.supports(definition):
+            self.definition_map[message.local_id] = definition
+            self.append_record(Record.from_message(definition).to_bytes())
+            stored_definition = definition
+        message.set_definition_message(stored_definition)
+        self.append_record(Record.from_message(message).to_bytes())
+
+    def add_encoded(self, local_id, definition_bytes, record_bytes):
+        if self.definition_map.get(local_id) != definition_bytes:
+            self.definition_map[local_id] = definition_bytes
+            self.append_record(definition_bytes)
+        self.append_record(record_bytes)
+
+    def append_record(self, record_bytes):
+        self.buffer += record_bytes
+        self.buffered_records += 1
+        if self.buffered_records >= self.flush_records:
+            self.flush()
+
+    def flush(self):
+        if self.output is None or not self.buffer:
+            return
+        self.crc = crc16(self.buffer, crc=self.crc)
+        self.records_size += len(self.buffer)
+        if self.io_worker is not None:
+            self.io_worker.submit_write(self.output, bytes(self.buffer), self.fsync)
+        else:
+            write_records(self.output, self.buffer, self.fsync)
+        self.buffer.clear()
+        self.buffered_records = 0
+
+    def close(self):
+        if self.output is None:
+            return
+        self.flush()
+        trailer = struct.pack('<H', self.crc)
+        header = FitFileHeader(records_size=self.records_size, gen_crc=True).to_bytes()
+        if self.io_worker is not None:
+            self.io_worker.submit_finish(self.output, trailer, header, self.fsync)
+        else:
+            finish_output(self.output, trailer, header, self.fsync)
+        self.output = None
+
+
+def scan_complete_records(data, offset, end):
+    # Walks record headers and definitions to find the end of the last complete record before `end`.
+    data_sizes = {}
+    while offset < end:
+        header = data[offset]
+        if header & RECORD_HEADER_COMPRESSED_TIMESTAMP:
+            data_size = data_sizes.get((header >> 5) & 0x03)
+            if data_size is None:
+                break
+            size = 1 + data_size
+        elif header & RECORD_HEADER_DEFINITION:
+            if offset + 6 > end:
+                break
+            n_fields = data[offset + 5]
+            size = 6 + n_fields * 3
+            if offset + size > end:
+                break
+            data_size = sum(data[offset + 6 + i * 3 + 1] for i in range(n_fields))
+            if header & RECORD_HEADER_DEVELOPER_DATA:
+                if offset + size + 1 > end:
+                    break
+                n_developer_fields = data[offset + size]
+                developer_fields_offset = offset + size + 1
+                size += 1 + n_developer_fields * 3
+                if offset + size > end:
+                    break
+                data_size += sum(data[developer_fields_offset + i * 3 + 1] for i in range(n_developer_fields))
+            data_sizes[header & 0x0F] = data_size
+        else:
+            data_size = data_sizes.get(header & 0x0F)
+            if data_size is None:
+                break
+            size = 1 + data_size
+        if offset + size > end:
+            break
+        offset += size
+    return offset
+
+
+def recover_fit_file(file_name):
+    # Repairs a FIT file left behind by an interrupted FitFileStream: drops a trailing partial record, then rewrites
+    # the header and appends the file CRC. Returns the size of the recovered records section.
+    with open(file_name, 'r+b') as fit_file:
+        data = fit_file.read()
+        if len(data) < 12 or data[8:12] != b'.FIT':
+            raise ValueError(f"{file_name} is not a FIT file")
+        header_size = data[0]
+        records_size, = struct.unpack_from('<I', data, 4)
+        if records_size > 0 and header_size + records_size + FIT_CRC_SIZE == len(data) and crc16(data) == 0:
+            return records_size
+
+        records_end = scan_complete_records(data, header_size, len(data))
+        records = data[header_size:records_end]
+        fit_file.seek(0)
+        fit_file.write(FitFileHeader(records_size=len(records), gen_crc=True).to_bytes())
+        fit_file.write(records)
+        fit_file.write(struct.pack('<H', crc16(records)))
+        fit_file.truncate()
+    return len(records)
+
+
+if __name__ == '__main__':
+    for recover_file_name in sys.argv[1:]:
+        print(f"Recovered {recover_file_name}: {recover_fit_file(recover_file_name)} bytes of records")
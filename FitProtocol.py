@@ -0,0 +1,41 @@
+from DataPoints import (
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+
+# Constants of the FIT wire format shared by the writers, FitReader and FitBatch.
+# They live apart from FitWriter and FitFileStream so that reading a FIT file does not load fit_tool.
+FIT_EPOCH_MS = 631065600000
+FIT_MESG_NUM_RECORD = 20
+
+FIT_HEADER_SIZE = 14
+FIT_CRC_SIZE = 2
+
+RECORD_HEADER_COMPRESSED_TIMESTAMP = 0x80
+RECORD_HEADER_DEFINITION = 0x40
+RECORD_HEADER_DEVELOPER_DATA = 0x20
+
+
+def encode_unscaled(value):
+    return int(value)
+
+
+def encode_speed(value):
+    return round((value + 0.0) * 1000.0)
+
+
+def encode_distance(value):
+    return round((value + 0.0) * 100.0)
+
+
+# data point, FIT field id, field size, FIT base type, struct format, value encoder; in RecordMessage field order
+RECORD_FIELDS = (
+    (DATA_POINT_HEART_RATE, 3, 1, 0x02, 'B', encode_unscaled),
+    (DATA_POINT_CADENCE, 4, 1, 0x02, 'B', encode_unscaled),
+    (DATA_POINT_DISTANCE, 5, 4, 0x86, 'I', encode_distance),
+    (DATA_POINT_SPEED, 6, 2, 0x84, 'H', encode_speed),
+    (DATA_POINT_POWER, 7, 2, 0x84, 'H', encode_unscaled),
+)
@@ -0,0 +1,497 @@
+import logging
+import mmap
+import os
+import random
+import struct
+import sys
+import time
+from array import array
+from bisect import bisect_left
+
+from DataPoints import (
+    DATA_POINT_TIME,
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+from FitProtocol import (
+    FIT_EPOCH_MS,
+    FIT_MESG_NUM_RECORD,
+    RECORD_HEADER_COMPRESSED_TIMESTAMP,
+    RECORD_HEADER_DEFINITION,
+    RECORD_HEADER_DEVELOPER_DATA,
+)
+
+LOG = logging.getLogger(__name__)
+
+FIT_MESG_NUM_LAP = 19
+FIT_FIELD_TIMESTAMP = 253
+FIT_FIELD_LAP_START_TIME = 2
+
+DEFAULT_READ_CHUNK_SIZE = 1 << 16
+FIT_EPOCH_S = FIT_EPOCH_MS // 1000
+
+INDEX_FILE_SUFFIX = ".idx"
+# the index arrays are stored in native byte order, an index from a machine with the other one is rebuilt
+INDEX_MAGIC = b'FITIDX1' + (b'L' if sys.byteorder == 'little' else b'B')
+# magic, size and mtime_ns of the FIT file, number of records, number of definitions
+INDEX_HEADER = struct.Struct('<8sQQII')
+# big endian, number of fields, developer data size; followed by the field definitions
+INDEX_DEFINITION_HEADER = struct.Struct('<BBH')
+
+# FIT base type: (struct format, invalid value)
+BASE_TYPES = {
+    0x00: ('B', 0xFF),
+    0x01: ('b', 0x7F),
+    0x02: ('B', 0xFF),
+    0x83: ('h', 0x7FFF),
+    0x84: ('H', 0xFFFF),
+    0x85: ('i', 0x7FFFFFFF),
+    0x86: ('I', 0xFFFFFFFF),
+    0x88: ('f', None),
+    0x89: ('d', None),
+    0x0A: ('B', 0x00),
+    0x8B: ('H', 0x0000),
+    0x8C: ('I', 0x00000000),
+    0x0D: ('B', 0xFF),
+    0x8E: ('q', 0x7FFFFFFFFFFFFFFF),
+    0x8F: ('Q', 0xFFFFFFFFFFFFFFFF),
+    0x90: ('Q', 0x0000000000000000),
+}
+
+# Row layout of decoded records, the same data points FitWriter writes
+RECORD_DATA_POINTS = (
+    DATA_POINT_TIME,
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+# record field id: (row column, scale)
+RECORD_FIELD_COLUMNS = {
+    FIT_FIELD_TIMESTAMP: (0, 1),
+    3: (1, 1),
+    7: (2, 1),
+    4: (3, 1),
+    6: (4, 1000),
+    5: (5, 100),
+}
+# data point: (record field id, scale)
+DATA_POINT_FIELDS = {RECORD_DATA_POINTS[column]: (field_id, scale)
+                     for field_id, (column, scale) in RECORD_FIELD_COLUMNS.items()}
+
+
+def parse_definition(buffer, offset, end):
+    # (size, big endian, global message number, [(field id, size, base type)], developer data size) of the definition
+    # message at offset, None when it does not end before `end`
+    if offset + 6 > end:
+        return None
+    n_fields = buffer[offset + 5]
+    size = 6 + n_fields * 3
+    developer_size = 0
+    if buffer[offset] & RECORD_HEADER_DEVELOPER_DATA:
+        if offset + size + 1 > end:
+            return None
+        n_developer_fields = buffer[offset + size]
+        developer_offset = offset + size + 1
+        size += 1 + n_developer_fields * 3
+        if offset + size > end:
+            return None
+        developer_size = sum(buffer[developer_offset + i * 3 + 1] for i in range(n_developer_fields))
+    elif offset + size > end:
+        return None
+    big_endian = buffer[offset + 2] == 1
+    global_num = struct.unpack_from('>H' if big_endian else '<H', buffer, offset + 3)[0]
+    fields = [tuple(buffer[offset + 6 + i * 3:offset + 9 + i * 3]) for i in range(n_fields)]
+    return size, big_endian, global_num, fields, developer_size
+
+
+class FitDataDefinition:
+    # A definition message compiled into one struct that unpacks just the wanted fields of its data messages.
+    # Without wanted fields its data messages are only skipped and field_ids is None.
+    __slots__ = ('global_num', 'size', 'unpacker', 'field_ids', 'invalid_values')
+
+    def __init__(self, global_num, big_endian, fields, developer_size, wanted_fields=None):
+        self.global_num = global_num
+        if wanted_fields is None:
+            self.size = sum(field[1] for field in fields) + developer_size
+            self.unpacker = None
+            self.field_ids = None
+            self.invalid_values = None
+            return
+        layout = '>' if big_endian else '<'
+        self.field_ids = []
+        self.invalid_values = []
+        for field_id, size, base_type in fields:
+            base_format, invalid_value = BASE_TYPES.get(base_type & 0x9F, (None, None))
+            if field_id in wanted_fields and base_format is not None and struct.calcsize(base_format) == size:
+                layout += base_format
+                self.field_ids.append(field_id)
+                self.invalid_values.append(invalid_value)
+            else:
+                layout += f'{size}x'
+        layout += f'{developer_size}x'
+        self.unpacker = struct.Struct(layout)
+        self.size = self.unpacker.size
+
+
+class FitMessageReader:
+    # Streams the data messages of a FIT file in fixed-size chunks, so memory use does not depend on the file size.
+    # Only the messages and fields listed in `wanted` ({global message number: set of field ids}) are decoded, other
+    # messages are skipped by size. Compressed timestamp headers get their timestamp field filled in. A truncated
+    # last message, e.g. in a file that was never closed, ends the stream.
+    def __init__(self, file_name, wanted, chunk_size=DEFAULT_READ_CHUNK_SIZE):
+        self.file_name = file_name
+        self.wanted = wanted
+        self.chunk_size = chunk_size
+        # global message number -> ids of the fields its definitions have, filled in while reading
+        self.defined_fields = {}
+
+    def __iter__(self):
+        definitions = {}
+        last_timestamp = None
+        with open(self.file_name, 'rb') as fit_file:
+            header = fit_file.read(12)
+            if len(header) < 12 or header[8:12] != b'.FIT':
+                raise ValueError(f"{self.file_name} is not a FIT file")
+            header_size = header[0]
+            data_size = struct.unpack_from('<I', header, 4)[0]
+            fit_file.seek(header_size)
+            end = header_size + data_size
+            if data_size == 0:
+                # never closed, read until the CRC-less end of the file
+                end = None
+            position = header_size
+            buffer = bytearray()
+            offset = 0
+            while True:
+                if offset > self.chunk_size:
+                    del buffer[:offset]
+                    offset = 0
+                to_read = self.chunk_size if end is None else min(self.chunk_size, end - position)
+                chunk = fit_file.read(to_read) if to_read > 0 else b''
+                position += len(chunk)
+                buffer += chunk
+                at_end = len(chunk) < to_read or to_read <= 0
+                while offset < len(buffer):
+                    record_header = buffer[offset]
+                    if record_header & RECORD_HEADER_COMPRESSED_TIMESTAMP:
+                        definition = definitions.get((record_header >> 5) & 0x03)
+                        if definition is None:
+                            raise ValueError(f"{self.file_name}: data message without definition")
+                        if offset + 1 + definition.size > len(buffer):
+                            break
+                        if last_timestamp is not None:
+                            time_offset = record_header & 0x1F
+                            last_timestamp += (time_offset - last_timestamp) & 0x1F
+                        if definition.field_ids is not None:
+                            fields = self.decode(definition, buffer, offset + 1)
+                            if last_timestamp is not None:
+                                fields[FIT_FIELD_TIMESTAMP] = last_timestamp
+                            yield definition.global_num, fields
+                        offset += 1 + definition.size
+                    elif record_header & RECORD_HEADER_DEFINITION:
+                        parsed = parse_definition(buffer, offset, len(buffer))
+                        if parsed is None:
+                            break
+                        size, big_endian, global_num, fields, developer_size = parsed
+                        self.defined_fields.setdefault(global_num, set()).update(field[0] for field in fields)
+                        definitions[record_header & 0x0F] = FitDataDefinition(global_num, big_endian, fields,
+                                                                              developer_size,
+                                                                              self.wanted.get(global_num))
+                        offset += size
+                    else:
+                        definition = definitions.get(record_header & 0x0F)
+                        if definition is None:
+                            raise ValueError(f"{self.file_name}: data message without definition")
+                        if offset + 1 + definition.size > len(buffer):
+                            break
+                        if definition.field_ids is not None:
+                            fields = self.decode(definition, buffer, offset + 1)
+                            timestamp = fields.get(FIT_FIELD_TIMESTAMP)
+                            if timestamp is not None:
+                                last_timestamp = timestamp
+                            yield definition.global_num, fields
+                        offset += 1 + definition.size
+                if at_end:
+                    return
+
+    @staticmethod
+    def decode(definition, buffer, offset):
+        fields = {}
+        for field_id, value, invalid_value in zip(definition.field_ids, definition.unpacker.unpack_from(buffer, offset),
+                                                  definition.invalid_values):
+            if value != invalid_value:
+                fields[field_id] = value
+        return fields
+
+
+def iter_records(file_name, chunk_size=DEFAULT_READ_CHUNK_SIZE):
+    # Yields one list per record message in RECORD_DATA_POINTS order: unix time in seconds, then values scaled like
+    # FitWriter wrote them, None where the field is missing or invalid
+    wanted = {FIT_MESG_NUM_RECORD: set(RECORD_FIELD_COLUMNS)}
+    for _, fields in FitMessageReader(file_name, wanted, chunk_size):
+        yield get_record_row(fields)
+
+
+def get_record_row(fields):
+    row = [None] * len(RECORD_DATA_POINTS)
+    for field_id, value in fields.items():
+        column, scale = RECORD_FIELD_COLUMNS[field_id]
+        row[column] = value / scale if scale != 1 else value
+    if row[0] is not None:
+        row[0] += FIT_EPOCH_S
+    return row
+
+
+def read_lap_times(file_name, chunk_size=DEFAULT_READ_CHUNK_SIZE):
+    # (start, end) unix times in seconds of every lap message
+    return read_laps_and_data_points(file_name, chunk_size)[0]
+
+
+def read_laps_and_data_points(file_name, chunk_size=DEFAULT_READ_CHUNK_SIZE):
+    # One pass over the file: the lap times like read_lap_times(), and the RECORD_DATA_POINTS any record definition
+    # has a field for, e.g. heart rate when the strap only connected halfway through the ride
+    wanted = {FIT_MESG_NUM_LAP: {FIT_FIELD_TIMESTAMP, FIT_FIELD_LAP_START_TIME}}
+    reader = FitMessageReader(file_name, wanted, chunk_size)
+    laps = []
+    for _, fields in reader:
+        if FIT_FIELD_LAP_START_TIME in fields and FIT_FIELD_TIMESTAMP in fields:
+            laps.append((fields[FIT_FIELD_LAP_START_TIME] + FIT_EPOCH_S, fields[FIT_FIELD_TIMESTAMP] + FIT_EPOCH_S))
+    record_fields = reader.defined_fields.get(FIT_MESG_NUM_RECORD, set())
+    data_points = tuple(data_point for data_point in RECORD_DATA_POINTS
+                        if DATA_POINT_FIELDS[data_point][0] in record_fields)
+    return laps, data_points
+
+
+class MappedFitReader:
+    # Random access to the record messages of a FIT file through mmap. One scan builds an index of every record's
+    # offset, definition and timestamp, which is saved next to the file (file name + INDEX_FILE_SUFFIX), so reopening
+    # a long ride only reads three arrays and seeking to a time is a bisect over the timestamps. The index is rebuilt
+    # when the FIT file's size or modification time changed, e.g. while it is still being recorded.
+    # Seeks assume timestamps never go backwards, which holds for files recorded on SampleScheduler ticks; older files
+    # can be repaired with FitBatch.py --fix-timestamps.
+    def __init__(self, file_name, index_file_name=None, save_index=True):
+        self.file_name = file_name
+        self.index_file_name = index_file_name or file_name + INDEX_FILE_SUFFIX
+        self.file = open(file_name, 'rb')
+        header = self.file.read(12)
+        if len(header) < 12 or header[8:12] != b'.FIT':
+            self.file.close()
+            raise ValueError(f"{file_name} is not a FIT file")
+        stat = os.fstat(self.file.fileno())
+        self.source_key = (stat.st_size, stat.st_mtime_ns)
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.clear_index()
+        if not self.load_index():
+            self.build_index()
+            if save_index:
+                self.save_index()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def clear_index(self):
+        # record definitions as (big endian, fields, developer data size), and their decoders
+        self.definitions = []
+        self.decoders = []
+        self.timestamps = array('I')
+        self.offsets = array('I')
+        self.definition_ids = array('H')
+
+    def add_definition(self, definition):
+        self.definitions.append(definition)
+        big_endian, fields, developer_size = definition
+        self.decoders.append(FitDataDefinition(FIT_MESG_NUM_RECORD, big_endian, fields, developer_size,
+                                               set(RECORD_FIELD_COLUMNS)))
+
+    def build_index(self):
+        data = self.map
+        header_size = data[0]
+        data_size = struct.unpack_from('<I', data, 4)[0]
+        end = min(header_size + data_size, len(data)) if data_size else len(data)
+        # local message number: (record definition id or None, decoder)
+        local_definitions = {}
+        definition_ids = {}
+        last_timestamp = None
+        offset = header_size
+        while offset < end:
+            record_header = data[offset]
+            compressed = record_header & RECORD_HEADER_COMPRESSED_TIMESTAMP
+            if not compressed and record_header & RECORD_HEADER_DEFINITION:
+                parsed = parse_definition(data, offset, end)
+                if parsed is None:
+                    break
+                size, big_endian, global_num, fields, developer_size = parsed
+                if global_num == FIT_MESG_NUM_RECORD:
+                    definition = (big_endian, fields, developer_size)
+                    key = (big_endian, tuple(fields), developer_size)
+                    if key not in definition_ids:
+                        definition_ids[key] = len(self.definitions)
+                        self.add_definition(definition)
+                    definition_id = definition_ids[key]
+                    local_definitions[record_header & 0x0F] = (definition_id, self.decoders[definition_id])
+                else:
+                    # other messages only matter for their size and the timestamps compressed headers count from
+                    local_definitions[record_header & 0x0F] = (None, FitDataDefinition(
+                        global_num, big_endian, fields, developer_size, {FIT_FIELD_TIMESTAMP}))
+                offset += size
+                continue
+            local_id = (record_header >> 5) & 0x03 if compressed else record_header & 0x0F
+            local_definition = local_definitions.get(local_id)
+            if local_definition is None:
+                raise ValueError(f"{self.file_name}: data message without definition")
+            definition_id, decoder = local_definition
+            if offset + 1 + decoder.size > end:
+                break
+            if compressed:
+                if last_timestamp is not None:
+                    last_timestamp += ((record_header & 0x1F) - last_timestamp) & 0x1F
+            else:
+                timestamp = FitMessageReader.decode(decoder, data, offset + 1).get(FIT_FIELD_TIMESTAMP)
+                if timestamp is not None:
+                    last_timestamp = timestamp
+            if definition_id is not None:
+                self.timestamps.append(last_timestamp or 0)
+                self.offsets.append(offset)
+                self.definition_ids.append(definition_id)
+            offset += 1 + decoder.size
+
+    def save_index(self):
+        temporary_file_name = self.index_file_name + ".tmp"
+        try:
+            with open(temporary_file_name, 'wb') as index_file:
+                index_file.write(INDEX_HEADER.pack(INDEX_MAGIC, *self.source_key, len(self.offsets),
+                                                   len(self.definitions)))
+                for big_endian, fields, developer_size in self.definitions:
+                    index_file.write(INDEX_DEFINITION_HEADER.pack(big_endian, len(fields), developer_size))
+                    index_file.write(bytes(value for field in fields for value in field))
+                self.timestamps.tofile(index_file)
+                self.offsets.tofile(index_file)
+                self.definition_ids.tofile(index_file)
+            os.replace(temporary_file_name, self.index_file_name)
+        except OSError as e:
+            # e.g. a read-only archive, the index is rebuilt next time
+            LOG.warning("FitReader %s| could not save index: %s", self.file_name, e)
+
+    def load_index(self):
+        try:
+            with open(self.index_file_name, 'rb') as index_file:
+                data = index_file.read()
+        except OSError:
+            return False
+        try:
+            magic, size, mtime_ns, n_records, n_definitions = INDEX_HEADER.unpack_from(data)
+            if magic != INDEX_MAGIC or (size, mtime_ns) != self.source_key:
+                return False
+            offset = INDEX_HEADER.size
+            for _ in range(n_definitions):
+                big_endian, n_fields, developer_size = INDEX_DEFINITION_HEADER.unpack_from(data, offset)
+                offset += INDEX_DEFINITION_HEADER.size
+                fields = [tuple(data[offset + i * 3:offset + i * 3 + 3]) for i in range(n_fields)]
+                offset += n_fields * 3
+                self.add_definition((bool(big_endian), fields, developer_size))
+            for column in (self.timestamps, self.offsets, self.definition_ids):
+                n_bytes = column.itemsize * n_records
+                column.frombytes(data[offset:offset + n_bytes])
+                offset += n_bytes
+        except (struct.error, ValueError):
+            offset = None
+        if offset != len(data):
+            # truncated or otherwise damaged
+            self.clear_index()
+            return False
+        return True
+
+    def get_time(self, index):
+        return self.timestamps[index] + FIT_EPOCH_S
+
+    def seek(self, timestamp):
+        # Index of the first record at or after the unix time in seconds, len(self) when there is none
+        return bisect_left(self.timestamps, timestamp - FIT_EPOCH_S)
+
+    def get_range(self, start=None, end=None):
+        return (0 if start is None else self.seek(start)), (len(self) if end is None else self.seek(end))
+
+    def read_record(self, index):
+        # One record as a row in RECORD_DATA_POINTS order, like iter_records()
+        fields = FitMessageReader.decode(self.decoders[self.definition_ids[index]], self.map, self.offsets[index] + 1)
+        fields[FIT_FIELD_TIMESTAMP] = self.timestamps[index]
+        return get_record_row(fields)
+
+    def iter_window(self, start=None, end=None):
+        # Rows of the records from start (inclusive) to end (exclusive), unix times in seconds
+        first, last = self.get_range(start, end)
+        for index in range(first, last):
+            yield self.read_record(index)
+
+    def get_field_location(self, definition_id, field_id):
+        # (offset in the message, numpy dtype, invalid value) of a field of a record definition, None if not in it
+        big_endian, fields, developer_size = self.definitions[definition_id]
+        offset = 1
+        for definition_field_id, size, base_type in fields:
+            if definition_field_id == field_id:
+                base_format, invalid_value = BASE_TYPES.get(base_type & 0x9F, (None, None))
+                if base_format is None or struct.calcsize(base_format) != size:
+                    return None
+                return offset, ('>' if big_endian else '<') + base_format, invalid_value
+            offset += size
+        return None
+
+    def get_channel(self, data_point, start=None, end=None):
+        # One data point of the records from start to end as a float64 NumPy array, NaN where a record does not have
+        # it. Only that field is read from the map, with one vectorised gather per record definition.
+        import numpy
+        first, last = self.get_range(start, end)
+        if data_point == DATA_POINT_TIME:
+            return numpy.frombuffer(self.timestamps, numpy.uint32)[first:last].astype(numpy.float64) + FIT_EPOCH_S
+        if data_point not in DATA_POINT_FIELDS:
+            raise ValueError(f"unknown data point {data_point}")
+        field_id, scale = DATA_POINT_FIELDS[data_point]
+        channel = numpy.full(last - first, numpy.nan)
+        data = numpy.frombuffer(self.map, numpy.uint8)
+        offsets = numpy.frombuffer(self.offsets, numpy.uint32)[first:last].astype(numpy.int64)
+        definition_ids = numpy.frombuffer(self.definition_ids, numpy.uint16)[first:last]
+        for definition_id in numpy.unique(definition_ids):
+            location = self.get_field_location(int(definition_id), field_id)
+            if location is None:
+                continue
+            field_offset, dtype, invalid_value = location
+            dtype = numpy.dtype(dtype)
+            selected = definition_ids == definition_id
+            positions = offsets[selected] + field_offset
+            values = data[positions[:, None] + numpy.arange(dtype.itemsize)].view(dtype).ravel().astype(numpy.float64)
+            if invalid_value is not None:
+                values[values == invalid_value] = numpy.nan
+            channel[selected] = values / scale
+        return channel
+
+
+if __name__ == '__main__':
+    # FitReader.py FIT_FILE: index build/load and seek timings
+    t0 = time.perf_counter()
+    with MappedFitReader(sys.argv[1]) as reader:
+        print(f"{len(reader)} records indexed in {(time.perf_counter() - t0) * 1000:.2f}ms")
+        if len(reader):
+            first_time, last_time = reader.get_time(0), reader.get_time(len(reader) - 1)
+            seek_times = [random.uniform(first_time, last_time) for _ in range(10000)]
+            t0 = time.perf_counter()
+            for seek_time in seek_times:
+                reader.read_record(min(reader.seek(seek_time), len(reader) - 1))
+            print(f"seek + read: {(time.perf_counter() - t0) / len(seek_times) * 1e6:.2f}us")
+            t0 = time.perf_counter()
+            power = reader.get_channel(DATA_POINT_POWER)
+            print(f"power channel of {len(power)} records in {(time.perf_counter() - t0) * 1000:.2f}ms")
@@ -1,4 +1,6 @@
+import logging
 import random
+import struct
 import time
 import datetime
 
@@ -10,33 +12,136 @@ from fit_tool.profile.messages.session_message import SessionMessage
 from fit_tool.profile.messages.event_message import EventMessage
 from fit_tool.profile.messages.lap_message import LapMessage
 from fit_tool.profile.messages.record_message import RecordMessage
-from fit_tool.profile.profile_type import FileType, Manufacturer, Sport, Event, EventType
+from fit_tool.profile.profile_type import FileType, Manufacturer, Sport, Event, EventType, LapTrigger, SessionTrigger
 
-DATA_POINT_TIME = 1
-DATA_POINT_HEART_RATE = 2
-DATA_POINT_POWER = 3
-DATA_POINT_CADENCE = 4
-DATA_POINT_SPEED = 5
-DATA_POINT_DISTANCE = 6
+from DataPoints import (
+    DATA_POINT_TIME,
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+from FitFileStream import FitFileStream, DEFAULT_FLUSH_RECORDS
+from FitProtocol import FIT_EPOCH_MS, FIT_MESG_NUM_RECORD, RECORD_FIELDS
+from Instrumentation import METRICS
+from SummaryAccumulator import (
+    SummaryAccumulator,
+    DEFAULT_HR_ZONE_BOUNDARIES,
+    DEFAULT_POWER_ZONE_BOUNDARIES,
+    SUMMARY_FIELD_LIMITS,
+)
+
+LOG = logging.getLogger(__name__)
+RECORDS_WRITTEN = METRICS.counter("fit_records")
+# add_record() per record, add_records() and add_samples() per batch
+ADD_RECORD_TIME = METRICS.histogram("fit_add_record_seconds")
+ADD_SAMPLES_TIME = METRICS.histogram("fit_add_samples_seconds")
+
+# in SummaryAccumulator.add() argument order
+SUMMARY_DATA_POINTS = (
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+
+
+class RecordEncoder:
+    # Encodes record messages for a fixed set of data points straight to bytes, producing the same definition and
+    # data messages fit_tool's RecordMessage would, without building a message object per sample.
+    def __init__(self, data_points, local_id=0):
+        self.local_id = local_id
+        fields = [field for field in RECORD_FIELDS if field[0] in data_points]
+        self.data_points = tuple(field[0] for field in fields)
+        # (value encoder, invalid value, highest value) per field: a missing value (None) is written as the field's
+        # invalid value, all bits set, and encoded values are clamped to [0, highest value] so no value the field
+        # cannot hold reaches the struct
+        self.value_formats = tuple((field[5], (1 << 8 * field[2]) - 1, (1 << 8 * field[2]) - 2) for field in fields)
+
+        definition = bytearray(struct.pack('<BBBHB', 0x40 | local_id, 0, 0, FIT_MESG_NUM_RECORD, len(fields) + 1))
+        definition += struct.pack('BBB', 253, 4, 0x86)
+        for _, field_id, size, base_type, _, _ in fields:
+            definition += struct.pack('BBB', field_id, size, base_type)
+        self.definition_bytes = bytes(definition)
+        self.data_struct = struct.Struct('<BI' + ''.join(field[4] for field in fields))
+        self.size = self.data_struct.size
+
+    def encode_values(self, timestamp_ms, data_map):
+        values = [self.local_id, round((timestamp_ms - float(FIT_EPOCH_MS)) * 0.001)]
+        for data_point, (value_encoder, invalid_value, highest_value) in zip(self.data_points, self.value_formats):
+            value = data_map[data_point]
+            values.append(invalid_value if value is None else min(highest_value, max(0, value_encoder(value))))
+        return values
+
+    def encode_ordered(self, timestamp_ms, ordered_values):
+        # ordered_values follow self.data_points
+        values = [self.local_id, round((timestamp_ms - float(FIT_EPOCH_MS)) * 0.001)]
+        for value, (value_encoder, invalid_value, highest_value) in zip(ordered_values, self.value_formats):
+            values.append(invalid_value if value is None else min(highest_value, max(0, value_encoder(value))))
+        return self.data_struct.pack(*values)
+
+    def encode(self, timestamp_ms, data_map):
+        return self.data_struct.pack(*self.encode_values(timestamp_ms, data_map))
+
+    def encode_into(self, buffer, offset, timestamp_ms, data_map):
+        self.data_struct.pack_into(buffer, offset, *self.encode_values(timestamp_ms, data_map))
+
+    def encode_records(self, data_maps, include_definition=True):
+        buffer = bytearray(self.definition_bytes) if include_definition else bytearray()
+        offset = len(buffer)
+        buffer.extend(bytes(self.size * len(data_maps)))
+        for data_map in data_maps:
+            self.encode_into(buffer, offset, get_record_timestamp(data_map), data_map)
+            offset += self.size
+        return buffer
+
+
+def get_record_timestamp(data_map):
+    if DATA_POINT_TIME in data_map:
+        return round(data_map[DATA_POINT_TIME] * 1000)
+    return round(datetime.datetime.now().timestamp() * 1000)
 
 
 class FitWriter:
-    def __init__(self):
+    # Writers recording side by side can share one record_encoders dict, encoders only depend on the data points, and
+    # one FitIOWorker doing their file writes
+    def __init__(self, streaming=False, flush_records=DEFAULT_FLUSH_RECORDS, hr_zones=DEFAULT_HR_ZONE_BOUNDARIES,
+                 power_zones=DEFAULT_POWER_ZONE_BOUNDARIES, record_encoders=None, io_worker=None):
+        self.streaming = streaming
+        self.flush_records = flush_records
+        self.hr_zones = hr_zones
+        self.power_zones = power_zones
         self.file_name = None
         self.file_open = False
         self.output_file = None
         self.start_time = None
+        self.num_laps = 0
+        self.session_summary = None
+        self.lap_summary = None
+        self.record_encoders = {} if record_encoders is None else record_encoders
+        self.io_worker = io_worker
 
-    def start_writing(self, file_name):
-        print(f"Started writing: {file_name}")
+    def start_writing(self, file_name, start_time=None):
+        # start_time in ms, defaults to now
+        LOG.info("Started writing: %s", file_name)
         if self.file_open:
             self.stop_writing()
         self.file_name = file_name
-        self.output_file = FitFileBuilder(auto_define=True, min_string_size=50)
+        if self.streaming:
+            self.output_file = FitFileStream(file_name, flush_records=self.flush_records, min_string_size=50,
+                                             io_worker=self.io_worker)
+        else:
+            self.output_file = FitFileBuilder(auto_define=True, min_string_size=50)
         self.file_open = True
 
-        start_time = round(datetime.datetime.now().timestamp() * 1000)
+        if start_time is None:
+            start_time = round(datetime.datetime.now().timestamp() * 1000)
         self.start_time = start_time
+        self.num_laps = 0
+        self.session_summary = SummaryAccumulator(start_time, self.hr_zones, self.power_zones)
+        self.lap_summary = SummaryAccumulator(start_time, self.hr_zones, self.power_zones)
 
         # FIle ID Message
         id_message = FileIdMessage()
@@ -62,30 +167,141 @@ class FitWriter:
         start_message.timestamp = start_time
         self.output_file.add(start_message)
 
+    def get_record_encoder(self, data_map):
+        data_points = frozenset(data_map)
+        encoder = self.record_encoders.get(data_points)
+        if encoder is None:
+            encoder = RecordEncoder(data_points)
+            self.record_encoders[data_points] = encoder
+        return encoder
+
+    def add_summary_sample(self, timestamp_ms, values):
+        # values follow SUMMARY_DATA_POINTS, None for data points that are not recorded
+        timestamp = timestamp_ms * 0.001
+        self.session_summary.add(timestamp, *values)
+        self.lap_summary.add(timestamp, *values)
+
     def add_record(self, data_map):
         if self.file_open:
-            print(f"Adding record: {data_map}")
-            record_message = RecordMessage()
-            record_message.timestamp = round(datetime.datetime.now().timestamp() * 1000)
-            if DATA_POINT_TIME in data_map:
-                # record_message.timestamp = data_map[DATA_POINT_TIME]
-                record_message.timestamp = round(data_map[DATA_POINT_TIME] * 1000)
-            if DATA_POINT_HEART_RATE in data_map:
-                record_message.heart_rate = data_map[DATA_POINT_HEART_RATE]
-            if DATA_POINT_POWER in data_map:
-                record_message.power = data_map[DATA_POINT_POWER]
-            if DATA_POINT_CADENCE in data_map:
-                record_message.cadence = data_map[DATA_POINT_CADENCE]
-            if DATA_POINT_SPEED in data_map:
-                record_message.speed = data_map[DATA_POINT_SPEED]
-            if DATA_POINT_DISTANCE in data_map:
-                record_message.distance = data_map[DATA_POINT_DISTANCE]
-            self.output_file.add(record_message)
-
-    def stop_writing(self):
-        print(f"Stopping writing: {self.file_name}")
+            t0 = time.perf_counter()
+            LOG.debug("Adding record: %s", data_map)
+            self.write_record(data_map)
+            ADD_RECORD_TIME.add(time.perf_counter() - t0)
+            RECORDS_WRITTEN.add()
+
+    def write_record(self, data_map):
+        # the summaries only get samples whose record was encoded
+        timestamp = get_record_timestamp(data_map)
+        if self.streaming:
+            encoder = self.get_record_encoder(data_map)
+            record_bytes = encoder.encode(timestamp, data_map)
+            self.add_summary_sample(timestamp, [data_map.get(data_point) for data_point in SUMMARY_DATA_POINTS])
+            self.output_file.add_encoded(encoder.local_id, encoder.definition_bytes, record_bytes)
+            return
+        record_message = RecordMessage()
+        record_message.timestamp = timestamp
+        if DATA_POINT_HEART_RATE in data_map:
+            record_message.heart_rate = data_map[DATA_POINT_HEART_RATE]
+        if DATA_POINT_POWER in data_map:
+            record_message.power = data_map[DATA_POINT_POWER]
+        if DATA_POINT_CADENCE in data_map:
+            record_message.cadence = data_map[DATA_POINT_CADENCE]
+        if DATA_POINT_SPEED in data_map:
+            record_message.speed = data_map[DATA_POINT_SPEED]
+        if DATA_POINT_DISTANCE in data_map:
+            record_message.distance = data_map[DATA_POINT_DISTANCE]
+        self.add_summary_sample(timestamp, [data_map.get(data_point) for data_point in SUMMARY_DATA_POINTS])
+        self.output_file.add(record_message)
+
+    def add_records(self, data_maps):
+        if self.file_open:
+            if not self.streaming:
+                for data_map in data_maps:
+                    self.add_record(data_map)
+                return
+            t0 = time.perf_counter()
+            n_records = 0
+            for data_map in data_maps:
+                encoder = self.get_record_encoder(data_map)
+                timestamp = get_record_timestamp(data_map)
+                record_bytes = encoder.encode(timestamp, data_map)
+                self.add_summary_sample(timestamp, [data_map.get(data_point) for data_point in SUMMARY_DATA_POINTS])
+                self.output_file.add_encoded(encoder.local_id, encoder.definition_bytes, record_bytes)
+                n_records += 1
+            ADD_SAMPLES_TIME.add(time.perf_counter() - t0)
+            RECORDS_WRITTEN.add(n_records)
+
+    def add_samples(self, sample_buffer, start=0, stop=None):
+        if not self.file_open:
+            return
+        if not self.streaming:
+            for index in range(start, len(sample_buffer) if stop is None else stop):
+                self.add_record(sample_buffer.data_map(index))
+            return
+        t0 = time.perf_counter()
+        n_records = 0
+        encoder = self.get_record_encoder(sample_buffer.data_points)
+        time_index = (sample_buffer.column_index(DATA_POINT_TIME) if DATA_POINT_TIME in sample_buffer.data_points
+                      else None)
+        value_indexes = [sample_buffer.column_index(data_point) for data_point in encoder.data_points]
+        summary_indexes = [sample_buffer.column_index(data_point) if data_point in sample_buffer.data_points else None
+                           for data_point in SUMMARY_DATA_POINTS]
+        for row in sample_buffer.rows(start, stop):
+            if time_index is None:
+                timestamp = round(datetime.datetime.now().timestamp() * 1000)
+            else:
+                timestamp = round(row[time_index] * 1000)
+            record_bytes = encoder.encode_ordered(timestamp, [row[index] for index in value_indexes])
+            self.add_summary_sample(timestamp, [None if index is None else row[index] for index in summary_indexes])
+            self.output_file.add_encoded(encoder.local_id, encoder.definition_bytes, record_bytes)
+            n_records += 1
+        ADD_SAMPLES_TIME.add(time.perf_counter() - t0)
+        RECORDS_WRITTEN.add(n_records)
+
+    def add_lap(self, lap_time=None):
+        # Closing a lap only swaps the lap accumulator, adding samples costs the same with or without laps
+        if self.file_open:
+            if lap_time is None:
+                lap_time = round(datetime.datetime.now().timestamp() * 1000)
+            LOG.info("Lap %d: %s", self.num_laps, self.file_name)
+            self.write_lap_message(lap_time, LapTrigger.MANUAL)
+            previous_lap = self.lap_summary
+            self.lap_summary = SummaryAccumulator(lap_time, self.hr_zones, self.power_zones)
+            # the time and distance from the last sample of the previous lap to the first one of this lap count for
+            # this lap, so the laps add up to the session
+            self.lap_summary.last_timestamp = previous_lap.last_timestamp
+            self.lap_summary.first_distance = previous_lap.last_distance
+            self.lap_summary.last_distance = previous_lap.last_distance
+
+    def add_timer_gap(self, stop_time, start_time):
+        # Stops the timer at stop_time and starts it again at start_time (ms), e.g. over ticks the recording missed;
+        # the gap does not count as timer time
+        if self.file_open:
+            for timestamp, event_type in ((stop_time, EventType.STOP), (start_time, EventType.START)):
+                event_message = EventMessage()
+                event_message.event = Event.TIMER
+                event_message.event_type = event_type
+                event_message.timestamp = timestamp
+                self.output_file.add(event_message)
+            paused_time = (start_time - stop_time) / 1000
+            self.session_summary.paused_time += paused_time
+            self.lap_summary.paused_time += paused_time
+
+    def write_lap_message(self, lap_end_time, lap_trigger):
+        lap_message = LapMessage()
+        lap_message.message_index = self.num_laps
+        lap_message.event = Event.LAP
+        lap_message.event_type = EventType.STOP
+        lap_message.lap_trigger = lap_trigger
+        self.lap_summary.apply(lap_message, lap_end_time)
+        self.output_file.add(lap_message)
+        self.num_laps += 1
+
+    def stop_writing(self, stop_time=None):
+        LOG.info("Stopping writing: %s", self.file_name)
         if self.output_file is not None:
-            stop_time = round(datetime.datetime.now().timestamp() * 1000)
+            if stop_time is None:
+                stop_time = round(datetime.datetime.now().timestamp() * 1000)
 
             # Stop Timer Message
             start_message = EventMessage()
@@ -95,27 +311,22 @@ class FitWriter:
             self.output_file.add(start_message)
 
             # Lap Message
-            lap_message = LapMessage()
-            lap_message.start_time = self.start_time
-            lap_message.total_elapsed_time = stop_time - self.start_time
-            lap_message.total_timer_time = stop_time - self.start_time
-            lap_message.timestamp = stop_time
-            self.output_file.add(lap_message)
+            self.write_lap_message(stop_time, LapTrigger.SESSION_END)
 
             # Session Message
             session_message = SessionMessage()
-            session_message.start_time = self.start_time
-            session_message.total_elapsed_time = stop_time - self.start_time
-            session_message.total_timer_time = stop_time - self.start_time
-            session_message.timestamp = stop_time
+            self.session_summary.apply(session_message, stop_time)
             session_message.sport = Sport.CYCLING
+            session_message.trigger = SessionTrigger.ACTIVITY_END
+            session_message.first_lap_index = 0
+            session_message.num_laps = self.num_laps
             self.output_file.add(session_message)
 
             # Activity Message
             activity_message = ActivityMessage()
             activity_message.start_time = self.start_time
-            activity_message.total_elapsed_time = stop_time - self.start_time
-            activity_message.total_timer_time = stop_time - self.start_time
+            timer_time = (stop_time - self.start_time) / 1000 - self.session_summary.paused_time
+            activity_message.total_timer_time = min(SUMMARY_FIELD_LIMITS["total_timer_time"], max(0.0, timer_time))
             activity_message.timestamp = stop_time
             activity_message.sport = Sport.CYCLING
             activity_message.num_sessions = 1
@@ -123,9 +334,13 @@ class FitWriter:
             self.output_file.add(activity_message)
 
             # Write Fit File
-            if self.file_name is None:
-                self.file_name = "unknown.fit"
-            self.output_file.build().to_file(self.file_name)
+            if self.streaming:
+                self.output_file.close()
+            else:
+                if self.file_name is None:
+                    self.file_name = "unknown.fit"
+                self.output_file.build().to_file(self.file_name)
+            self.output_file = None
         self.file_open = False
 
 
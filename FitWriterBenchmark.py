@@ -0,0 +1,58 @@
+import sys
+import time
+
+from fit_tool.fit_file_builder import FitFileBuilder
+from fit_tool.profile.messages.record_message import RecordMessage
+
+import FitWriter
+
+
+def generate_samples(n_samples, t0=1700000000.0):
+    samples = []
+    for i in range(n_samples):
+        samples.append({
+            FitWriter.DATA_POINT_TIME: t0 + i,
+            FitWriter.DATA_POINT_HEART_RATE: 120 + i % 40,
+            FitWriter.DATA_POINT_POWER: 150 + i % 120,
+            FitWriter.DATA_POINT_CADENCE: 85 + i % 10,
+            FitWriter.DATA_POINT_SPEED: 8.0 + (i % 50) / 10,
+            FitWriter.DATA_POINT_DISTANCE: i * 8.5
+        })
+    return samples
+
+
+def encode_with_fit_tool(samples):
+    # Same field assignments FitWriter.add_record() does on the fit_tool path
+    builder = FitFileBuilder(auto_define=True, min_string_size=50)
+    for data_map in samples:
+        record_message = RecordMessage()
+        record_message.timestamp = FitWriter.get_record_timestamp(data_map)
+        record_message.heart_rate = data_map[FitWriter.DATA_POINT_HEART_RATE]
+        record_message.power = data_map[FitWriter.DATA_POINT_POWER]
+        record_message.cadence = data_map[FitWriter.DATA_POINT_CADENCE]
+        record_message.speed = data_map[FitWriter.DATA_POINT_SPEED]
+        record_message.distance = data_map[FitWriter.DATA_POINT_DISTANCE]
+        builder.add(record_message)
+    return b''.join(record.to_bytes() for record in builder.records)
+
+
+def encode_with_record_encoder(samples):
+    encoder = FitWriter.RecordEncoder(frozenset(samples[0]))
+    return bytes(encoder.encode_records(samples))
+
+
+def benchmark_record_encoding(n_samples=20000):
+    samples = generate_samples(n_samples)
+    results = {}
+    for name, encode in (("fit_tool", encode_with_fit_tool), ("RecordEncoder", encode_with_record_encoder)):
+        t0 = time.perf_counter()
+        results[name] = encode(samples)
+        elapsed = time.perf_counter() - t0
+        print(f"{name:>14}: {n_samples / elapsed:12.0f} records/s")
+    if results["fit_tool"] != results["RecordEncoder"]:
+        raise AssertionError("RecordEncoder output differs from fit_tool output")
+    print("outputs are byte-identical")
+
+
+if __name__ == '__main__':
+    benchmark_record_encoding(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
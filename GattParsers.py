@@ -0,0 +1,173 @@
+import struct
+
+# Heart Rate Measurement (0x2A37) flags
+HR_FLAG_UINT16_FORMAT = 0x01
+HR_FLAG_SENSOR_CONTACT_SUPPORTED = 0x04
+HR_FLAG_SENSOR_CONTACT_DETECTED = 0x02
+HR_FLAG_ENERGY_EXPENDED = 0x08
+HR_FLAG_RR_INTERVALS = 0x10
+
+# Cycling Power Measurement (0x2A63) flags
+CP_FLAG_PEDAL_POWER_BALANCE = 0x0001
+CP_FLAG_ACCUMULATED_TORQUE = 0x0004
+CP_FLAG_WHEEL_REVOLUTION_DATA = 0x0010
+CP_FLAG_CRANK_REVOLUTION_DATA = 0x0020
+CP_FLAG_EXTREME_FORCE_MAGNITUDES = 0x0040
+CP_FLAG_EXTREME_TORQUE_MAGNITUDES = 0x0080
+CP_FLAG_EXTREME_ANGLES = 0x0100
+CP_FLAG_TOP_DEAD_SPOT_ANGLE = 0x0200
+CP_FLAG_BOTTOM_DEAD_SPOT_ANGLE = 0x0400
+CP_FLAG_ACCUMULATED_ENERGY = 0x0800
+
+# CSC Measurement (0x2A5B) flags
+CSC_FLAG_WHEEL_REVOLUTION_DATA = 0x01
+CSC_FLAG_CRANK_REVOLUTION_DATA = 0x02
+
+# flag, struct format, fields; in the order the fields follow the flags on the wire
+HEART_RATE_LAYOUT = (
+    (HR_FLAG_ENERGY_EXPENDED, 'H', ('energy_expended',)),
+)
+CYCLING_POWER_LAYOUT = (
+    (CP_FLAG_PEDAL_POWER_BALANCE, 'B', ('pedal_power_balance',)),
+    (CP_FLAG_ACCUMULATED_TORQUE, 'H', ('accumulated_torque',)),
+    (CP_FLAG_WHEEL_REVOLUTION_DATA, 'IH', ('cumulative_wheel_revs', 'last_wheel_event_time')),
+    (CP_FLAG_CRANK_REVOLUTION_DATA, 'HH', ('cumulative_crank_revs', 'last_crank_event_time')),
+    (CP_FLAG_EXTREME_FORCE_MAGNITUDES, 'hh', ('max_force', 'min_force')),
+    (CP_FLAG_EXTREME_TORQUE_MAGNITUDES, 'hh', ('max_torque', 'min_torque')),
+    (CP_FLAG_EXTREME_ANGLES, 'HB', ('max_angle', 'min_angle')),
+    (CP_FLAG_TOP_DEAD_SPOT_ANGLE, 'H', ('top_dead_spot_angle',)),
+    (CP_FLAG_BOTTOM_DEAD_SPOT_ANGLE, 'H', ('bottom_dead_spot_angle',)),
+    (CP_FLAG_ACCUMULATED_ENERGY, 'H', ('accumulated_energy',)),
+)
+CSC_LAYOUT = (
+    (CSC_FLAG_WHEEL_REVOLUTION_DATA, 'IH', ('cumulative_wheel_revs', 'last_wheel_event_time')),
+    (CSC_FLAG_CRANK_REVOLUTION_DATA, 'HH', ('cumulative_crank_revs', 'last_crank_event_time')),
+)
+
+RR_INTERVAL_STRUCTS = {}
+
+
+class HeartRateSample:
+    __slots__ = ('heart_rate', 'sensor_contact', 'energy_expended', 'rr_intervals')
+
+    def __init__(self):
+        self.heart_rate = None
+        self.sensor_contact = None
+        self.energy_expended = None
+        self.rr_intervals = ()
+
+
+class CyclingPowerSample:
+    __slots__ = ('instantaneous_power', 'pedal_power_balance', 'accumulated_torque', 'cumulative_wheel_revs',
+                 'last_wheel_event_time', 'cumulative_crank_revs', 'last_crank_event_time', 'max_force', 'min_force',
+                 'max_torque', 'min_torque', 'max_angle', 'min_angle', 'top_dead_spot_angle', 'bottom_dead_spot_angle',
+                 'accumulated_energy')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+
+class CSCSample:
+    __slots__ = ('cumulative_wheel_revs', 'last_wheel_event_time', 'cumulative_crank_revs', 'last_crank_event_time')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+
+class FlagLayoutCache:
+    # Precompiles one struct.Struct per flags value seen, covering every field present after the flags
+    def __init__(self, header_format, layout, sample_fields):
+        self.header_format = header_format
+        self.layout = layout
+        self.sample_fields = sample_fields
+        self.compiled = {}
+
+    def get(self, flags):
+        compiled = self.compiled.get(flags)
+        if compiled is None:
+            struct_format = '<' + self.header_format
+            names = []
+            for flag, field_format, field_names in self.layout:
+                if flags & flag:
+                    struct_format += field_format
+                    names.extend(field_names)
+            absent = tuple(name for name in self.sample_fields if name not in names)
+            compiled = (struct.Struct(struct_format), tuple(names), absent)
+            self.compiled[flags] = compiled
+        return compiled
+
+
+HEART_RATE_LAYOUTS = (
+    FlagLayoutCache('B', HEART_RATE_LAYOUT, ('energy_expended',)),
+    FlagLayoutCache('H', HEART_RATE_LAYOUT, ('energy_expended',)),
+)
+CYCLING_POWER_LAYOUTS = FlagLayoutCache(
+    'h', CYCLING_POWER_LAYOUT, tuple(name for _, _, names in CYCLING_POWER_LAYOUT for name in names))
+CSC_LAYOUTS = FlagLayoutCache('', CSC_LAYOUT, CSCSample.__slots__)
+
+
+def unpack_layout(compiled, data, offset, sample):
+    data_struct, names, absent = compiled
+    if len(data) < offset + data_struct.size:
+        raise ValueError(f"truncated measurement: {len(data)} bytes, expected {offset + data_struct.size}")
+    values = data_struct.unpack_from(data, offset)
+    for name in absent:
+        setattr(sample, name, None)
+    return values, names, offset + data_struct.size
+
+
+def parse_heart_rate(data, sample: HeartRateSample = None):
+    if sample is None:
+        sample = HeartRateSample()
+    if len(data) < 2:
+        raise ValueError(f"truncated heart rate measurement: {len(data)} bytes")
+    flags = data[0]
+    values, names, offset = unpack_layout(HEART_RATE_LAYOUTS[flags & HR_FLAG_UINT16_FORMAT].get(flags), data, 1, sample)
+    sample.heart_rate = values[0]
+    for name, value in zip(names, values[1:]):
+        setattr(sample, name, value)
+    if flags & HR_FLAG_SENSOR_CONTACT_SUPPORTED:
+        sample.sensor_contact = bool(flags & HR_FLAG_SENSOR_CONTACT_DETECTED)
+    else:
+        sample.sensor_contact = None
+    if flags & HR_FLAG_RR_INTERVALS:
+        n_intervals = (len(data) - offset) // 2
+        rr_struct = RR_INTERVAL_STRUCTS.get(n_intervals)
+        if rr_struct is None:
+            rr_struct = RR_INTERVAL_STRUCTS[n_intervals] = struct.Struct(f'<{n_intervals}H')
+        # RR intervals in 1/1024 s
+        sample.rr_intervals = rr_struct.unpack_from(data, offset)
+    else:
+        sample.rr_intervals = ()
+    return sample
+
+
+def parse_cycling_power(data, sample: CyclingPowerSample = None):
+    if sample is None:
+        sample = CyclingPowerSample()
+    if len(data) < 4:
+        raise ValueError(f"truncated cycling power measurement: {len(data)} bytes")
+    flags = data[0] | (data[1] << 8)
+    values, names, _ = unpack_layout(CYCLING_POWER_LAYOUTS.get(flags), data, 2, sample)
+    sample.instantaneous_power = values[0]
+    for name, value in zip(names, values[1:]):
+        setattr(sample, name, value)
+    if flags & CP_FLAG_EXTREME_ANGLES:
+        # two 12-bit angles packed in 3 bytes
+        packed = sample.max_angle | (sample.min_angle << 16)
+        sample.max_angle = packed & 0x0FFF
+        sample.min_angle = packed >> 12
+    return sample
+
+
+def parse_csc(data, sample: CSCSample = None):
+    if sample is None:
+        sample = CSCSample()
+    if len(data) < 1:
+        raise ValueError("empty CSC measurement")
+    values, names, _ = unpack_layout(CSC_LAYOUTS.get(data[0]), data, 1, sample)
+    for name, value in zip(names, values):
+        setattr(sample, name, value)
+    return sample
@@ -0,0 +1,79 @@
+import random
+import sys
+import time
+
+import GattParsers
+
+# Example notification payloads following the GATT Specification Supplement layouts, with and without optional fields
+HEART_RATE_PACKETS = [
+    bytes.fromhex('0048'),
+    bytes.fromhex('1650a803'),
+    bytes.fromhex('16509c03a403'),
+    bytes.fromhex('19a0003400e803'),
+]
+CYCLING_POWER_PACKETS = [
+    bytes.fromhex('0000a000'),
+    bytes.fromhex('3000c8001c0300004d0a6b00e01f'),
+    bytes.fromhex('2000f5002a01b2c3'),
+    bytes.fromhex('ff0f2c016428000e0100009a1050008b1f2c01ceff8000f0ff5ae0101e00d2000c00'),
+]
+CSC_PACKETS = [
+    bytes.fromhex('03a4050000c21f6e00a81e'),
+    bytes.fromhex('01a4050000c21f'),
+    bytes.fromhex('026e00a81e'),
+]
+PARSERS = (
+    (GattParsers.parse_heart_rate, GattParsers.HeartRateSample, HEART_RATE_PACKETS),
+    (GattParsers.parse_cycling_power, GattParsers.CyclingPowerSample, CYCLING_POWER_PACKETS),
+    (GattParsers.parse_csc, GattParsers.CSCSample, CSC_PACKETS),
+)
+
+
+def parse_legacy_csc(data):
+    # the slicing decoder BLESensorProxy used before GattParsers
+    return (int.from_bytes(data[1:5], 'little'), int.from_bytes(data[5:7], 'little'),
+            int.from_bytes(data[7:9], 'little'), int.from_bytes(data[9:11], 'little'))
+
+
+def benchmark_parsers(n_iterations=200000):
+    for parse, sample_class, packets in PARSERS:
+        sample = sample_class()
+        data = bytearray(packets[-1])
+        t0 = time.perf_counter()
+        for _ in range(n_iterations):
+            parse(data, sample)
+        elapsed = time.perf_counter() - t0
+        print(f"{parse.__name__:>20}: {elapsed / n_iterations * 1e9:8.0f} ns/packet")
+    data = bytearray(CSC_PACKETS[0])
+    t0 = time.perf_counter()
+    for _ in range(n_iterations):
+        parse_legacy_csc(data)
+    elapsed = time.perf_counter() - t0
+    print(f"{'legacy csc slicing':>20}: {elapsed / n_iterations * 1e9:8.0f} ns/packet")
+
+
+def fuzz_parsers(n_iterations=100000, seed=0):
+    # Truncated, bit-flipped and extended versions of the example packets may only ever raise ValueError
+    rng = random.Random(seed)
+    for parse, sample_class, packets in PARSERS:
+        sample = sample_class()
+        for _ in range(n_iterations):
+            data = bytearray(rng.choice(packets))
+            mutation = rng.randrange(3)
+            if mutation == 0:
+                data = data[:rng.randrange(len(data) + 1)]
+            elif mutation == 1 and data:
+                data[rng.randrange(len(data))] ^= 1 << rng.randrange(8)
+            else:
+                data += bytes(rng.randrange(256) for _ in range(rng.randrange(8)))
+            try:
+                parse(data, sample)
+            except ValueError:
+                pass
+    print(f"fuzzed {n_iterations} packets per parser without unexpected errors")
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    benchmark_parsers(n)
+    fuzz_parsers(n // 2)
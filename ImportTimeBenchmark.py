@@ -0,0 +1,68 @@
+import importlib.util
+import subprocess
+import sys
+
+# Cold start budget per entry point: the cumulative import time, in a fresh interpreter, of the module the process
+# starts from. Heavy dependencies are imported when they are first used instead (fit_tool when a recording starts,
+# bleak when a BLE sensor starts, openant when an ANT+ sensor starts), none of them may be loaded by the import.
+# FitReader and FitBatch read FIT files without fit_tool, FitBatch loads it for the fit export format only.
+IMPORT_BUDGETS_MS = {
+    "Recorder": 200,
+    "RecorderDaemon": 200,
+    "SessionManager": 200,
+    "TelemetryServer": 200,
+    "SensorConfig": 80,
+    "Overlay": 300,
+    "FitReader": 80,
+    "FitBatch": 150,
+}
+DEFERRED_PACKAGES = ("fit_tool", "bleak", "openant", "numpy", "pyarrow")
+# entry points that need an optional dependency to be imported at all
+REQUIRED_PACKAGES = {
+    "Overlay": "PyQt5",
+}
+
+
+def measure_import(module_name):
+    # Returns (cumulative import time in ms, {module: cumulative ms}) from `python -X importtime`
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module_name}"],
+                            capture_output=True, text=True, check=True)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            imports[name.strip()] = int(cumulative) / 1000
+    return imports[module_name], imports
+
+
+def benchmark_imports(runs=5):
+    failures = []
+    for module_name, budget_ms in IMPORT_BUDGETS_MS.items():
+        required = REQUIRED_PACKAGES.get(module_name)
+        if required is not None and importlib.util.find_spec(required) is None:
+            print(f"{module_name}: skipped, {required} is not installed")
+            continue
+        measurements = [measure_import(module_name) for _ in range(runs)]
+        import_ms, imports = min(measurements, key=lambda measurement: measurement[0])
+        loaded = sorted({name.split(".")[0] for name in imports} & set(DEFERRED_PACKAGES))
+        status = "ok" if import_ms <= budget_ms and not loaded else "FAILED"
+        print(f"{module_name}: {import_ms:.1f}ms (budget {budget_ms}ms, best of {runs}) {status}")
+        if import_ms > budget_ms:
+            failures.append(f"{module_name} takes {import_ms:.1f}ms to import, budget is {budget_ms}ms")
+        if loaded:
+            print(f"  loads {', '.join(loaded)}")
+            failures.append(f"{module_name} imports {', '.join(loaded)} at startup")
+        slowest = sorted(((ms, name) for name, ms in imports.items() if "." not in name and
+                          name != module_name), reverse=True)[:3]
+        print(f"  slowest imports: {', '.join(f'{name} {ms:.1f}ms' for ms, name in slowest)}")
+    return failures
+
+
+if __name__ == '__main__':
+    # ImportTimeBenchmark.py [runs], exits with 1 when an entry point is over its budget
+    failures = benchmark_imports(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
+    for failure in failures:
+        print(failure)
+    sys.exit(1 if failures else 0)
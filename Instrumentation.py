@@ -0,0 +1,165 @@
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import threading
+import time
+from bisect import bisect_left
+
+DEFAULT_LOG_LEVEL = logging.INFO
+LOG_FORMAT = "%(asctime)s %(levelname)s %(message)s"
+DEFAULT_METRICS_INTERVAL_S = 60
+
+# latency histogram bucket upper bounds in seconds: 1 us to ~4 s in powers of two, plus an overflow bucket
+LATENCY_BUCKETS_S = tuple(1e-6 * 2 ** i for i in range(23))
+
+
+class Counter:
+    # Updated without locking: every counter is owned by one sensor or writer and only ever bumped from its thread
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def add(self, n=1):
+        self.value += n
+
+    def get_stats(self):
+        return self.value
+
+
+class Histogram:
+    # Fixed buckets, so recording a value costs one bisect and a few additions and never allocates
+    __slots__ = ('bounds', 'counts', 'count', 'total', 'max')
+
+    def __init__(self, bounds=LATENCY_BUCKETS_S):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def get_quantile(self, quantile):
+        # upper bound of the bucket holding the quantile, never more than the largest value seen
+        rank = quantile * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.bounds[index], self.max) if index < len(self.bounds) else self.max
+        return 0.0
+
+    def get_stats(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.get_quantile(0.5),
+            "p99": self.get_quantile(0.99),
+            "max": self.max,
+        }
+
+
+class MetricsRegistry:
+    # Counters and histograms by (metric name, label), e.g. ("sensor_notifications", "BLE C9:8B:...")
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def get_metric(self, metric_type, name, label):
+        key = (name, label)
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = metric_type()
+                self.metrics[key] = metric
+        if not isinstance(metric, metric_type):
+            raise ValueError(f"metric {name} is a {type(metric).__name__}, not a {metric_type.__name__}")
+        return metric
+
+    def counter(self, name, label="") -> Counter:
+        return self.get_metric(Counter, name, label)
+
+    def histogram(self, name, label="") -> Histogram:
+        return self.get_metric(Histogram, name, label)
+
+    def get_stats(self):
+        # {name: {label: value or histogram stats}}
+        with self.lock:
+            metrics = list(self.metrics.items())
+        stats = {}
+        for (name, label), metric in sorted(metrics, key=lambda item: item[0]):
+            stats.setdefault(name, {})[label] = metric.get_stats()
+        return stats
+
+
+METRICS = MetricsRegistry()
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    # QueueHandler formats every record before queueing it; leaving that to the listener thread keeps the sensor
+    # callbacks down to a level check and a queue put. Log arguments must therefore not be mutated after logging.
+    def prepare(self, record):
+        return record
+
+
+class MetricsReporter:
+    # Logs the registry every `interval` seconds from a daemon thread
+    def __init__(self, registry=METRICS, interval=DEFAULT_METRICS_INTERVAL_S):
+        self.registry = registry
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="MetricsReporter", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        log = logging.getLogger(__name__)
+        while not self.stopped.wait(self.interval):
+            log.info("Metrics| %s", json.dumps(self.registry.get_stats()))
+
+    def stop(self):
+        self.stopped.set()
+
+
+def setup_logging(level=DEFAULT_LOG_LEVEL, handler=None):
+    # Routes all logging through a queue to a listener thread that formats and writes the records, stderr by default.
+    # Returns the listener; stopping it flushes the records still queued.
+    if handler is None:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+if __name__ == '__main__':
+    # cost of a suppressed debug log, a queued info log and a histogram sample on the calling thread
+    setup_logging(logging.INFO, logging.NullHandler())
+    benchmark_log = logging.getLogger("benchmark")
+    histogram = METRICS.histogram("benchmark")
+    devnull = open(os.devnull, "w")
+    n = 100000
+    for name, function in (("debug (off)", lambda i: benchmark_log.debug("value: %s", i)),
+                           ("info (queued)", lambda i: benchmark_log.info("value: %s", i)),
+                           ("print", lambda i: print(f"value: {i}", file=devnull)),
+                           ("histogram", lambda i: histogram.add(i * 1e-9))):
+        t0 = time.perf_counter()
+        for i in range(n):
+            function(i)
+        print(f"{name}: {(time.perf_counter() - t0) / n * 1e9:.0f}ns")
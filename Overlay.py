@@ -1,19 +1,32 @@
 import sys
 import time
-import datetime
-import asyncio
 from PyQt5 import QtGui, QtCore, uic
 from PyQt5 import QtWidgets
 from PyQt5.QtWidgets import QMainWindow, QApplication
 from threading import Timer
 
-import ANTSensorProxy
-import BLESensorProxy
-import FitWriter
+import DataPoints
+import Instrumentation
+import Recorder
+import SensorConfig
+import SensorDataBus
+from AbstractSensorProxy import LAST_VALUE_ATTRIBUTES
+
+DEFAULT_FRAME_RATE = 4
+
+TIME_TEMPLATE = " Time: {:02d}:{:02d}:{:02d}"
+LABEL_TEMPLATES = {
+    DataPoints.DATA_POINT_HEART_RATE: "   HR: {}BPM",
+    DataPoints.DATA_POINT_POWER: "Power: {}W",
+    DataPoints.DATA_POINT_CADENCE: "  Cad: {:.0f}RPM",
+    DataPoints.DATA_POINT_SPEED: "Speed: {:.2f}km/h",
+    DataPoints.DATA_POINT_DISTANCE: " Dist: {:.2f}km",
+}
 
 
 class TrainerOverlayWindow(QMainWindow):
-    def __init__(self, show_hr=True, show_power=True, show_cadence=True, show_speed=True, show_distance=True):
+    def __init__(self, show_hr=True, show_power=True, show_cadence=True, show_speed=True, show_distance=True,
+                 config=SensorConfig.DEFAULT_SENSOR_CONFIG, frame_rate=DEFAULT_FRAME_RATE):
         QMainWindow.__init__(self)
         self.setWindowTitle("JBP Trainer")
         self.setWindowFlags(
@@ -81,84 +94,55 @@ class TrainerOverlayWindow(QMainWindow):
 
         self.recording = False
         self.start_time = 0
-        self.update_gui_timer = None
-        self.write_data_timer = None
-
-        self.hr_sensor = None
-        self.power_sensor = None
-        self.cadence_sensor = None
-        self.speed_sensor = None
-        self.distance_sensor = None
+        self.subscription = None
+        self.label_texts = {}
+        # Labels are only touched from the GUI thread: a QTimer redraws at most frame_rate times a second, coalescing
+        # all sensor updates received in between
+        self.frame_timer = QtCore.QTimer(self)
+        self.frame_timer.setInterval(round(1000 / frame_rate))
+        self.frame_timer.timeout.connect(self.update_frame)
+
+        shown_channels = [channel for channel, shown in (
+            ("heart_rate", show_hr),
+            ("power", show_power),
+            ("cadence", show_cadence),
+            ("speed", show_speed),
+            ("distance", show_distance),
+        ) if shown]
+        self.recorder = Recorder.Recorder()
+        self.recorder.configure(config, channels=shown_channels)
+        self.label_sources = {}
+        for label_name, channel in (("label_hr", "heart_rate"), ("label_power", "power"), ("label_cad", "cadence"),
+                                    ("label_speed", "speed"), ("label_dist", "distance")):
+            sensor = getattr(self.recorder, Recorder.CHANNEL_SENSOR_ATTRIBUTES[channel])
+            if sensor is not None:
+                data_point = SensorConfig.CHANNEL_DATA_POINTS[channel]
+                self.label_sources[data_point] = (getattr(self, label_name), LABEL_TEMPLATES[data_point], sensor,
+                                                  LAST_VALUE_ATTRIBUTES[data_point])
         connect_sensors_timer = Timer(0.1, self.connect_sensors)
         connect_sensors_timer.start()
 
         print("end constructor")
 
-    def update_gui_loop(self):
-        while self.recording:
-            self.label_time.setText(" Time: {}".format(self.get_elapsed_time()))
-            if self.show_hr:
-                self.label_hr.setText("   HR: {}".format(self.get_current_hr()))
-            if self.show_power:
-                self.label_power.setText("Power: {}".format(self.get_current_power()))
-            if self.show_cadence:
-                self.label_cad.setText("  Cad: {}".format(self.get_current_cadence()))
-            if self.show_speed:
-                self.label_speed.setText("Speed: {}".format(self.get_current_speed()))
-            if self.show_distance:
-                self.label_dist.setText(" Dist: {}".format(self.get_distance_travelled()))
-            time.sleep(0.5)
+    def update_frame(self):
+        dropped = self.subscription.dropped
+        updated = {sample[SensorDataBus.SAMPLE_DATA_POINT] for sample in self.subscription.poll()}
+        if self.subscription.dropped != dropped:
+            updated = self.label_sources.keys()
+        self.set_label_text(self.label_time, TIME_TEMPLATE.format(*self.get_elapsed_time()))
+        for data_point in updated:
+            if data_point in self.label_sources:
+                label, template, sensor, attribute = self.label_sources[data_point]
+                self.set_label_text(label, template.format(getattr(sensor, attribute)))
+
+    def set_label_text(self, label, text):
+        # only repaint labels whose text changed
+        if self.label_texts.get(label) != text:
+            self.label_texts[label] = text
+            label.setText(text)
 
     def connect_sensors(self):
-        garmin_hr_belt_ble = BLESensorProxy.BLESensorProxy("F4:86:48:60:E7:0D", {
-            BLESensorProxy.GATT_CHAR_UUID_HEART_RATE: '00002a37-0000-1000-8000-00805f9b34fb'
-            })
-        tacx_flow_ble = BLESensorProxy.BLESensorProxy("C4:0D:01:89:C9:9F", {
-            # SensorProxy.GATT_CHAR_UUID_CSC: '00002a5b-0000-1000-8000-00805f9b34fb',
-            BLESensorProxy.GATT_CHAR_UUID_POWER: '00002a63-0000-1000-8000-00805f9b34fb'
-            })
-        tacx_flow_csc_ant = ANTSensorProxy.ANTSensorProxy(ANTSensorProxy.DEVICE_TYPE_CSC, 48757, connection_retries=10)
-        if self.show_hr:
-            self.hr_sensor = garmin_hr_belt_ble
-        if self.show_power:
-            self.power_sensor = tacx_flow_ble
-        if self.show_cadence:
-            self.cadence_sensor = tacx_flow_csc_ant
-        if self.show_speed:
-            self.speed_sensor = tacx_flow_csc_ant
-        if self.show_distance:
-            self.distance_sensor = tacx_flow_csc_ant
-        ant_sensors = [tacx_flow_csc_ant]
-        ble_sensors = [garmin_hr_belt_ble, tacx_flow_ble]
-        print("1!!!!!!!!")
-        for ant_sensor in ant_sensors:
-            ant_sensor.start()
-        print("2!!!!!!!!")
-        asyncio.run(self.start_ble_sensor_tasks(ble_sensors))
-        print("3!!!!!!!!")
-
-    def write_data(self):
-        fit_writer = FitWriter.FitWriter()
-        output_file = f"{datetime.datetime.now().strftime('%Y-%m-%dT%H_%M_%S')}.fit"
-        fit_writer.start_writing(output_file)
-        t0 = time.time()
-        while self.recording:
-            data_map = {}
-            # data_map[FitWriter.DATA_POINT_TIME] = time.time()
-            data_map[FitWriter.DATA_POINT_TIME] = datetime.datetime.now().timestamp()
-            if self.hr_sensor is not None:
-                data_map[FitWriter.DATA_POINT_HEART_RATE] = self.hr_sensor.last_hr_value
-            if self.power_sensor is not None:
-                data_map[FitWriter.DATA_POINT_POWER] = self.power_sensor.last_power_value
-            if self.cadence_sensor is not None:
-                data_map[FitWriter.DATA_POINT_CADENCE] = self.cadence_sensor.last_cadence_value
-            if self.speed_sensor is not None:
-                data_map[FitWriter.DATA_POINT_SPEED] = self.speed_sensor.last_speed_value
-            if self.distance_sensor is not None:
-                data_map[FitWriter.DATA_POINT_DISTANCE] = self.distance_sensor.last_total_distance_value
-            fit_writer.add_record(data_map)
-            time.sleep(1 - ((time.time()-t0) % 1))
-        fit_writer.stop_writing()
+        self.recorder.connect_sensors()
 
     def mousePressEvent(self, event):
         if self.recording:
@@ -172,59 +156,32 @@ class TrainerOverlayWindow(QMainWindow):
         self.recording = True
         self.start_time = time.time()
         self.label_ctrl.setStyleSheet("background-color: #FF0000;")
-        self.update_gui_timer = Timer(0.1, self.update_gui_loop)
-        self.update_gui_timer.start()
-        self.write_data_timer = Timer(0.1, self.write_data)
-        self.write_data_timer.start()
+        self.subscription = self.recorder.data_bus.subscribe(self.label_sources.keys())
+        self.frame_timer.start()
+        self.recorder.start_recording()
 
     def stop_recording(self):
         self.recording = False
+        self.recorder.stop_recording()
+        self.frame_timer.stop()
+        self.subscription.close()
         self.label_ctrl.setStyleSheet("background-color: #00FF00;")
 
     def save_and_quit(self):
-        self.hr_sensor.stop()
-        self.power_sensor.stop()
-        self.cadence_sensor.stop()
-        self.speed_sensor.stop()
-        self.distance_sensor.stop()
+        self.recorder.stop()
         QtWidgets.qApp.quit()
 
-    async def start_ble_sensor_tasks(self, sensors):
-        sensor_tasks = []
-        for sensor in sensors:
-            sensor_tasks.append(asyncio.create_task(sensor.start()))
-            print(f"added task for sensor {sensor.sensor_address}")
-        for sensor_task in sensor_tasks:
-            await sensor_task
-            print(f"ended task for a sensor")
-
     def get_elapsed_time(self):
         if self.start_time == 0:
-            return "00:00:00"
-        time_elapsed = time.time() - self.start_time
-        ts = int(time_elapsed % 60)
-        tm = int(time_elapsed / 60)
-        th = int(time_elapsed / 3600)
-        return f"{th:02d}:{tm:02d}:{ts:02d}"
-
-    def get_current_hr(self):
-        return f"{self.hr_sensor.last_hr_value}BPM"
-
-    def get_current_power(self):
-        return f"{self.power_sensor.last_power_value}W"
-
-    def get_current_cadence(self):
-        return f"{round(self.cadence_sensor.last_cadence_value)}RPM"
-
-    def get_current_speed(self):
-        return f"{self.speed_sensor.last_speed_value:.{2}f}km/h"
-
-    def get_distance_travelled(self):
-        return f"{self.distance_sensor.last_total_distance_value:.{2}f}km"
+            return 0, 0, 0
+        time_elapsed = int(time.time() - self.start_time)
+        return time_elapsed // 3600, time_elapsed // 60 % 60, time_elapsed % 60
 
 
 if __name__ == '__main__':
+    log_listener = Instrumentation.setup_logging()
     app = QApplication(sys.argv)
     overlay_window = TrainerOverlayWindow(show_cadence=False, show_speed=False, show_distance=False)
     overlay_window.show()
-    app.exec_()
\ No newline at end of file
+    app.exec_()
+    log_listener.stop()
@@ -0,0 +1,219 @@
+import asyncio
+import datetime
+import logging
+import os
+import struct
+import threading
+import time
+
+import DataPoints
+import SampleBuffer
+import SampleScheduler
+import SensorConfig
+import SummaryAccumulator
+import SensorDataBus
+import SensorRuntime
+
+LOG = logging.getLogger(__name__)
+
+CHANNEL_SENSOR_ATTRIBUTES = {
+    "heart_rate": "hr_sensor",
+    "power": "power_sensor",
+    "cadence": "cadence_sensor",
+    "speed": "speed_sensor",
+    "distance": "distance_sensor",
+}
+
+
+class Recorder:
+    # Sensor setup and FIT recording without any GUI, shared by the overlay and the headless daemon
+    def __init__(self, output_dir="."):
+        self.output_dir = output_dir
+        self.data_bus = SensorDataBus.SensorDataBus()
+        self.sensor_runtime = SensorRuntime.SensorRuntime()
+        self.ant_node_manager = None
+        self.sensors = {}
+
+        self.hr_sensor = None
+        self.power_sensor = None
+        self.cadence_sensor = None
+        self.speed_sensor = None
+        self.distance_sensor = None
+        # SourceArbiter per channel with several candidate sensors
+        self.arbiters = {}
+
+        self.recording = False
+        self.start_time = 0
+        self.output_file = None
+        self.samples = None
+        self.lap_requested = False
+        self.write_data_thread = None
+        self.recording_rate = SampleScheduler.DEFAULT_RECORDING_RATE
+        self.missed_ticks = SampleScheduler.MISSED_TICKS_FILL
+        self.hr_zones = SummaryAccumulator.DEFAULT_HR_ZONE_BOUNDARIES
+        self.power_zones = SummaryAccumulator.DEFAULT_POWER_ZONE_BOUNDARIES
+        self.scheduler = None
+        self.trainer_controller = None
+        self.journal = None
+        self.device_cache = None
+
+    def configure(self, config, channels=None):
+        # channels limits which of the configured channels get recorded
+        SensorConfig.validate_sensor_config(config)
+        if SensorConfig.uses_discovery(config):
+            import DeviceDiscovery
+            # sensors without an address or device id get one from the device cache, or from a scan when not cached
+            self.device_cache, config = DeviceDiscovery.setup_device_cache(config)
+        self.output_dir = config.get("output_dir", self.output_dir)
+        self.recording_rate = config.get("recording_rate", self.recording_rate)
+        self.missed_ticks = config.get("missed_ticks", self.missed_ticks)
+        self.hr_zones = tuple(config.get("hr_zones", self.hr_zones))
+        self.power_zones = tuple(config.get("power_zones", self.power_zones))
+        for sensor_config in config["sensors"]:
+            if sensor_config["type"] == SensorConfig.SENSOR_TYPE_ANT and self.ant_node_manager is None:
+                import ANTNodeManager
+                self.ant_node_manager = ANTNodeManager.ANTNodeManager()
+            sensor = SensorConfig.create_sensor(sensor_config, self.data_bus, self.ant_node_manager)
+            self.sensors[sensor_config["name"]] = sensor
+            self.sensor_runtime.add_sensor(sensor, sensor_config.get("connect_timeout"))
+        if "journal" in config:
+            # every raw packet of every sensor, see CaptureJournal
+            import CaptureJournal
+            self.journal = CaptureJournal.CaptureJournal(config["journal"], config.get("journal_compression"))
+            for sensor in self.sensors.values():
+                sensor.set_journal(self.journal)
+        if self.device_cache is not None:
+            for sensor in self.sensors.values():
+                sensor.set_device_cache(self.device_cache)
+        for channel, sensor_names in config.get("channels", {}).items():
+            if channels is None or channel in channels:
+                setattr(self, CHANNEL_SENSOR_ATTRIBUTES[channel],
+                        self.get_channel_source(channel, sensor_names, config.get("arbitration", {})))
+        if "trainer" in config:
+            import TrainerController
+            import Workout
+            self.trainer_controller = TrainerController.TrainerController(
+                self.sensors[config["trainer"]], self.data_bus, ftp=config.get("ftp", Workout.DEFAULT_FTP),
+                user_weight_kg=config.get("user_weight_kg", TrainerController.DEFAULT_USER_WEIGHT_KG),
+                bike_weight_kg=config.get("bike_weight_kg", TrainerController.DEFAULT_BIKE_WEIGHT_KG))
+
+    def get_channel_source(self, channel, sensor_names, arbitration):
+        # The channel's sensor, or a SourceArbiter over its candidate sensors
+        if isinstance(sensor_names, str):
+            return self.sensors[sensor_names]
+        import SourceArbiter
+        arbiter = SourceArbiter.SourceArbiter(SensorConfig.CHANNEL_DATA_POINTS[channel],
+                                              [self.sensors[name] for name in sensor_names], self.data_bus,
+                                              arbitration.get(channel, SourceArbiter.ARBITRATION_SWITCH),
+                                              name=f"arbiter {channel}")
+        self.arbiters[channel] = arbiter
+        self.sensor_runtime.add_sensor(arbiter)
+        return arbiter
+
+    def connect_sensors(self):
+        if self.trainer_controller is not None:
+            self.trainer_controller.start()
+        asyncio.run(self.sensor_runtime.run())
+
+    async def run_sensors(self):
+        if self.trainer_controller is not None:
+            self.trainer_controller.start()
+        await self.sensor_runtime.run()
+
+    def start_recording(self):
+        if self.recording:
+            return
+        self.wait_for_recording()
+        self.recording = True
+        self.start_time = time.time()
+        self.output_file = os.path.join(self.output_dir, f"{datetime.datetime.now().strftime('%Y-%m-%dT%H_%M_%S')}.fit")
+        self.write_data_thread = threading.Thread(target=self.write_data, name="Recorder")
+        self.write_data_thread.start()
+
+    def stop_recording(self):
+        self.recording = False
+
+    def wait_for_recording(self):
+        if self.write_data_thread is not None:
+            self.write_data_thread.join()
+        self.write_data_thread = None
+
+    def lap(self):
+        # handled on the recording thread so the FIT writer is only ever used from one thread
+        if self.recording:
+            self.lap_requested = True
+
+    def stop(self):
+        self.stop_recording()
+        self.wait_for_recording()
+        if self.trainer_controller is not None:
+            self.trainer_controller.stop()
+        self.sensor_runtime.stop()
+        if self.ant_node_manager is not None:
+            self.ant_node_manager.stop()
+        if self.journal is not None:
+            self.journal.close()
+        if self.device_cache is not None:
+            self.device_cache.save()
+
+    def write_data(self):
+        # fit_tool is only loaded once the first recording starts
+        import FitWriter
+        fit_writer = FitWriter.FitWriter(streaming=True, hr_zones=self.hr_zones, power_zones=self.power_zones)
+        fit_writer.start_writing(self.output_file)
+        sample_sources = [
+            (DataPoints.DATA_POINT_HEART_RATE, self.hr_sensor, 'last_hr_value'),
+            (DataPoints.DATA_POINT_POWER, self.power_sensor, 'last_power_value'),
+            (DataPoints.DATA_POINT_CADENCE, self.cadence_sensor, 'last_cadence_value'),
+            (DataPoints.DATA_POINT_SPEED, self.speed_sensor, 'last_speed_value'),
+            (DataPoints.DATA_POINT_DISTANCE, self.distance_sensor, 'last_total_distance_value'),
+        ]
+        sample_sources = [source for source in sample_sources if source[1] is not None]
+        self.samples = SampleBuffer.SampleBuffer([DataPoints.DATA_POINT_TIME] +
+                                                 [source[0] for source in sample_sources])
+        self.scheduler = SampleScheduler.SampleScheduler(self.recording_rate, self.missed_ticks)
+        subscription = self.data_bus.subscribe() if self.scheduler.smart else None
+        self.scheduler.start()
+        try:
+            while self.recording:
+                if self.lap_requested:
+                    self.lap_requested = False
+                    fit_writer.add_lap()
+                start = len(self.samples)
+                timestamps = self.scheduler.wait(subscription)
+                for gap_start, gap_end in self.scheduler.pop_gaps():
+                    fit_writer.add_timer_gap(round(gap_start * 1000), round(gap_end * 1000))
+                values = [getattr(sensor, attribute) for _, sensor, attribute in sample_sources]
+                try:
+                    for timestamp in timestamps:
+                        # missed ticks are filled with the values read for the tick that is due now
+                        self.samples.append(timestamp, *values)
+                    fit_writer.add_samples(self.samples, start)
+                except (TypeError, ValueError, OverflowError, struct.error) as e:
+                    # one bad value costs its tick, not the recording
+                    LOG.warning("Recorder| dropping samples %s: %s", values, e)
+        finally:
+            # the FIT file is finalized however the recording ends
+            if subscription is not None:
+                subscription.close()
+            fit_writer.stop_writing()
+        LOG.info("Recorder| scheduler stats: %s", self.scheduler.get_stats())
+
+    def get_channel_sensors(self):
+        # {data point: sensor} of the configured channels
+        return {data_point: getattr(self, CHANNEL_SENSOR_ATTRIBUTES[channel])
+                for channel, data_point in SensorConfig.CHANNEL_DATA_POINTS.items()
+                if getattr(self, CHANNEL_SENSOR_ATTRIBUTES[channel]) is not None}
+
+    def get_status(self):
+        return {
+            "recording": self.recording,
+            "output_file": self.output_file if self.recording else None,
+            "elapsed": time.time() - self.start_time if self.recording else 0,
+            "samples": len(self.samples) if self.samples is not None else 0,
+            "scheduler": self.scheduler.get_stats() if self.scheduler is not None else None,
+            "sensors": {name: sensor.connected for name, sensor in self.sensors.items()},
+            "trainer": self.trainer_controller.get_status() if self.trainer_controller is not None else None,
+            "journal": self.journal.get_stats() if self.journal is not None else None,
+            "arbiters": {channel: arbiter.get_stats() for channel, arbiter in self.arbiters.items()},
+        }
@@ -0,0 +1,179 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+
+import Instrumentation
+import Recorder
+import SensorConfig
+import TelemetryServer
+
+DEFAULT_SOCKET_PATH = "/tmp/fittrainer.sock"
+
+LOG = logging.getLogger(__name__)
+
+COMMANDS = ("start", "stop", "lap", "status", "metrics", "quit", "erg", "grade", "resistance", "workout")
+TRAINER_COMMANDS = ("erg", "grade", "resistance", "workout")
+
+
+class RecorderDaemon:
+    # Headless recorder controlled with one-line commands (start, stop, lap, status, metrics, quit) over a local Unix
+    # socket, or over a localhost TCP port where Unix sockets are not available. Every command is answered with one
+    # JSON line, "metrics" with the counters and latency histograms of Instrumentation.METRICS.
+    # With a trainer configured, "erg WATTS", "grade PERCENT", "resistance PERCENT", "workout FILE" and
+    # "workout stop" control it.
+    def __init__(self, config, socket_path=DEFAULT_SOCKET_PATH, port=None, telemetry_port=None,
+                 telemetry_host=TelemetryServer.DEFAULT_TELEMETRY_HOST, telemetry_multicast=None):
+        self.recorder = Recorder.Recorder()
+        self.recorder.configure(config)
+        self.socket_path = socket_path
+        self.port = port
+        # live channel values over WebSocket on telemetry_port and/or UDP multicast to telemetry_multicast,
+        # a (group, port) tuple
+        self.telemetry = None
+        if telemetry_port is not None or telemetry_multicast is not None:
+            self.telemetry = TelemetryServer.TelemetryServer(self.recorder.data_bus,
+                                                             self.recorder.get_channel_sensors())
+        self.telemetry_port = telemetry_port
+        self.telemetry_host = telemetry_host
+        self.telemetry_multicast = telemetry_multicast
+        self.server = None
+        self.quit_event = None
+        self.clients = set()
+
+    async def run(self):
+        self.quit_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.quit_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass
+        if self.port is not None:
+            self.server = await asyncio.start_server(self.handle_client, "127.0.0.1", self.port)
+            LOG.info("Recorder daemon| listening on 127.0.0.1:%d", self.port)
+        else:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.server = await asyncio.start_unix_server(self.handle_client, self.socket_path)
+            LOG.info("Recorder daemon| listening on %s", self.socket_path)
+        telemetry_task = None
+        if self.telemetry is not None:
+            if self.telemetry_port is not None:
+                await self.telemetry.start_websocket(self.telemetry_host, self.telemetry_port)
+            if self.telemetry_multicast is not None:
+                await self.telemetry.start_multicast(*self.telemetry_multicast)
+            telemetry_task = asyncio.create_task(self.telemetry.run())
+        sensors_task = asyncio.create_task(self.recorder.run_sensors())
+        await self.quit_event.wait()
+        if telemetry_task is not None:
+            self.telemetry.stop()
+            await telemetry_task
+        self.server.close()
+        for writer in list(self.clients):
+            writer.close()
+        await self.server.wait_closed()
+        await loop.run_in_executor(None, self.recorder.stop)
+        await sensors_task
+        if self.port is None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    async def handle_client(self, reader, writer):
+        self.clients.add(writer)
+        try:
+            while not reader.at_eof():
+                line = await reader.readline()
+                if not line:
+                    break
+                command, _, argument = line.decode().strip().partition(" ")
+                response = await self.handle_command(command.lower(), argument.strip())
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            writer.close()
+
+    async def handle_command(self, command, argument=""):
+        if command not in COMMANDS:
+            return {"error": f"unknown command {command!r}, expected one of {', '.join(COMMANDS)}"}
+        if command in TRAINER_COMMANDS:
+            try:
+                self.handle_trainer_command(command, argument)
+            except (ValueError, OSError) as e:
+                return {"error": f"{command} {argument}: {e}"}
+        elif command == "start":
+            self.recorder.start_recording()
+        elif command == "stop":
+            self.recorder.stop_recording()
+            await asyncio.get_running_loop().run_in_executor(None, self.recorder.wait_for_recording)
+        elif command == "lap":
+            self.recorder.lap()
+        elif command == "metrics":
+            return Instrumentation.METRICS.get_stats()
+        elif command == "quit":
+            self.quit_event.set()
+        return self.recorder.get_status()
+
+    def handle_trainer_command(self, command, argument):
+        trainer_controller = self.recorder.trainer_controller
+        if trainer_controller is None:
+            raise ValueError("no trainer configured")
+        if command == "erg":
+            trainer_controller.set_target_power(float(argument))
+        elif command == "grade":
+            trainer_controller.set_grade(float(argument))
+        elif command == "resistance":
+            trainer_controller.set_resistance(float(argument))
+        elif argument.lower() == "stop":
+            trainer_controller.stop_workout()
+        else:
+            import Workout
+            trainer_controller.start_workout(Workout.load_workout(argument, trainer_controller.ftp))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless FIT recorder")
+    parser.add_argument("--config", help="sensor config JSON file, defaults to the built-in sensor setup")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Unix socket path for control commands")
+    parser.add_argument("--port", type=int, help="localhost TCP port for control commands instead of a Unix socket")
+    parser.add_argument("--start", action="store_true", help="start recording right away")
+    parser.add_argument("--telemetry-port", type=int, help="serve live telemetry over WebSocket on this port")
+    parser.add_argument("--telemetry-host", default=TelemetryServer.DEFAULT_TELEMETRY_HOST,
+                        help="address the telemetry WebSocket listens on, 0.0.0.0 for other machines")
+    parser.add_argument("--telemetry-multicast", metavar="GROUP:PORT",
+                        help="send live telemetry to a UDP multicast group")
+    parser.add_argument("--log-level", default="INFO", choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+                        help="DEBUG also logs every sensor notification and FIT record")
+    parser.add_argument("--metrics-interval", type=float, default=0,
+                        help="log sensor and writer metrics every this many seconds, 0 to only report them on the "
+                             "metrics command")
+    args = parser.parse_args()
+    log_listener = Instrumentation.setup_logging(args.log_level)
+    metrics_reporter = None
+    if args.metrics_interval > 0:
+        metrics_reporter = Instrumentation.MetricsReporter(interval=args.metrics_interval)
+        metrics_reporter.start()
+    telemetry_multicast = None
+    if args.telemetry_multicast:
+        group, _, multicast_port = args.telemetry_multicast.rpartition(":")
+        telemetry_multicast = (group, int(multicast_port))
+
+    config = SensorConfig.load_sensor_config(args.config) if args.config else SensorConfig.DEFAULT_SENSOR_CONFIG
+    daemon = RecorderDaemon(config, socket_path=args.socket, port=args.port, telemetry_port=args.telemetry_port,
+                            telemetry_host=args.telemetry_host, telemetry_multicast=telemetry_multicast)
+    if args.start:
+        daemon.recorder.start_recording()
+    try:
+        asyncio.run(daemon.run())
+    finally:
+        if metrics_reporter is not None:
+            metrics_reporter.stop()
+        log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+import asyncio
+import json
+import logging
+import random
+import struct
+import time
+
+from AbstractSensorProxy import AbstractSensorProxy
+from ANTSensorProxy import ANTDataHandlers
+from BLESensorProxy import BLENotificationHandlers
+from CSCEngine import (
+    CSCEngine,
+    ANT_WHEEL_FORMAT,
+    ANT_CRANK_FORMAT,
+    WHEEL_CIRCUMFERENCE_M_700CX25,
+)
+
+REPLAY_BLE_HEART_RATE = "ble_heart_rate"
+REPLAY_BLE_POWER = "ble_power"
+REPLAY_BLE_CSC = "ble_csc"
+REPLAY_ANT_PAGE = "ant_page"
+
+REPLAY_AS_FAST_AS_POSSIBLE = 0
+# how many events are replayed between yields to the loop when replaying as fast as possible
+FAST_REPLAY_BATCH = 64
+
+# cadence event time step of synthetic ANT+ pages in 1/1024 s: their first byte is then 0x00, 0x20, ... 0xE0, page
+# numbers openant decodes as speed & cadence data and none of the common pages (0x50-0x52)
+ANT_PAGE_TIME_STEP = 32
+
+LOG = logging.getLogger(__name__)
+
+EVENT_TIME = 0
+EVENT_KIND = 1
+EVENT_DATA = 2
+
+
+def load_replay(file_name):
+    # One JSON object per line: {"t": seconds since the start, "kind": one of the REPLAY_* kinds, "data": hex payload}
+    events = []
+    with open(file_name) as replay_file:
+        for line in replay_file:
+            if line.strip():
+                event = json.loads(line)
+                events.append((event["t"], event["kind"], bytes.fromhex(event["data"])))
+    return events
+
+
+def save_replay(file_name, events):
+    with open(file_name, "w") as replay_file:
+        for event_time, kind, data in events:
+            replay_file.write(json.dumps({"t": round(event_time, 6), "kind": kind, "data": bytes(data).hex()}) + "\n")
+
+
+class ReplayChannel:
+    # Stands in for an openant channel: the device profile configures it and the replay feeds broadcast pages into it
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.on_broadcast_data = None
+        self.on_burst_data = None
+        self.on_acknowledge = None
+
+    def set_id(self, device_id, device_type, trans_type):
+        pass
+
+    def set_period(self, period):
+        pass
+
+    def set_rf_freq(self, rf_freq):
+        pass
+
+    def set_search_timeout(self, timeout):
+        pass
+
+    def enable_extended_messages(self, enable):
+        pass
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ReplayNode:
+    # Lets the openant device profiles decode recorded data pages without an ANT+ USB stick
+    def __init__(self):
+        self.channels = []
+
+    def new_channel(self, channel_type, network_number=0x00, ext_assign=None):
+        channel = ReplayChannel(len(self.channels))
+        self.channels.append(channel)
+        return channel
+
+    def stop(self):
+        pass
+
+
+class ReplaySensorProxy(BLENotificationHandlers, ANTDataHandlers, AbstractSensorProxy):
+    # Replays recorded raw BLE notifications or ANT+ data pages through the same parse callbacks the real proxies use,
+    # at real time (speed=1), N times faster (speed=N) or as fast as possible (speed=REPLAY_AS_FAST_AS_POSSIBLE).
+    # ANT+ pages need the device_type of the ANTSensorProxy they were recorded from.
+    def __init__(self, events, speed=1.0, device_type=None, device_id=0, name="replay", data_bus=None,
+                 wheel_circumference_m=WHEEL_CIRCUMFERENCE_M_700CX25):
+        super().__init__(0, data_bus, f"replay {name}")
+        self.events = events
+        self.speed = speed
+        self.device_type = device_type
+        self.device_id = device_id
+        self.replay_name = name
+        if device_type is None:
+            self.init_notification_state(wheel_circumference_m)
+        else:
+            self.csc_engine = CSCEngine(wheel_circumference_m, ANT_WHEEL_FORMAT, ANT_CRANK_FORMAT)
+        self.device = None
+        self.connecting = False
+
+        self.replayed = 0
+        self.invalid = 0
+        self.max_lag = 0.0
+
+    def __str__(self):
+        return f"ReplaySensorProxy({self.replay_name})"
+
+    def get_replay_handlers(self):
+        if self.device_type is None:
+            return {
+                REPLAY_BLE_HEART_RATE: lambda data: self.store_hr_value(None, data),
+                REPLAY_BLE_POWER: lambda data: self.store_power_value(None, data),
+                REPLAY_BLE_CSC: lambda data: self.store_csc_values(None, data),
+            }
+        # openant is only imported when ANT+ pages are replayed
+        import ANTSensorProxy
+        node = ReplayNode()
+        self.device = ANTSensorProxy.create_device(node, self.device_type, self.device_id)
+        self.device.on_found = self.on_found
+        self.device.on_device_data = self.on_device_data
+        channel = node.channels[0]
+        return {REPLAY_ANT_PAGE: lambda data: channel.on_broadcast_data(list(data))}
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+        handlers = {kind: self.instrument_handler(handler) for kind, handler in self.get_replay_handlers().items()}
+        if self.device_type is None:
+            self.set_connected(True)
+        t0 = time.monotonic()
+        first_event_time = self.events[0][EVENT_TIME] if self.events else 0
+        for event_time, kind, data in self.events:
+            if not self.running:
+                break
+            if self.speed:
+                lag = time.monotonic() - t0 - (event_time - first_event_time) / self.speed
+                if lag < 0:
+                    await asyncio.sleep(-lag)
+                elif lag > self.max_lag:
+                    self.max_lag = lag
+            elif self.replayed % FAST_REPLAY_BATCH == 0:
+                await asyncio.sleep(0)
+            try:
+                handlers[kind](data)
+            except (KeyError, IndexError, ValueError) as e:
+                self.invalid += 1
+                LOG.warning("Replay sensor %s| cannot replay %s event: %s", self.replay_name, kind, e)
+            self.replayed += 1
+        self.running = False
+        self.set_connected(False)
+
+    def stop(self):
+        self.running = False
+
+
+def advance_revolutions(revs, event_time, revs_per_second, t, dt):
+    # Like a real sensor the event time only moves on when a whole revolution completes, to the time it completed
+    new_revs = revs + revs_per_second * dt
+    if int(new_revs) > int(revs):
+        event_time = t + dt - (new_revs % 1) / revs_per_second
+    return new_revs, event_time
+
+
+def generate_ble_events(duration_s, rate_hz=4, seed=0, heart_rate=True, power=True, csc=True,
+                        wheel_circumference_m=WHEEL_CIRCUMFERENCE_M_700CX25):
+    # Synthetic BLE notifications with random-walk heart rate, power, speed and cadence and consistent CSC counters
+    rng = random.Random(seed)
+    events = []
+    hr, watts, speed_kmh, cadence = 120.0, 180.0, 30.0, 85.0
+    wheel_revs, wheel_time, crank_revs, crank_time = 0.0, 0.0, 0.0, 0.0
+    dt = 1 / rate_hz
+    for i in range(round(duration_s * rate_hz)):
+        t = i * dt
+        hr = min(200.0, max(60.0, hr + rng.uniform(-1, 1)))
+        watts = min(1200.0, max(0.0, watts + rng.uniform(-15, 15)))
+        speed_kmh = min(60.0, max(5.0, speed_kmh + rng.uniform(-0.5, 0.5)))
+        cadence = min(130.0, max(40.0, cadence + rng.uniform(-2, 2)))
+        wheel_revs, wheel_time = advance_revolutions(wheel_revs, wheel_time, speed_kmh / 3.6 / wheel_circumference_m,
+                                                     t, dt)
+        crank_revs, crank_time = advance_revolutions(crank_revs, crank_time, cadence / 60, t, dt)
+        if heart_rate:
+            events.append((t, REPLAY_BLE_HEART_RATE, struct.pack('<BB', 0x00, round(hr))))
+        if power:
+            events.append((t, REPLAY_BLE_POWER, struct.pack('<Hh', 0x0000, round(watts))))
+        if csc:
+            events.append((t, REPLAY_BLE_CSC, struct.pack('<BIHHH', 0x03, int(wheel_revs) & 0xFFFFFFFF,
+                                                          round(wheel_time * 1024) & 0xFFFF,
+                                                          int(crank_revs) & 0xFFFF,
+                                                          round(crank_time * 1024) & 0xFFFF)))
+    return events
+
+
+def generate_ant_csc_pages(duration_s, rate_hz=4, seed=0, wheel_circumference_m=WHEEL_CIRCUMFERENCE_M_700CX25):
+    # Synthetic combined bike speed & cadence pages (cadence time, cadence revs, speed time, speed revs). openant
+    # takes the first byte of these pages, the low byte of the cadence event time, for a page number, so the cadence
+    # event time is kept to multiples of ANT_PAGE_TIME_STEP ticks.
+    rng = random.Random(seed)
+    events = []
+    speed_kmh, cadence = 30.0, 85.0
+    wheel_revs, wheel_time, crank_revs, crank_time = 0.0, 0.0, 0.0, 0.0
+    dt = 1 / rate_hz
+    for i in range(round(duration_s * rate_hz)):
+        t = i * dt
+        speed_kmh = min(60.0, max(5.0, speed_kmh + rng.uniform(-0.5, 0.5)))
+        cadence = min(130.0, max(40.0, cadence + rng.uniform(-2, 2)))
+        wheel_revs, wheel_time = advance_revolutions(wheel_revs, wheel_time, speed_kmh / 3.6 / wheel_circumference_m,
+                                                     t, dt)
+        crank_revs, crank_time = advance_revolutions(crank_revs, crank_time, cadence / 60, t, dt)
+        crank_ticks = round(crank_time * 1024 / ANT_PAGE_TIME_STEP) * ANT_PAGE_TIME_STEP
+        events.append((t, REPLAY_ANT_PAGE, struct.pack('<HHHH', crank_ticks & 0xFFFF,
+                                                       int(crank_revs) & 0xFFFF,
+                                                       round(wheel_time * 1024) & 0xFFFF,
+                                                       int(wheel_revs) & 0xFFFF)))
+    return events
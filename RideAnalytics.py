@@ -0,0 +1,344 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import time
+
+import numpy
+
+import FitBatch
+import FitReader
+import Instrumentation
+from DataPoints import (
+    DATA_POINT_TIME,
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+)
+from SummaryAccumulator import NORMALIZED_POWER_WINDOW_S, MAX_SAMPLE_INTERVAL_S
+
+LOG = logging.getLogger(__name__)
+
+# bumped whenever a computation changes, so cached results of older versions are recomputed
+ANALYTICS_VERSION = 1
+DEFAULT_CACHE_NAME = "analytics.jsonl"
+HASH_CHUNK_SIZE = 1 << 20
+
+# durations shown in the report, part of the power-duration curve grid
+REPORT_DURATIONS_S = (5, 60, 300, 1200, 3600)
+# Power-duration curve durations: MMP_STEPS_PER_DOUBLING log-spaced durations per doubling of the duration, so a ride
+# of n seconds has O(log n) of them and its curve costs O(n log n). Every ride uses the same grid, so the curve of a
+# season is the maximum of its rides' curves.
+MMP_STEPS_PER_DOUBLING = 8
+MMP_MAX_DURATION_S = 24 * 3600
+MMP_DURATIONS_S = tuple(sorted({round(2 ** (step / MMP_STEPS_PER_DOUBLING))
+                                for step in range(int(math.log2(MMP_MAX_DURATION_S) * MMP_STEPS_PER_DOUBLING) + 1)} |
+                               set(REPORT_DURATIONS_S)))
+
+DEFAULT_W_PRIME_J = 20000
+# Skiba's W' recovery time constant: W_PRIME_TAU_SCALE_S * exp(-W_PRIME_TAU_RATE * DCP) + W_PRIME_TAU_OFFSET_S, with
+# DCP the difference between CP and the average power below CP
+W_PRIME_TAU_SCALE_S = 546
+W_PRIME_TAU_RATE = 0.01
+W_PRIME_TAU_OFFSET_S = 316
+# the W' balance is evaluated in blocks of this many seconds so exp(t / tau) stays far from overflowing
+W_PRIME_BLOCK_S = 3600
+
+# each half of the riding needs at least this many seconds for a meaningful decoupling
+MIN_DECOUPLING_HALF_S = 600
+
+ANALYSED_DATA_POINTS = (DATA_POINT_HEART_RATE, DATA_POINT_POWER, DATA_POINT_CADENCE, DATA_POINT_SPEED)
+
+
+def resample_1hz(seconds, values, fill):
+    # Values on a 1 Hz grid from the first record: a second without a value repeats the previous value when that is
+    # at most MAX_SAMPLE_INTERVAL_S old, otherwise it is `fill` (0 W for power, NaN for the other channels)
+    grid = numpy.full(seconds[-1] + 1, numpy.nan)
+    grid[seconds] = values
+    index = numpy.arange(len(grid))
+    last = numpy.maximum.accumulate(numpy.where(numpy.isnan(grid), -1, index))
+    held = (last >= 0) & (index - last <= MAX_SAMPLE_INTERVAL_S)
+    return numpy.where(held, grid[numpy.maximum(last, 0)], fill)
+
+
+def load_ride(file_name):
+    # (start time, duration in s, {data point: float64 array on a 1 Hz grid, None if not recorded}), None for a file
+    # without records.
+    # Each channel is one vectorised read of its field, see MappedFitReader.get_channel().
+    with FitReader.MappedFitReader(file_name, save_index=False) as reader:
+        if not len(reader):
+            return None
+        times = reader.get_channel(DATA_POINT_TIME)
+        seconds = numpy.round(times - times.min()).astype(numpy.int64)
+        channels = {}
+        for data_point in ANALYSED_DATA_POINTS:
+            values = reader.get_channel(data_point)
+            if numpy.isnan(values).all():
+                channels[data_point] = None
+            else:
+                channels[data_point] = resample_1hz(seconds, values, 0.0 if data_point == DATA_POINT_POWER else
+                                                    numpy.nan)
+    return float(times.min()), int(seconds.max()) + 1, channels
+
+
+def get_mean_max_power(power, durations=MMP_DURATIONS_S):
+    # {duration: best average power over that many seconds} for the durations up to the ride's length. One cumulative
+    # sum, then one vectorised difference per duration instead of a sliding window per start second.
+    sums = numpy.concatenate(([0.0], numpy.cumsum(power)))
+    curve = {}
+    for duration in durations:
+        if duration > len(power):
+            break
+        curve[duration] = float((sums[duration:] - sums[:-duration]).max() / duration)
+    return curve
+
+
+def get_normalized_power(power):
+    # Fourth-power mean of the rolling NORMALIZED_POWER_WINDOW_S average, like SummaryAccumulator
+    if len(power) < NORMALIZED_POWER_WINDOW_S:
+        return None
+    sums = numpy.concatenate(([0.0], numpy.cumsum(power)))
+    rolling = (sums[NORMALIZED_POWER_WINDOW_S:] - sums[:-NORMALIZED_POWER_WINDOW_S]) / NORMALIZED_POWER_WINDOW_S
+    return float(numpy.mean(rolling ** 4) ** 0.25)
+
+
+def get_w_prime_balance(power, cp, w_prime=DEFAULT_W_PRIME_J):
+    # Skiba's integral model: every second's work above CP is taken from W' and recovers exponentially, faster the
+    # further below CP the recovery is ridden. The decaying sum of expenditures is the recurrence
+    # spent[t] = spent[t - 1] * exp(-1 / tau) + expended[t], evaluated per block as a scaled cumulative sum.
+    expended = numpy.maximum(power - cp, 0.0)
+    below = power < cp
+    dcp = cp - float(power[below].mean()) if below.any() else 0.0
+    tau = W_PRIME_TAU_SCALE_S * math.exp(-W_PRIME_TAU_RATE * dcp) + W_PRIME_TAU_OFFSET_S
+    spent = numpy.empty(len(power))
+    carry = 0.0
+    for start in range(0, len(power), W_PRIME_BLOCK_S):
+        block = expended[start:start + W_PRIME_BLOCK_S]
+        growth = numpy.exp(numpy.arange(len(block)) / tau)
+        spent[start:start + len(block)] = (numpy.cumsum(block * growth) + carry) / growth
+        carry = spent[start + len(block) - 1] * math.exp(-1 / tau)
+    return w_prime - spent
+
+
+def get_aerobic_decoupling(output, hr):
+    # (efficiency factor of the first half, of the second half, decoupling in %) of the seconds ridden with heart
+    # rate; output is power (Pw:HR) or speed (Pa:HR). Stops and coasting are left out.
+    riding = (output > 0) & (hr > 0)
+    half = int(riding.sum()) // 2
+    if half < MIN_DECOUPLING_HALF_S:
+        return None
+    output, hr = output[riding], hr[riding]
+    first = float(output[:half].mean() / hr[:half].mean())
+    second = float(output[half:].mean() / hr[half:].mean())
+    return first, second, (first - second) / first * 100
+
+
+def analyze_ride(file_name, ftp=None, cp=None, w_prime=DEFAULT_W_PRIME_J):
+    # Training metrics of one ride as a JSON-serialisable dict, only for the channels that were recorded; runs in a
+    # worker process
+    t0 = time.perf_counter()
+    ride = load_ride(file_name)
+    if ride is None:
+        return {"duration": 0, "seconds": time.perf_counter() - t0}
+    start_time, duration, channels = ride
+    power, hr, speed = channels[DATA_POINT_POWER], channels[DATA_POINT_HEART_RATE], channels[DATA_POINT_SPEED]
+    result = {"start_time": start_time, "duration": duration}
+    if power is not None:
+        result["avg_power"] = float(power.mean())
+        result["work"] = float(power.sum())
+        result["mean_max_power"] = list(get_mean_max_power(power).items())
+        normalized_power = get_normalized_power(power)
+        if normalized_power is not None:
+            result["normalized_power"] = normalized_power
+            if ftp:
+                intensity_factor = normalized_power / ftp
+                result["intensity_factor"] = intensity_factor
+                result["training_stress_score"] = duration * normalized_power * intensity_factor / (ftp * 3600) * 100
+        if cp:
+            w_prime_balance = get_w_prime_balance(power, cp, w_prime)
+            lowest = int(w_prime_balance.argmin())
+            result["w_prime_balance_min"] = float(w_prime_balance[lowest])
+            result["w_prime_balance_min_time"] = lowest
+    if hr is not None:
+        result["avg_heart_rate"] = float(numpy.nanmean(hr))
+        output = power if power is not None else speed
+        decoupling = get_aerobic_decoupling(output, hr) if output is not None else None
+        if decoupling is not None:
+            result["efficiency_factors"] = list(decoupling[:2])
+            result["decoupling"] = decoupling[2]
+            result["decoupling_output"] = "power" if power is not None else "speed"
+    if channels[DATA_POINT_CADENCE] is not None:
+        cadence = channels[DATA_POINT_CADENCE]
+        pedalling = cadence > 0
+        result["avg_cadence"] = float(cadence[pedalling].mean()) if pedalling.any() else 0.0
+    result["seconds"] = time.perf_counter() - t0
+    return result
+
+
+def get_file_hash(file_name):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_name, "rb") as fit_file:
+        while chunk := fit_file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class AnalyticsCache:
+    # Results of analyze_ride() per FIT file content hash and analysis options, in an append-only JSON lines file like
+    # the FitBatch manifest (the last entry of a (hash, options) key wins). A file is only hashed again when its size
+    # or modification time changed, so reanalysing a season only computes the rides that are new or were rewritten;
+    # a copied or renamed ride is found by its hash.
+    def __init__(self, file_name):
+        self.file_name = file_name
+        # (hash, options) -> result
+        self.results = {}
+        # absolute file name -> (size, modification time, hash)
+        self.hashes = {}
+        self.hits = 0
+        self.misses = 0
+        if os.path.exists(file_name):
+            with open(file_name) as cache_file:
+                for line in cache_file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a line cut short by an interrupted run
+                        continue
+                    # every entry is kept, a ride analysed with other options does not replace the earlier results
+                    self.hashes[entry["file"]] = (entry["size"], entry["mtime_ns"], entry["hash"])
+                    self.results[(entry["hash"], entry["options"])] = entry["result"]
+        self.output = None
+
+    def get_hash(self, file_name):
+        stat = os.stat(file_name)
+        known = self.hashes.get(os.path.abspath(file_name))
+        if known is not None and known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+        return get_file_hash(file_name)
+
+    def get(self, file_hash, options):
+        result = self.results.get((file_hash, options))
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def put(self, file_name, file_hash, options, result):
+        if self.output is None:
+            os.makedirs(os.path.dirname(self.file_name) or ".", exist_ok=True)
+            self.output = open(self.file_name, "a")
+        stat = os.stat(file_name)
+        entry = {"file": os.path.abspath(file_name), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+                 "hash": file_hash, "options": options, "result": result}
+        self.output.write(json.dumps(entry) + "\n")
+        self.output.flush()
+        self.hashes[entry["file"]] = (stat.st_size, stat.st_mtime_ns, file_hash)
+        self.results[(file_hash, options)] = result
+
+    def close(self):
+        if self.output is not None:
+            self.output.close()
+            self.output = None
+
+
+def get_options_key(ftp, cp, w_prime):
+    return json.dumps({"version": ANALYTICS_VERSION, "mmp_steps": MMP_STEPS_PER_DOUBLING, "ftp": ftp, "cp": cp,
+                       "w_prime": w_prime}, sort_keys=True)
+
+
+def analyze_files(file_names, cache_name=DEFAULT_CACHE_NAME, ftp=None, cp=None, w_prime=DEFAULT_W_PRIME_J,
+                  workers=None):
+    # {file name: result} of every ride, cached rides are read from the cache and the others analysed in parallel
+    cache = AnalyticsCache(cache_name)
+    options = get_options_key(ftp, cp, w_prime)
+    results = {}
+    pending = {}
+    try:
+        for file_name in file_names:
+            file_hash = cache.get_hash(file_name)
+            result = cache.get(file_hash, options)
+            if result is not None:
+                results[file_name] = result
+            else:
+                pending[file_name] = file_hash
+        if pending:
+            with concurrent.futures.ProcessPoolExecutor(min(workers or os.cpu_count(), len(pending))) as executor:
+                futures = {executor.submit(analyze_ride, file_name, ftp, cp, w_prime): file_name
+                           for file_name in pending}
+                for future in concurrent.futures.as_completed(futures):
+                    file_name = futures[future]
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        LOG.error("Analytics| %s failed: %s: %s", file_name, type(e).__name__, e)
+                        continue
+                    cache.put(file_name, pending[file_name], options, result)
+                    results[file_name] = result
+    finally:
+        cache.close()
+    LOG.info("Analytics| %d rides, %d from the cache, %d analysed", len(results), cache.hits, len(pending))
+    return results
+
+
+def get_season_curve(results):
+    # Best power of the season for every duration, the maximum over the rides' curves
+    curve = {}
+    for result in results:
+        for duration, watts in result.get("mean_max_power", ()):
+            if watts > curve.get(duration, 0):
+                curve[duration] = watts
+    return curve
+
+
+def format_value(result, name, format_spec, unit=""):
+    return format(result[name], format_spec) + unit if name in result else "-"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Training metrics of FIT files: power-duration curve, NP/IF/TSS, "
+                                                 "W' balance and aerobic decoupling")
+    parser.add_argument("inputs", nargs="+", help="FIT files or directories searched recursively for .fit files")
+    parser.add_argument("--ftp", type=float, help="functional threshold power in W, for IF and TSS")
+    parser.add_argument("--cp", type=float, help="critical power in W, for the W' balance")
+    parser.add_argument("--w-prime", type=float, default=DEFAULT_W_PRIME_J, help="W' in J")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_NAME, help="results cache, one JSON line per analysed ride")
+    parser.add_argument("-j", "--workers", type=int, help="worker processes (default: all cores)")
+    parser.add_argument("--json", help="also write the results of every ride to this JSON file")
+    args = parser.parse_args()
+    log_listener = Instrumentation.setup_logging()
+    try:
+        t0 = time.perf_counter()
+        file_names = [file_name for file_name, _ in FitBatch.find_fit_files(args.inputs)]
+        results = analyze_files(file_names, args.cache, args.ftp, args.cp, args.w_prime, args.workers)
+        elapsed = time.perf_counter() - t0
+    finally:
+        log_listener.stop()
+    rides = sorted(results.items(), key=lambda item: item[1].get("start_time", 0))
+    print(f"{'ride':40} {'time':>8} {'NP':>6} {'IF':>5} {'TSS':>6} {'Wbal min':>9} {'decoupl.':>9}")
+    for file_name, result in rides:
+        print(f"{os.path.basename(file_name)[:40]:40} {result['duration'] / 60:7.1f}m "
+              f"{format_value(result, 'normalized_power', '6.0f'):>6} "
+              f"{format_value(result, 'intensity_factor', '5.2f'):>5} "
+              f"{format_value(result, 'training_stress_score', '6.1f'):>6} "
+              f"{format_value(result, 'w_prime_balance_min', '9.0f'):>9} "
+              f"{format_value(result, 'decoupling', '.1f', '%'):>9}")
+    curve = get_season_curve(results.values())
+    if curve:
+        print("best power: " + ", ".join(f"{duration}s {curve[duration]:.0f}W" for duration in REPORT_DURATIONS_S
+                                         if duration in curve))
+    print(f"total TSS: {sum(result.get('training_stress_score', 0) for result in results.values()):.0f}, "
+          f"{len(results)} rides in {elapsed:.2f}s")
+    if args.json:
+        with open(args.json, "w") as json_file:
+            json.dump(results, json_file, indent=1)
+    sys.exit(0 if len(results) == len(file_names) else 1)
+
+
+if __name__ == '__main__':
+    main()
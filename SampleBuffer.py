@@ -0,0 +1,96 @@
+from array import array
+
+from DataPoints import (
+    DATA_POINT_TIME,
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+
+COLUMN_TYPECODES = {
+    DATA_POINT_TIME: 'd',
+    DATA_POINT_HEART_RATE: 'H',
+    DATA_POINT_POWER: 'H',
+    DATA_POINT_CADENCE: 'd',
+    DATA_POINT_SPEED: 'd',
+    DATA_POINT_DISTANCE: 'd',
+}
+
+# the 'H' columns cannot store negative or larger values: values are clamped to the range of their FIT record fields
+# and truncated like RecordEncoder does, a missing value is stored as 0. RecordEncoder clamps every field it encodes.
+COLUMN_LIMITS = {
+    DATA_POINT_HEART_RATE: (0, 0xFE),
+    DATA_POINT_POWER: (0, 0xFFFE),
+}
+
+DEFAULT_CHUNK_SIZE = 3600
+
+
+class SampleBuffer:
+    # Columnar sample store with one typed array per data point. Storage grows in fixed-size chunks that are never
+    # resized, so memoryviews handed out over earlier samples stay valid while recording continues.
+    __slots__ = ('data_points', 'chunk_size', 'chunks', 'length', 'column_limits')
+
+    def __init__(self, data_points, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.data_points = tuple(data_points)
+        self.chunk_size = chunk_size
+        self.chunks = []
+        self.length = 0
+        self.column_limits = tuple(COLUMN_LIMITS.get(data_point) for data_point in self.data_points)
+
+    def __len__(self):
+        return self.length
+
+    def new_chunk(self):
+        chunk = []
+        for data_point in self.data_points:
+            column = array(COLUMN_TYPECODES[data_point])
+            column.frombytes(bytes(column.itemsize * self.chunk_size))
+            chunk.append(column)
+        return tuple(chunk)
+
+    def append(self, *values):
+        # values in data_points order; converted before any column is written, so a value that cannot be stored
+        # leaves no half-written row behind
+        values = [(value or 0.0) if limits is None else min(limits[1], max(limits[0], int(value or 0)))
+                  for value, limits in zip(values, self.column_limits)]
+        chunk_index, row = divmod(self.length, self.chunk_size)
+        if chunk_index == len(self.chunks):
+            self.chunks.append(self.new_chunk())
+        for column, value in zip(self.chunks[chunk_index], values):
+            column[row] = value
+        self.length += 1
+
+    def clear(self):
+        self.chunks = []
+        self.length = 0
+
+    def column_index(self, data_point):
+        return self.data_points.index(data_point)
+
+    def slices(self, start=0, stop=None):
+        # Yields a tuple of memoryviews (one per column, in data_points order) for every chunk overlapping [start, stop)
+        stop = self.length if stop is None else min(stop, self.length)
+        while start < stop:
+            chunk_index, row = divmod(start, self.chunk_size)
+            chunk_stop = min(stop - chunk_index * self.chunk_size, self.chunk_size)
+            yield tuple(memoryview(column)[row:chunk_stop] for column in self.chunks[chunk_index])
+            start += chunk_stop - row
+
+    def column_slices(self, data_point, start=0, stop=None):
+        column_index = self.column_index(data_point)
+        for views in self.slices(start, stop):
+            yield views[column_index]
+
+    def rows(self, start=0, stop=None):
+        for views in self.slices(start, stop):
+            yield from zip(*views)
+
+    def row(self, index):
+        chunk_index, row = divmod(index, self.chunk_size)
+        return tuple(column[row] for column in self.chunks[chunk_index])
+
+    def data_map(self, index):
+        return dict(zip(self.data_points, self.row(index)))
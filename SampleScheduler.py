@@ -0,0 +1,110 @@
+import math
+import time
+
+RECORDING_RATE_SMART = "smart"
+DEFAULT_RECORDING_RATE = 1
+# FIT record timestamps have one second resolution, faster rates would record several records per timestamp
+MAX_RECORDING_RATE = 1
+
+MISSED_TICKS_FILL = "fill"
+MISSED_TICKS_MARK = "mark"
+
+# longest a smart recording waits for sensor data before checking whether it should stop
+SMART_WAIT_TIMEOUT_S = 1.0
+
+
+class SampleScheduler:
+    # Schedules recording ticks on time.monotonic_ns(), anchored once to a wall-clock epoch on a whole second. Tick n is
+    # due at anchor + n * period on the monotonic clock and is stamped epoch + n * period, so NTP steps, GC pauses and
+    # late wakeups can neither duplicate nor skip a timestamp. Ticks missed by more than a period are either all
+    # returned so the caller fills them with the last values (MISSED_TICKS_FILL) or dropped and recorded as gaps
+    # (MISSED_TICKS_MARK), which the caller writes to the FIT file as timer stop/start events, see pop_gaps().
+    # With rate=RECORDING_RATE_SMART there are no ticks: a sample is taken whenever sensor data arrives, at most once
+    # per FIT timestamp second.
+    def __init__(self, rate=DEFAULT_RECORDING_RATE, missed_ticks=MISSED_TICKS_FILL):
+        if rate != RECORDING_RATE_SMART and not 0 < rate <= MAX_RECORDING_RATE:
+            raise ValueError(f"recording rate must be positive and at most {MAX_RECORDING_RATE} Hz or "
+                             f"'{RECORDING_RATE_SMART}', got {rate}")
+        if missed_ticks not in (MISSED_TICKS_FILL, MISSED_TICKS_MARK):
+            raise ValueError(f"unknown missed tick handling {missed_ticks}")
+        self.rate = rate
+        self.smart = rate == RECORDING_RATE_SMART
+        self.period_ns = 0 if self.smart else round(1e9 / rate)
+        self.missed_ticks = missed_ticks
+        self.anchor_ns = 0
+        self.epoch_ns = 0
+        self.next_tick = 0
+        self.last_second = None
+
+        self.ticks = 0
+        self.missed = 0
+        self.gaps = []
+        self.popped_gaps = 0
+        self.wakeups = 0
+        self.total_lag_ns = 0
+        self.max_lag_ns = 0
+
+    def start(self):
+        # The epoch is the next whole wall-clock second, which also becomes the first tick
+        now_ns = time.monotonic_ns()
+        wall_ns = time.time_ns()
+        self.epoch_ns = math.ceil(wall_ns / 1e9) * 1_000_000_000
+        self.anchor_ns = now_ns + self.epoch_ns - wall_ns
+        self.next_tick = 0
+        self.last_second = None
+
+    def wait(self, subscription=None):
+        # Blocks until samples are due and returns their timestamps, oldest first
+        if self.smart:
+            return self.wait_smart(subscription)
+        due_ns = self.anchor_ns + self.next_tick * self.period_ns
+        delay_ns = due_ns - time.monotonic_ns()
+        if delay_ns > 0:
+            time.sleep(delay_ns / 1e9)
+        lag_ns = max(0, time.monotonic_ns() - due_ns)
+        self.wakeups += 1
+        self.total_lag_ns += lag_ns
+        self.max_lag_ns = max(self.max_lag_ns, lag_ns)
+        n_due = 1 + lag_ns // self.period_ns
+        first_tick = self.next_tick
+        self.next_tick += n_due
+        if n_due > 1:
+            self.missed += n_due - 1
+            if self.missed_ticks == MISSED_TICKS_MARK:
+                # timestamps of the first missed tick and of the tick recording resumes with
+                self.gaps.append((self.get_tick_timestamp(first_tick), self.get_tick_timestamp(self.next_tick - 1)))
+                first_tick = self.next_tick - 1
+        self.ticks += self.next_tick - first_tick
+        return [self.get_tick_timestamp(tick) for tick in range(first_tick, self.next_tick)]
+
+    def wait_smart(self, subscription):
+        if not subscription.read(timeout=SMART_WAIT_TIMEOUT_S):
+            return []
+        # stamped with the whole second on the scheduler's clock, FIT timestamps have one second resolution anyway
+        second = (self.epoch_ns + time.monotonic_ns() - self.anchor_ns) // 1_000_000_000
+        if second == self.last_second:
+            # later updates in the same second are picked up by the next sample
+            return []
+        self.last_second = second
+        self.ticks += 1
+        return [float(second)]
+
+    def pop_gaps(self):
+        # (timer stop, timer start) timestamps of the gaps marked since the last call, to be written before the samples
+        # wait() returned
+        gaps = self.gaps[self.popped_gaps:]
+        self.popped_gaps = len(self.gaps)
+        return gaps
+
+    def get_tick_timestamp(self, tick):
+        return (self.epoch_ns + tick * self.period_ns) / 1e9
+
+    def get_stats(self):
+        return {
+            "rate": self.rate,
+            "samples": self.ticks,
+            "missed": self.missed,
+            "gaps": len(self.gaps),
+            "mean_lag_ms": self.total_lag_ns / self.wakeups / 1e6 if self.wakeups else 0.0,
+            "max_lag_ms": self.max_lag_ns / 1e6,
+        }
@@ -0,0 +1,217 @@
+import json
+
+import CaptureJournal
+import DataPoints
+import SampleScheduler
+
+SENSOR_TYPE_BLE = "ble"
+SENSOR_TYPE_ANT = "ant"
+SENSOR_TYPE_REPLAY = "replay"
+
+CHANNEL_DATA_POINTS = {
+    "heart_rate": DataPoints.DATA_POINT_HEART_RATE,
+    "power": DataPoints.DATA_POINT_POWER,
+    "cadence": DataPoints.DATA_POINT_CADENCE,
+    "speed": DataPoints.DATA_POINT_SPEED,
+    "distance": DataPoints.DATA_POINT_DISTANCE,
+}
+
+# The setup TrainerOverlayWindow used to hardcode in connect_sensors()
+DEFAULT_SENSOR_CONFIG = {
+    "sensors": [
+        {
+            "name": "garmin_hr_belt_ble",
+            "type": SENSOR_TYPE_BLE,
+            "address": "F4:86:48:60:E7:0D",
+            "characteristics": {"heart_rate": "00002a37-0000-1000-8000-00805f9b34fb"},
+        },
+        {
+            "name": "tacx_flow_ble",
+            "type": SENSOR_TYPE_BLE,
+            "address": "C4:0D:01:89:C9:9F",
+            "characteristics": {
+                "power": "00002a63-0000-1000-8000-00805f9b34fb",
+                "fec_rx": "6e40fec2-b5a3-f393-e0a9-e50e24dcca9e",
+                "fec_tx": "6e40fec3-b5a3-f393-e0a9-e50e24dcca9e",
+            },
+        },
+        {
+            "name": "tacx_flow_csc_ant",
+            "type": SENSOR_TYPE_ANT,
+            "device_type": "csc",
+            "device_id": 48757,
+            "connection_retries": 10,
+            "connect_timeout": 60,
+        },
+    ],
+    # candidate lists go through a SourceArbiter, so a stalled link drops out instead of freezing its channel; the
+    # trainer's FE-C data (fec_rx) also carries cadence
+    "channels": {
+        "heart_rate": ["garmin_hr_belt_ble"],
+        "power": ["tacx_flow_ble"],
+        "cadence": ["tacx_flow_csc_ant", "tacx_flow_ble"],
+        "speed": ["tacx_flow_csc_ant"],
+        "distance": ["tacx_flow_csc_ant"],
+    },
+    "output_dir": ".",
+    "recording_rate": SampleScheduler.DEFAULT_RECORDING_RATE,
+    "missed_ticks": SampleScheduler.MISSED_TICKS_FILL,
+}
+
+
+def load_sensor_config(file_name):
+    with open(file_name) as config_file:
+        config = json.load(config_file)
+    validate_sensor_config(config)
+    return config
+
+
+def load_session_config(file_name):
+    with open(file_name) as config_file:
+        config = json.load(config_file)
+    validate_session_config(config)
+    return config
+
+
+def validate_sensor_config(config):
+    names = set()
+    for sensor_config in config.get("sensors", []):
+        if sensor_config.get("type") not in SENSOR_TYPES:
+            raise ValueError(f"sensor {sensor_config.get('name')} has unknown type {sensor_config.get('type')}")
+        if "name" not in sensor_config:
+            raise ValueError(f"sensor {sensor_config} has no name")
+        names.add(sensor_config["name"])
+        # without an address, a BLE sensor uses a discovered device advertising its "capability", see DeviceDiscovery
+        if sensor_config["type"] == SENSOR_TYPE_BLE and "address" not in sensor_config:
+            import DeviceDiscovery
+            if sensor_config.get("capability") not in DeviceDiscovery.BLE_CAPABILITY_CHARACTERISTICS:
+                raise ValueError(f"BLE sensor {sensor_config['name']} needs an address or a known capability")
+        elif sensor_config["type"] == SENSOR_TYPE_BLE and "characteristics" not in sensor_config:
+            raise ValueError(f"BLE sensor {sensor_config['name']} has no characteristics")
+        if sensor_config["type"] == SENSOR_TYPE_ANT and "device_type" not in sensor_config:
+            raise ValueError(f"ANT+ sensor {sensor_config['name']} has no device_type")
+    recording_rate = config.get("recording_rate", SampleScheduler.DEFAULT_RECORDING_RATE)
+    if recording_rate != SampleScheduler.RECORDING_RATE_SMART and \
+            (not isinstance(recording_rate, (int, float)) or
+             not 0 < recording_rate <= SampleScheduler.MAX_RECORDING_RATE):
+        raise ValueError(f"recording_rate must be a positive rate of at most {SampleScheduler.MAX_RECORDING_RATE} Hz "
+                         f"or '{SampleScheduler.RECORDING_RATE_SMART}'")
+    if config.get("missed_ticks", SampleScheduler.MISSED_TICKS_FILL) not in (SampleScheduler.MISSED_TICKS_FILL,
+                                                                              SampleScheduler.MISSED_TICKS_MARK):
+        raise ValueError(f"unknown missed_ticks {config['missed_ticks']}")
+    for channel, sensor_names in config.get("channels", {}).items():
+        if channel not in CHANNEL_DATA_POINTS:
+            raise ValueError(f"unknown channel {channel}")
+        # one sensor, or a list of candidate sensors in order of preference that a SourceArbiter chooses from
+        candidates = [sensor_names] if isinstance(sensor_names, str) else sensor_names
+        if not candidates:
+            raise ValueError(f"channel {channel} has no sensors")
+        for sensor_name in candidates:
+            if sensor_name not in names:
+                raise ValueError(f"channel {channel} uses unknown sensor {sensor_name}")
+    if "arbitration" in config:
+        import SourceArbiter
+        for channel, mode in config["arbitration"].items():
+            if channel not in CHANNEL_DATA_POINTS:
+                raise ValueError(f"unknown arbitration channel {channel}")
+            if mode not in (SourceArbiter.ARBITRATION_SWITCH, SourceArbiter.ARBITRATION_FUSE):
+                raise ValueError(f"unknown arbitration mode {mode} for channel {channel}")
+    if "trainer" in config and config["trainer"] not in names:
+        raise ValueError(f"trainer {config['trainer']} is not a configured sensor")
+    if config.get("journal_compression") not in CaptureJournal.JOURNAL_CODECS:
+        raise ValueError(f"unknown journal_compression {config['journal_compression']}")
+
+
+def validate_session_config(config):
+    # A group session: the sensors of all riders in "sensors", and per rider a name and the channels recorded for them
+    # ({"name": ..., "channels": {...}}, optionally with their own hr_zones and power_zones)
+    validate_sensor_config(config)
+    rider_names = set()
+    for rider_config in config.get("riders", []):
+        name = rider_config.get("name")
+        if not name:
+            raise ValueError(f"rider {rider_config} has no name")
+        if name in rider_names:
+            raise ValueError(f"rider {name} is configured twice")
+        rider_names.add(name)
+        validate_sensor_config({"sensors": config.get("sensors", []), "channels": rider_config.get("channels", {})})
+    if not rider_names:
+        raise ValueError("a session needs at least one rider")
+
+
+def uses_discovery(config):
+    # a config needs a DeviceDiscovery cache when it names one, or when a sensor leaves its address or device id to
+    # discovery
+    return "device_cache" in config or any(get_missing_transport(sensor_config) is not None
+                                           for sensor_config in config.get("sensors", []))
+
+
+def get_missing_transport(sensor_config):
+    if sensor_config["type"] == SENSOR_TYPE_BLE and "address" not in sensor_config:
+        return SENSOR_TYPE_BLE
+    if sensor_config["type"] == SENSOR_TYPE_ANT and "device_id" not in sensor_config:
+        return SENSOR_TYPE_ANT
+    return None
+
+
+def create_ble_sensor(sensor_config, kwargs, ant_node_manager):
+    import BLESensorProxy
+    characteristics = {
+        "heart_rate": BLESensorProxy.GATT_CHAR_UUID_HEART_RATE,
+        "power": BLESensorProxy.GATT_CHAR_UUID_POWER,
+        "csc": BLESensorProxy.GATT_CHAR_UUID_CSC,
+        "fec_rx": BLESensorProxy.GATT_CHAR_UUID_FEC_RX,
+        "fec_tx": BLESensorProxy.GATT_CHAR_UUID_FEC_TX,
+    }
+    gatt_char_uuids_map = {characteristics[name]: uuid for name, uuid in sensor_config["characteristics"].items()}
+    return BLESensorProxy.BLESensorProxy(sensor_config["address"], gatt_char_uuids_map,
+                                         pair=sensor_config.get("pair", False), **kwargs)
+
+
+def create_ant_sensor(sensor_config, kwargs, ant_node_manager):
+    import ANTSensorProxy
+    return ANTSensorProxy.ANTSensorProxy(get_ant_device_type(sensor_config["device_type"]), sensor_config["device_id"],
+                                         node_manager=ant_node_manager, **kwargs)
+
+
+def create_replay_sensor(sensor_config, kwargs, ant_node_manager):
+    # recorded BLE notifications, or ANT+ pages when the sensor config has a device_type
+    import ReplaySensorProxy
+    device_type = get_ant_device_type(sensor_config["device_type"]) if "device_type" in sensor_config else None
+    kwargs.pop("connection_retries", None)
+    return ReplaySensorProxy.ReplaySensorProxy(ReplaySensorProxy.load_replay(sensor_config["file"]),
+                                               sensor_config.get("speed", 1.0), device_type=device_type,
+                                               device_id=sensor_config.get("device_id", 0),
+                                               name=sensor_config["name"], **kwargs)
+
+
+# Sensor type -> factory(sensor config, proxy kwargs, ANT+ node manager). A factory imports its proxy module when it is
+# called, so only the sensor types in use are loaded: a config without ANT+ sensors never imports openant.
+SENSOR_TYPES = {
+    SENSOR_TYPE_BLE: create_ble_sensor,
+    SENSOR_TYPE_ANT: create_ant_sensor,
+    SENSOR_TYPE_REPLAY: create_replay_sensor,
+}
+
+
+def register_sensor_type(sensor_type, factory):
+    SENSOR_TYPES[sensor_type] = factory
+
+
+def create_sensor(sensor_config, data_bus=None, ant_node_manager=None):
+    kwargs = {"data_bus": data_bus}
+    for key in ("connection_retries", "wheel_circumference_m"):
+        if key in sensor_config:
+            kwargs[key] = sensor_config[key]
+    return SENSOR_TYPES[sensor_config["type"]](sensor_config, kwargs, ant_node_manager)
+
+
+def get_ant_device_type(device_type_name):
+    import ANTSensorProxy
+    device_types = {
+        "heart_rate": ANTSensorProxy.DEVICE_TYPE_HEART_RATE,
+        "power": ANTSensorProxy.DEVICE_TYPE_POWER,
+        "csc": ANTSensorProxy.DEVICE_TYPE_CSC,
+        "fitness_equipment": ANTSensorProxy.DEVICE_TYPE_FITNESS_EQUIPMENT,
+    }
+    return device_types[device_type_name]
@@ -0,0 +1,82 @@
+import itertools
+import threading
+import time
+
+DEFAULT_BUS_CAPACITY = 1024
+
+SAMPLE_SEQUENCE = 0
+SAMPLE_TIMESTAMP = 1
+SAMPLE_DATA_POINT = 2
+SAMPLE_VALUE = 3
+SAMPLE_SOURCE = 4
+
+
+class SensorDataBus:
+    # Ring buffer of (sequence, timestamp, data_point, value, source) samples. Publishers claim a slot from an atomic
+    # counter and write without locking; every subscription keeps its own read position, so readers never block
+    # publishers. A subscriber that falls more than `capacity` samples behind skips the overwritten samples and counts
+    # them as dropped.
+    def __init__(self, capacity=DEFAULT_BUS_CAPACITY):
+        self.capacity = capacity
+        self.samples = [None] * capacity
+        self.sequence_counter = itertools.count()
+        self.sequence = 0
+        self.subscriptions = []
+
+    def publish(self, data_point, value, source=None, timestamp=None):
+        sequence = next(self.sequence_counter)
+        if timestamp is None:
+            timestamp = time.time()
+        self.samples[sequence % self.capacity] = (sequence, timestamp, data_point, value, source)
+        if sequence >= self.sequence:
+            self.sequence = sequence + 1
+        for subscription in self.subscriptions:
+            subscription.new_data.set()
+
+    def subscribe(self, data_points=None):
+        subscription = SensorSubscription(self, data_points)
+        self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions = [s for s in self.subscriptions if s is not subscription]
+
+
+class SensorSubscription:
+    def __init__(self, data_bus: SensorDataBus, data_points=None):
+        self.data_bus = data_bus
+        self.data_points = None if data_points is None else frozenset(data_points)
+        self.read_sequence = data_bus.sequence
+        self.dropped = 0
+        self.new_data = threading.Event()
+
+    def poll(self, max_samples=None):
+        samples = []
+        bus = self.data_bus
+        while max_samples is None or len(samples) < max_samples:
+            sample = bus.samples[self.read_sequence % bus.capacity]
+            if sample is None or sample[SAMPLE_SEQUENCE] < self.read_sequence:
+                break
+            if sample[SAMPLE_SEQUENCE] > self.read_sequence:
+                # overwritten before we got to it, continue from the oldest sample still in the buffer
+                oldest_sequence = max(bus.sequence, sample[SAMPLE_SEQUENCE] + 1) - bus.capacity + 1
+                self.dropped += oldest_sequence - self.read_sequence
+                self.read_sequence = oldest_sequence
+                continue
+            self.read_sequence += 1
+            if self.data_points is None or sample[SAMPLE_DATA_POINT] in self.data_points:
+                samples.append(sample)
+        return samples
+
+    def read(self, timeout=None, max_samples=None):
+        # Waits up to `timeout` seconds for new samples instead of polling on a fixed interval
+        self.new_data.clear()
+        samples = self.poll(max_samples)
+        if not samples and timeout != 0:
+            self.new_data.wait(timeout)
+            self.new_data.clear()
+            samples = self.poll(max_samples)
+        return samples
+
+    def close(self):
+        self.data_bus.unsubscribe(self)
@@ -0,0 +1,122 @@
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import FitWriter
+import SampleBuffer
+import SensorDataBus
+import SensorRuntime
+from ANTSensorProxy import DEVICE_TYPE_CSC
+from ReplaySensorProxy import (
+    ReplaySensorProxy,
+    REPLAY_AS_FAST_AS_POSSIBLE,
+    generate_ble_events,
+    generate_ant_csc_pages,
+)
+
+BENCHMARK_BUS_CAPACITY = 65536
+RECORD_DATA_POINTS = (
+    FitWriter.DATA_POINT_HEART_RATE,
+    FitWriter.DATA_POINT_POWER,
+    FitWriter.DATA_POINT_CADENCE,
+    FitWriter.DATA_POINT_SPEED,
+    FitWriter.DATA_POINT_DISTANCE,
+)
+
+
+def create_virtual_sensors(n_sensors, data_bus, duration_s, speed, seed=0):
+    # Every fourth virtual sensor is an ANT+ speed & cadence sensor, the rest are BLE HR/power/CSC sensors
+    sensors = []
+    for i in range(n_sensors):
+        if i % 4 == 3:
+            sensors.append(ReplaySensorProxy(generate_ant_csc_pages(duration_s, seed=seed + i), speed,
+                                             device_type=DEVICE_TYPE_CSC, device_id=i, name=f"virtual-ant-{i}",
+                                             data_bus=data_bus))
+        else:
+            sensors.append(ReplaySensorProxy(generate_ble_events(duration_s, seed=seed + i), speed,
+                                             name=f"virtual-ble-{i}", data_bus=data_bus))
+    return sensors
+
+
+class BenchmarkWriter:
+    # Drains the bus like a recording would and writes one FIT record per batch of samples read
+    def __init__(self, data_bus, file_name):
+        self.subscription = data_bus.subscribe()
+        self.file_name = file_name
+        self.running = True
+        self.consumed = 0
+        self.records = 0
+        self.latencies = []
+        self.thread = threading.Thread(target=self.write, name="BenchmarkWriter")
+
+    def write(self):
+        fit_writer = FitWriter.FitWriter(streaming=True)
+        fit_writer.start_writing(self.file_name)
+        samples = SampleBuffer.SampleBuffer((FitWriter.DATA_POINT_TIME,) + RECORD_DATA_POINTS)
+        last_values = dict.fromkeys(RECORD_DATA_POINTS, 0)
+        while True:
+            running = self.running
+            batch = self.subscription.read(timeout=0.05)
+            now = time.time()
+            for sample in batch:
+                self.latencies.append(now - sample[SensorDataBus.SAMPLE_TIMESTAMP])
+                last_values[sample[SensorDataBus.SAMPLE_DATA_POINT]] = sample[SensorDataBus.SAMPLE_VALUE]
+            if batch:
+                self.consumed += len(batch)
+                samples.append(batch[-1][SensorDataBus.SAMPLE_TIMESTAMP], *last_values.values())
+                fit_writer.add_samples(samples, len(samples) - 1)
+                self.records += 1
+            elif not running:
+                break
+        fit_writer.stop_writing()
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percentile / 100))]
+
+
+def benchmark_pipeline(n_sensors=100, duration_s=600, speed=REPLAY_AS_FAST_AS_POSSIBLE, seed=0):
+    data_bus = SensorDataBus.SensorDataBus(BENCHMARK_BUS_CAPACITY)
+    sensors = create_virtual_sensors(n_sensors, data_bus, duration_s, speed, seed)
+    runtime = SensorRuntime.SensorRuntime()
+    for sensor in sensors:
+        runtime.add_sensor(sensor)
+    n_events = sum(len(sensor.events) for sensor in sensors)
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        writer = BenchmarkWriter(data_bus, os.path.join(output_dir, "benchmark.fit"))
+        writer.thread.start()
+        t0 = time.perf_counter()
+        asyncio.run(runtime.run())
+        replay_elapsed = time.perf_counter() - t0
+        writer.running = False
+        writer.thread.join()
+        elapsed = time.perf_counter() - t0
+        file_size = os.path.getsize(writer.file_name)
+
+    mode = "as fast as possible" if not speed else f"{speed}x real time"
+    print(f"{n_sensors} virtual sensors, {duration_s}s of data each, replayed {mode}")
+    print(f"  replayed events: {sum(sensor.replayed for sensor in sensors)}/{n_events} "
+          f"({sum(sensor.invalid for sensor in sensors)} invalid) in {replay_elapsed:.2f}s, "
+          f"{n_events / replay_elapsed:.0f} events/s")
+    print(f"  bus samples: {data_bus.sequence} published, {writer.consumed} consumed, "
+          f"{writer.subscription.dropped} dropped, {data_bus.sequence / elapsed:.0f} samples/s end to end")
+    print(f"  writer: {writer.records} records, {file_size} bytes")
+    print(f"  bus latency: p50 {get_percentile(writer.latencies, 50) * 1000:.2f}ms, "
+          f"p99 {get_percentile(writer.latencies, 99) * 1000:.2f}ms, "
+          f"max {max(writer.latencies, default=0) * 1000:.2f}ms")
+    if speed:
+        print(f"  max replay lag behind schedule: {max(sensor.max_lag for sensor in sensors) * 1000:.2f}ms")
+
+
+if __name__ == '__main__':
+    # SensorPipelineBenchmark.py [n_sensors] [duration_s] [speed, 0 = as fast as possible]
+    benchmark_pipeline(int(sys.argv[1]) if len(sys.argv) > 1 else 100,
+                       float(sys.argv[2]) if len(sys.argv) > 2 else 600,
+                       float(sys.argv[3]) if len(sys.argv) > 3 else REPLAY_AS_FAST_AS_POSSIBLE)
@@ -0,0 +1,67 @@
+import asyncio
+import logging
+import time
+
+DEFAULT_CONNECT_TIMEOUT = 30
+# how often the sensors' speed and cadence are checked for revolutions that stopped, see expire_rates()
+EXPIRE_INTERVAL_S = 1.0
+
+LOG = logging.getLogger(__name__)
+
+
+class SensorRuntime:
+    # Hosts every sensor proxy on one asyncio loop. All sensors are started at once and each one gets its own connect
+    # timeout, so startup takes as long as the slowest sensor instead of the sum of all of them.
+    def __init__(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self.sensors = []
+        self.loop = None
+        self.tasks = []
+
+    def add_sensor(self, sensor, connect_timeout=None):
+        self.sensors.append((sensor, self.connect_timeout if connect_timeout is None else connect_timeout))
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        t0 = time.monotonic()
+        for sensor, _ in self.sensors:
+            sensor.loop = self.loop
+            sensor.connected_event = asyncio.Event()
+            self.tasks.append(asyncio.create_task(self.run_sensor(sensor)))
+        expire_task = asyncio.create_task(self.expire_rates())
+        try:
+            connected = await asyncio.gather(*[self.wait_connected(sensor, timeout)
+                                               for sensor, timeout in self.sensors])
+            LOG.info("Sensor runtime| %d/%d sensors connected in %.2fs", sum(connected), len(connected),
+                     time.monotonic() - t0)
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        finally:
+            expire_task.cancel()
+
+    async def expire_rates(self):
+        # Sensors only update speed and cadence when a notification arrives, so a sensor that stops sending would
+        # otherwise keep its last rate
+        while True:
+            await asyncio.sleep(EXPIRE_INTERVAL_S)
+            now = time.monotonic()
+            for sensor, _ in self.sensors:
+                sensor.expire_rates(now)
+
+    async def run_sensor(self, sensor):
+        try:
+            await sensor.run()
+        except Exception as e:
+            LOG.error("Sensor runtime| sensor %s stopped with error: %s", sensor, e)
+
+    async def wait_connected(self, sensor, timeout):
+        try:
+            await asyncio.wait_for(sensor.connected_event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            LOG.warning("Sensor runtime| sensor %s did not connect within %ss, stopping it", sensor, timeout)
+            sensor.stop()
+            return False
+
+    def stop(self):
+        for sensor, _ in self.sensors:
+            sensor.stop()
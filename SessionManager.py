@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import datetime
+import logging
+import os
+import signal
+import struct
+import threading
+import time
+
+import DataPoints
+import Instrumentation
+import SampleBuffer
+import SampleScheduler
+import SensorConfig
+import SensorDataBus
+import SensorRuntime
+import SummaryAccumulator
+from AbstractSensorProxy import LAST_VALUE_ATTRIBUTES
+
+LOG = logging.getLogger(__name__)
+
+# samples are handed to the FIT writers every this many ticks, in one add_samples() call per rider
+DEFAULT_ENCODE_BATCH_TICKS = 5
+
+
+class Rider:
+    # One rider of a session: the sensors of their channels, their samples and their FIT writer
+    def __init__(self, name, sample_sources, hr_zones, power_zones):
+        self.name = name
+        # (data point, sensor, last value attribute) per recorded channel
+        self.sample_sources = sample_sources
+        self.hr_zones = hr_zones
+        self.power_zones = power_zones
+        self.output_file = None
+        self.samples = None
+        self.fit_writer = None
+        self.encoded = 0
+        self.lap_requested = False
+
+    def sample(self, timestamps):
+        values = [getattr(sensor, attribute) for _, sensor, attribute in self.sample_sources]
+        try:
+            for timestamp in timestamps:
+                # missed ticks are filled with the values read for the tick that is due now
+                self.samples.append(timestamp, *values)
+        except (TypeError, ValueError, OverflowError) as e:
+            # one bad value costs the rider this tick, not the session
+            LOG.warning("Session| dropping samples of %s %s: %s", self.name, values, e)
+
+    def encode(self):
+        # hands the samples taken since the last call to the FIT writer
+        end = len(self.samples)
+        if end > self.encoded:
+            try:
+                self.fit_writer.add_samples(self.samples, self.encoded, end)
+            except (TypeError, ValueError, OverflowError, struct.error) as e:
+                # one bad value costs the rider this batch, not the session
+                LOG.warning("Session| dropping samples %d-%d of %s: %s", self.encoded, end, self.name, e)
+            self.encoded = end
+
+    def finish(self):
+        # writes the remaining samples and finalizes the FIT file
+        try:
+            self.encode()
+        finally:
+            self.fit_writer.stop_writing()
+
+
+class SessionManager:
+    # Records a group session with one FIT file per rider in one process. The sensors of all riders run on one
+    # SensorRuntime loop and share one ANT+ node; a single recording thread samples every rider on the same scheduler
+    # tick and encodes their samples in batches, with the record encoders shared between riders, and one FitIOWorker
+    # does the file writes of all riders. The thread count does not grow with the number of riders.
+    def __init__(self, output_dir="."):
+        self.output_dir = output_dir
+        self.data_bus = SensorDataBus.SensorDataBus()
+        self.sensor_runtime = SensorRuntime.SensorRuntime()
+        self.ant_node_manager = None
+        self.sensors = {}
+        self.riders = {}
+        # SourceArbiter per channel and candidate sensors, shared by the riders with the same candidates
+        self.arbiters = {}
+
+        self.recording = False
+        self.start_time = 0
+        self.write_data_thread = None
+        self.recording_rate = SampleScheduler.DEFAULT_RECORDING_RATE
+        self.missed_ticks = SampleScheduler.MISSED_TICKS_FILL
+        self.encode_batch_ticks = DEFAULT_ENCODE_BATCH_TICKS
+        self.scheduler = None
+        self.io_worker = None
+        self.journal = None
+        self.device_cache = None
+
+    def configure(self, config):
+        SensorConfig.validate_session_config(config)
+        if SensorConfig.uses_discovery(config):
+            import DeviceDiscovery
+            # sensors without an address or device id get one from the device cache, or from a scan when not cached
+            self.device_cache, config = DeviceDiscovery.setup_device_cache(config)
+        self.output_dir = config.get("output_dir", self.output_dir)
+        self.recording_rate = config.get("recording_rate", self.recording_rate)
+        self.missed_ticks = config.get("missed_ticks", self.missed_ticks)
+        self.encode_batch_ticks = config.get("encode_batch_ticks", self.encode_batch_ticks)
+        for sensor_config in config["sensors"]:
+            if sensor_config["type"] == SensorConfig.SENSOR_TYPE_ANT and self.ant_node_manager is None:
+                import ANTNodeManager
+                self.ant_node_manager = ANTNodeManager.ANTNodeManager()
+            sensor = SensorConfig.create_sensor(sensor_config, self.data_bus, self.ant_node_manager)
+            self.sensors[sensor_config["name"]] = sensor
+            self.sensor_runtime.add_sensor(sensor, sensor_config.get("connect_timeout"))
+        if "journal" in config:
+            # every raw packet of every sensor, see CaptureJournal
+            import CaptureJournal
+            self.journal = CaptureJournal.CaptureJournal(config["journal"], config.get("journal_compression"))
+            for sensor in self.sensors.values():
+                sensor.set_journal(self.journal)
+        if self.device_cache is not None:
+            for sensor in self.sensors.values():
+                sensor.set_device_cache(self.device_cache)
+        for rider_config in config["riders"]:
+            channels = rider_config.get("channels", {})
+            sample_sources = [(data_point, self.get_channel_source(channel, channels[channel],
+                                                                   config.get("arbitration", {})),
+                               LAST_VALUE_ATTRIBUTES[data_point])
+                              for channel, data_point in SensorConfig.CHANNEL_DATA_POINTS.items()
+                              if channel in channels]
+            self.riders[rider_config["name"]] = Rider(
+                rider_config["name"], sample_sources,
+                tuple(rider_config.get("hr_zones", config.get("hr_zones",
+                                                              SummaryAccumulator.DEFAULT_HR_ZONE_BOUNDARIES))),
+                tuple(rider_config.get("power_zones", config.get("power_zones",
+                                                                 SummaryAccumulator.DEFAULT_POWER_ZONE_BOUNDARIES))))
+
+    def get_channel_source(self, channel, sensor_names, arbitration):
+        # The channel's sensor, or a SourceArbiter over its candidate sensors
+        if isinstance(sensor_names, str):
+            return self.sensors[sensor_names]
+        key = (channel, tuple(sensor_names))
+        if key not in self.arbiters:
+            import SourceArbiter
+            self.arbiters[key] = SourceArbiter.SourceArbiter(
+                SensorConfig.CHANNEL_DATA_POINTS[channel], [self.sensors[name] for name in sensor_names],
+                self.data_bus, arbitration.get(channel, SourceArbiter.ARBITRATION_SWITCH),
+                name=f"arbiter {channel} {'/'.join(sensor_names)}")
+            self.sensor_runtime.add_sensor(self.arbiters[key])
+        return self.arbiters[key]
+
+    async def run_sensors(self):
+        await self.sensor_runtime.run()
+
+    def start_recording(self):
+        if self.recording:
+            return
+        self.wait_for_recording()
+        self.recording = True
+        self.start_time = time.time()
+        session_name = datetime.datetime.now().strftime('%Y-%m-%dT%H_%M_%S')
+        for rider in self.riders.values():
+            rider.output_file = os.path.join(self.output_dir, f"{session_name}_{rider.name}.fit")
+        self.write_data_thread = threading.Thread(target=self.write_data, name="SessionManager")
+        self.write_data_thread.start()
+
+    def stop_recording(self):
+        self.recording = False
+
+    def wait_for_recording(self):
+        if self.write_data_thread is not None:
+            self.write_data_thread.join()
+        self.write_data_thread = None
+
+    def lap(self, rider_name=None):
+        # a lap for one rider, or for everyone
+        if self.recording:
+            for rider in self.riders.values() if rider_name is None else [self.riders[rider_name]]:
+                rider.lap_requested = True
+
+    def stop(self):
+        self.stop_recording()
+        self.wait_for_recording()
+        self.sensor_runtime.stop()
+        if self.ant_node_manager is not None:
+            self.ant_node_manager.stop()
+        if self.journal is not None:
+            self.journal.close()
+        if self.device_cache is not None:
+            self.device_cache.save()
+
+    def write_data(self):
+        # fit_tool is only loaded once the first recording starts
+        import FitFileStream
+        import FitWriter
+        riders = list(self.riders.values())
+        record_encoders = {}
+        self.io_worker = FitFileStream.FitIOWorker()
+        self.io_worker.start()
+        for rider in riders:
+            rider.fit_writer = FitWriter.FitWriter(streaming=True, hr_zones=rider.hr_zones,
+                                                   power_zones=rider.power_zones, record_encoders=record_encoders,
+                                                   io_worker=self.io_worker)
+            rider.fit_writer.start_writing(rider.output_file)
+            rider.samples = SampleBuffer.SampleBuffer([DataPoints.DATA_POINT_TIME] +
+                                                      [source[0] for source in rider.sample_sources])
+            rider.encoded = 0
+        self.scheduler = SampleScheduler.SampleScheduler(self.recording_rate, self.missed_ticks)
+        subscription = self.data_bus.subscribe() if self.scheduler.smart else None
+        self.scheduler.start()
+        pending_ticks = 0
+        try:
+            while self.recording:
+                for rider in riders:
+                    if rider.lap_requested:
+                        rider.lap_requested = False
+                        rider.encode()
+                        rider.fit_writer.add_lap()
+                timestamps = self.scheduler.wait(subscription)
+                gaps = self.scheduler.pop_gaps()
+                for rider in riders:
+                    if gaps:
+                        # the samples before the gap go to the file before its timer events
+                        rider.encode()
+                        for gap_start, gap_end in gaps:
+                            rider.fit_writer.add_timer_gap(round(gap_start * 1000), round(gap_end * 1000))
+                    rider.sample(timestamps)
+                pending_ticks += len(timestamps)
+                if pending_ticks >= self.encode_batch_ticks:
+                    pending_ticks = 0
+                    for rider in riders:
+                        rider.encode()
+        finally:
+            # every rider's FIT file is finalized however the session ends, and the FitIOWorker thread always stops
+            try:
+                if subscription is not None:
+                    subscription.close()
+                for rider in riders:
+                    try:
+                        rider.finish()
+                    except Exception as e:
+                        LOG.error("Session| could not finalize the FIT file of %s: %s", rider.name, e)
+            finally:
+                self.io_worker.stop()
+        LOG.info("Session| %d riders recorded, scheduler stats: %s", len(riders), self.scheduler.get_stats())
+
+    def get_status(self):
+        return {
+            "recording": self.recording,
+            "elapsed": time.time() - self.start_time if self.recording else 0,
+            "scheduler": self.scheduler.get_stats() if self.scheduler is not None else None,
+            "sensors": {name: sensor.connected for name, sensor in self.sensors.items()},
+            "journal": self.journal.get_stats() if self.journal is not None else None,
+            "arbiters": {arbiter.name: arbiter.get_stats() for arbiter in self.arbiters.values()},
+            "riders": {name: {
+                "output_file": rider.output_file if self.recording else None,
+                "samples": len(rider.samples) if rider.samples is not None else 0,
+            } for name, rider in self.riders.items()},
+        }
+
+
+async def run_session(session: SessionManager, duration=None):
+    # Records until `duration` seconds have passed, or until SIGINT/SIGTERM
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass
+    sensors_task = asyncio.create_task(session.run_sensors())
+    session.start_recording()
+    try:
+        await asyncio.wait_for(stop_event.wait(), duration)
+    except asyncio.TimeoutError:
+        pass
+    await loop.run_in_executor(None, session.stop)
+    await sensors_task
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record a group session, one FIT file per rider")
+    parser.add_argument("config", help="session config JSON file with the sensors and riders")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds instead of on Ctrl+C")
+    args = parser.parse_args()
+    log_listener = Instrumentation.setup_logging()
+    session = SessionManager()
+    session.configure(SensorConfig.load_session_config(args.config))
+    try:
+        asyncio.run(run_session(session, args.duration))
+    finally:
+        log_listener.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import time
+
+import SensorDataBus
+from AbstractSensorProxy import AbstractSensorProxy, LAST_VALUE_ATTRIBUTES
+from DataPoints import (
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+from Instrumentation import METRICS
+
+LOG = logging.getLogger(__name__)
+
+ARBITRATION_SWITCH = "switch"
+ARBITRATION_FUSE = "fuse"
+
+# how often the candidates are rescored, also when none of them sends anything
+DEFAULT_UPDATE_INTERVAL_S = 0.1
+# interval assumed for a source until it sent two samples
+DEFAULT_SOURCE_INTERVAL_S = 1.0
+# smoothing of the measured update interval of a source
+INTERVAL_SMOOTHING = 0.2
+# a source is fully fresh for FRESH_INTERVALS of its update intervals after a sample, then its freshness falls to 0
+# at STALE_INTERVALS intervals, and never before MIN_STALE_AFTER_S
+FRESH_INTERVALS = 1.5
+STALE_INTERVALS = 4
+MIN_STALE_AFTER_S = 3.0
+# sources updating slower than this are scored down in proportion
+REFERENCE_INTERVAL_S = 1.0
+# smoothing of the share of plausible values of a source
+PLAUSIBILITY_SMOOTHING = 0.2
+# a non-zero value that has not changed for this long is suspect, e.g. a strap that lost contact but keeps sending
+FROZEN_AFTER_S = 30.0
+FROZEN_PENALTY = 0.5
+# a challenger has to score this much better than the selected source for SWITCH_HOLD_S before the arbiter switches
+SWITCH_MARGIN = 0.25
+# every position further down a channel's candidate list scales the score by this; 1 / PRIORITY_WEIGHT is above
+# 1 + SWITCH_MARGIN, so a preferred source that recovers takes over again
+PRIORITY_WEIGHT = 0.75
+SWITCH_HOLD_S = 2.0
+
+# values outside these ranges are implausible and not used
+PLAUSIBLE_RANGES = {
+    DATA_POINT_HEART_RATE: (25, 240),
+    DATA_POINT_POWER: (0, 3000),
+    DATA_POINT_CADENCE: (0, 220),
+    DATA_POINT_SPEED: (0, 120),
+    DATA_POINT_DISTANCE: (0, 100000),
+}
+# recorded as unsigned integers, see SampleBuffer
+INTEGER_DATA_POINTS = frozenset((DATA_POINT_HEART_RATE, DATA_POINT_POWER))
+# running totals: never fused or zeroed, and kept continuous when the source changes
+CUMULATIVE_DATA_POINTS = frozenset((DATA_POINT_DISTANCE,))
+
+
+class SourceCandidate:
+    # What the arbiter knows about one candidate source of its channel
+    __slots__ = ('sensor', 'weight', 'value', 'last_time', 'interval', 'last_change_time', 'plausibility', 'score',
+                 'late')
+
+    def __init__(self, sensor, weight):
+        self.sensor = sensor
+        self.weight = weight
+        self.value = None
+        self.last_time = None
+        self.interval = None
+        self.last_change_time = None
+        self.plausibility = 1.0
+        self.score = 0.0
+        # no sample within FRESH_INTERVALS of the source's update interval
+        self.late = True
+
+    def add(self, timestamp, value, plausible):
+        self.plausibility += PLAUSIBILITY_SMOOTHING * ((1.0 if plausible else 0.0) - self.plausibility)
+        if not plausible:
+            return
+        if self.last_time is not None and timestamp > self.last_time:
+            interval = timestamp - self.last_time
+            self.interval = interval if self.interval is None else \
+                self.interval + INTERVAL_SMOOTHING * (interval - self.interval)
+        if value != self.value:
+            self.last_change_time = timestamp
+        self.value = value
+        self.last_time = timestamp
+
+    def update_score(self, now):
+        if self.last_time is None:
+            self.score = 0.0
+            self.late = True
+            return self.score
+        interval = self.interval if self.interval is not None else DEFAULT_SOURCE_INTERVAL_S
+        fresh_for = FRESH_INTERVALS * interval
+        stale_after = max(MIN_STALE_AFTER_S, STALE_INTERVALS * interval)
+        age = now - self.last_time
+        self.late = age > fresh_for
+        if age >= stale_after:
+            freshness = 0.0
+        elif age <= fresh_for:
+            freshness = 1.0
+        else:
+            freshness = (stale_after - age) / (stale_after - fresh_for)
+        rate = min(1.0, REFERENCE_INTERVAL_S / interval)
+        frozen = FROZEN_PENALTY if self.value and now - self.last_change_time > FROZEN_AFTER_S else 1.0
+        self.score = self.weight * freshness * rate * self.plausibility * frozen
+        return self.score
+
+
+class SourceArbiter(AbstractSensorProxy):
+    # One recorded channel fed by several candidate sensors, e.g. cadence from the ANT+ CSC sensor and from the
+    # trainer's FE-C data. The arbiter reads the candidates' samples off the bus and scores every candidate by
+    # freshness, update rate, plausibility of its values and its position in the config; a source that stalls fades
+    # out within a few of its update intervals. With ARBITRATION_SWITCH the best source is used, and another source
+    # only takes over when it scored SWITCH_MARGIN better for SWITCH_HOLD_S, or at once when the selected one is late
+    # with its next update. With ARBITRATION_FUSE the fresh sources are averaged, weighted by their scores.
+    # The chosen value is published on the bus with the arbiter as source, so recording, overlay and telemetry use the
+    # arbiter like a sensor. Without any fresh source the channel drops to 0 instead of freezing at its last value;
+    # running totals (distance) hold and continue from the next source without a jump.
+    def __init__(self, data_point, sensors, data_bus: SensorDataBus.SensorDataBus, mode=ARBITRATION_SWITCH, name=None,
+                 update_interval=DEFAULT_UPDATE_INTERVAL_S):
+        if mode not in (ARBITRATION_SWITCH, ARBITRATION_FUSE):
+            raise ValueError(f"unknown arbitration mode {mode}")
+        super().__init__(0, data_bus, name or f"arbiter {data_point}")
+        self.data_point = data_point
+        self.mode = ARBITRATION_SWITCH if data_point in CUMULATIVE_DATA_POINTS else mode
+        self.update_interval = update_interval
+        self.candidates = {sensor: SourceCandidate(sensor, PRIORITY_WEIGHT ** position)
+                           for position, sensor in enumerate(sensors)}
+        self.selected = None
+        self.challenger = None
+        self.challenger_since = None
+        self.offset = 0.0
+        self.value = None
+        self.switches = METRICS.counter("arbiter_switches", self.name)
+
+    def __str__(self):
+        return f"SourceArbiter({self.name})"
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.running = True
+        subscription = self.data_bus.subscribe((self.data_point,))
+        # the arbiter has nothing to connect to, the sensor runtime should not wait for it
+        self.set_connected(True)
+        try:
+            while self.running:
+                await asyncio.sleep(self.update_interval)
+                dropped = subscription.dropped
+                self.update(subscription.poll(), time.time())
+                if subscription.dropped != dropped:
+                    self.read_sensor_values(time.time())
+        finally:
+            subscription.close()
+            self.set_connected(False)
+
+    def stop(self):
+        self.running = False
+
+    def read_sensor_values(self, now):
+        # the candidates' current values, after the bus overran our subscription
+        for sensor, candidate in self.candidates.items():
+            if sensor.connected:
+                self.add_value(candidate, now, getattr(sensor, LAST_VALUE_ATTRIBUTES[self.data_point]))
+
+    def add_value(self, candidate, timestamp, value):
+        low, high = PLAUSIBLE_RANGES[self.data_point]
+        candidate.add(timestamp, value, value is not None and low <= value <= high)
+
+    def update(self, samples, now):
+        # Takes the candidates' new samples, rescores them and publishes the channel value when it changed
+        for sample in samples:
+            candidate = self.candidates.get(sample[SensorDataBus.SAMPLE_SOURCE])
+            if candidate is not None:
+                self.add_value(candidate, sample[SensorDataBus.SAMPLE_TIMESTAMP], sample[SensorDataBus.SAMPLE_VALUE])
+        for candidate in self.candidates.values():
+            candidate.update_score(now)
+        self.select(now)
+        value = self.get_value()
+        if value is not None and value != self.value:
+            self.value = value
+            self.publish(self.data_point, value)
+
+    def select(self, now):
+        best = max(self.candidates.values(), key=lambda candidate: candidate.score)
+        selected = self.selected
+        if best.score == 0.0 or best is selected:
+            self.challenger = None
+            return
+        if selected is not None and selected.score > 0.0 and not selected.late:
+            # hysteresis: a challenger has to stay clearly better for a while, unless the selected source missed its
+            # update and the challenger is better at all
+            if best.score < selected.score * (1 + SWITCH_MARGIN):
+                self.challenger = None
+                return
+            if self.challenger is not best:
+                self.challenger = best
+                self.challenger_since = now
+                return
+            if now - self.challenger_since < SWITCH_HOLD_S:
+                return
+        self.challenger = None
+        self.switch_to(best)
+
+    def switch_to(self, candidate):
+        if self.data_point in CUMULATIVE_DATA_POINTS and self.value is not None:
+            self.offset = self.value - candidate.value
+        if self.selected is not None:
+            self.switches.add()
+            LOG.info("Arbiter %s| switching from %s to %s", self.name, self.selected.sensor.name,
+                     candidate.sensor.name)
+        else:
+            LOG.info("Arbiter %s| using %s", self.name, candidate.sensor.name)
+        self.selected = candidate
+
+    def get_value(self):
+        selected = self.selected
+        if self.data_point in CUMULATIVE_DATA_POINTS:
+            if selected is None or selected.value is None:
+                return None
+            if self.value is not None and selected.value + self.offset < self.value:
+                # the sensor restarted its count, e.g. after a reconnect: continue from the total so far, like a switch
+                self.offset = self.value - selected.value
+            return selected.value + self.offset
+        if self.mode == ARBITRATION_FUSE:
+            fresh = [candidate for candidate in self.candidates.values() if candidate.score > 0.0]
+            if not fresh:
+                return 0
+            value = sum(candidate.value * candidate.score for candidate in fresh) / \
+                sum(candidate.score for candidate in fresh)
+        elif selected is None or selected.score == 0.0:
+            return 0
+        else:
+            value = selected.value
+        return round(value) if self.data_point in INTEGER_DATA_POINTS else value
+
+    def get_stats(self):
+        return {
+            "mode": self.mode,
+            "source": self.selected.sensor.name if self.selected is not None else None,
+            "value": self.value,
+            "switches": self.switches.get_stats(),
+            "scores": {candidate.sensor.name: round(candidate.score, 3) for candidate in self.candidates.values()},
+        }
@@ -0,0 +1,168 @@
+from bisect import bisect_right
+from collections import deque
+
+NORMALIZED_POWER_WINDOW_S = 30
+# longest time between two samples that still counts towards work and time in zones, e.g. across a marked gap
+MAX_SAMPLE_INTERVAL_S = 5.0
+
+# upper zone boundaries, a value above the last boundary is in the last zone
+DEFAULT_HR_ZONE_BOUNDARIES = (120, 140, 155, 170)
+DEFAULT_POWER_ZONE_BOUNDARIES = (110, 150, 180, 210, 240, 300)
+
+# highest value the LapMessage/SessionMessage fields can hold below their invalid values, in get_summary() units;
+# apply() clamps the summary to [0, highest value] so an outlier sample cannot fail writing the lap or session
+SUMMARY_FIELD_LIMITS = {
+    "total_elapsed_time": 0xFFFFFFFE / 1000,
+    "total_timer_time": 0xFFFFFFFE / 1000,
+    "avg_heart_rate": 0xFE,
+    "max_heart_rate": 0xFE,
+    "avg_power": 0xFFFE,
+    "max_power": 0xFFFE,
+    "total_work": 0xFFFFFFFE,
+    "normalized_power": 0xFFFE,
+    "avg_cadence": 0xFE,
+    "max_cadence": 0xFE,
+    "avg_speed": 0xFFFE / 1000,
+    "max_speed": 0xFFFE / 1000,
+    "total_distance": 0xFFFFFFFE / 100,
+}
+
+
+class SummaryAccumulator:
+    # Streaming lap/session statistics. Every sample is added in O(1) (the normalized power window is amortised O(1)),
+    # so filling a LapMessage or SessionMessage costs the same however long the lap was. Heart rate and cadence
+    # averages leave out zeros, power averages include them. Work and time in zones are weighted with the time since
+    # the previous sample.
+    __slots__ = ('start_time', 'hr_zones', 'power_zones', 'last_timestamp', 'hr_sum', 'hr_count', 'max_hr',
+                 'power_sum', 'power_count', 'max_power', 'cadence_sum', 'cadence_count', 'max_cadence', 'speed_sum',
+                 'speed_count', 'max_speed', 'first_distance', 'last_distance', 'work', 'np_start', 'np_window',
+                 'np_window_sum', 'np_sum', 'np_count', 'time_in_hr_zone', 'time_in_power_zone', 'paused_time')
+
+    def __init__(self, start_time, hr_zones=DEFAULT_HR_ZONE_BOUNDARIES, power_zones=DEFAULT_POWER_ZONE_BOUNDARIES):
+        # start_time in ms, like the FIT message timestamps FitWriter uses
+        self.start_time = start_time
+        self.hr_zones = hr_zones
+        self.power_zones = power_zones
+        self.last_timestamp = None
+        self.hr_sum = 0
+        self.hr_count = 0
+        self.max_hr = 0
+        self.power_sum = 0
+        self.power_count = 0
+        self.max_power = 0
+        self.cadence_sum = 0
+        self.cadence_count = 0
+        self.max_cadence = 0
+        self.speed_sum = 0.0
+        self.speed_count = 0
+        self.max_speed = 0.0
+        self.first_distance = None
+        self.last_distance = None
+        self.work = 0.0
+        self.np_start = None
+        self.np_window = deque()
+        self.np_window_sum = 0.0
+        self.np_sum = 0.0
+        self.np_count = 0
+        self.time_in_hr_zone = [0.0] * (len(hr_zones) + 1)
+        self.time_in_power_zone = [0.0] * (len(power_zones) + 1)
+        # seconds the timer was stopped, see FitWriter.add_timer_gap()
+        self.paused_time = 0.0
+
+    def add(self, timestamp, hr=None, power=None, cadence=None, speed=None, distance=None):
+        # timestamp in seconds, values in the units the record messages get them in
+        if self.last_timestamp is None:
+            dt = 0.0
+        else:
+            dt = min(timestamp - self.last_timestamp, MAX_SAMPLE_INTERVAL_S)
+        self.last_timestamp = timestamp
+
+        # heart rate, power and cadence as the integers RecordEncoder writes, so an average never exceeds its maximum
+        if hr:
+            hr = int(hr)
+            self.hr_sum += hr
+            self.hr_count += 1
+            if hr > self.max_hr:
+                self.max_hr = hr
+            self.time_in_hr_zone[bisect_right(self.hr_zones, hr)] += dt
+
+        if power is not None:
+            power = int(power)
+            self.power_sum += power
+            self.power_count += 1
+            if power > self.max_power:
+                self.max_power = power
+            self.work += power * dt
+            self.time_in_power_zone[bisect_right(self.power_zones, power)] += dt
+            if self.np_start is None:
+                self.np_start = timestamp
+            window = self.np_window
+            window.append((timestamp, power))
+            self.np_window_sum += power
+            while window[0][0] <= timestamp - NORMALIZED_POWER_WINDOW_S:
+                self.np_window_sum -= window.popleft()[1]
+            if timestamp - self.np_start + dt >= NORMALIZED_POWER_WINDOW_S:
+                self.np_sum += (self.np_window_sum / len(window)) ** 4
+                self.np_count += 1
+
+        if cadence:
+            cadence = int(cadence)
+            self.cadence_sum += cadence
+            self.cadence_count += 1
+            if cadence > self.max_cadence:
+                self.max_cadence = cadence
+
+        if speed is not None:
+            self.speed_sum += speed
+            self.speed_count += 1
+            if speed > self.max_speed:
+                self.max_speed = speed
+
+        if distance is not None:
+            if self.first_distance is None:
+                self.first_distance = distance
+            self.last_distance = distance
+
+    @property
+    def normalized_power(self):
+        if not self.np_count:
+            return None
+        return (self.np_sum / self.np_count) ** 0.25
+
+    def get_summary(self, end_time):
+        # Summary values under their LapMessage/SessionMessage field names, only for data points that were recorded;
+        # end_time in ms
+        elapsed_time = (end_time - self.start_time) / 1000
+        summary = {
+            "start_time": self.start_time,
+            "timestamp": end_time,
+            "total_elapsed_time": elapsed_time,
+            "total_timer_time": max(0.0, elapsed_time - self.paused_time),
+        }
+        if self.hr_count:
+            summary["avg_heart_rate"] = round(self.hr_sum / self.hr_count)
+            summary["max_heart_rate"] = self.max_hr
+            summary["time_in_hr_zone"] = list(self.time_in_hr_zone)
+        if self.power_count:
+            summary["avg_power"] = round(self.power_sum / self.power_count)
+            summary["max_power"] = self.max_power
+            summary["total_work"] = round(self.work)
+            summary["time_in_power_zone"] = list(self.time_in_power_zone)
+            if self.np_count:
+                summary["normalized_power"] = round(self.normalized_power)
+        if self.cadence_count:
+            summary["avg_cadence"] = round(self.cadence_sum / self.cadence_count)
+            summary["max_cadence"] = round(self.max_cadence)
+        if self.speed_count:
+            summary["avg_speed"] = self.speed_sum / self.speed_count
+            summary["max_speed"] = self.max_speed
+        if self.first_distance is not None:
+            summary["total_distance"] = self.last_distance - self.first_distance
+        return summary
+
+    def apply(self, message, end_time):
+        # Fills the summary fields LapMessage and SessionMessage have in common
+        for field_name, value in self.get_summary(end_time).items():
+            if field_name in SUMMARY_FIELD_LIMITS:
+                value = min(SUMMARY_FIELD_LIMITS[field_name], max(0, value))
+            setattr(message, field_name, value)
@@ -0,0 +1,299 @@
+import asyncio
+import base64
+import hashlib
+import logging
+import socket
+import struct
+import time
+from collections import deque
+
+import SensorDataBus
+from AbstractSensorProxy import LAST_VALUE_ATTRIBUTES
+
+LOG = logging.getLogger(__name__)
+
+DEFAULT_TELEMETRY_FRAME_RATE = 4
+DEFAULT_TELEMETRY_HOST = "127.0.0.1"
+# every this many frames all channels are sent, so UDP receivers and clients that lost frames catch up
+DEFAULT_KEYFRAME_INTERVAL = 20
+DEFAULT_CLIENT_QUEUE_FRAMES = 16
+# a UDP transport with more than this many bytes waiting skips frames until the next keyframe
+MAX_UDP_BUFFER_BYTES = 1 << 16
+# a WebSocket client stops taking frames off its queue once this much is buffered in its transport, so stale frames
+# are dropped from the queue instead of piling up in asyncio's write buffer
+WEBSOCKET_WRITE_BUFFER_BYTES = 4096
+MULTICAST_TTL = 1
+
+# Frame: header, then one (data point, value) pair per channel in the frame. Data points are the
+# DataPoints ids. Delta frames only carry the channels that changed since the previous frame.
+TELEMETRY_FRAME_VERSION = 1
+TELEMETRY_FLAG_KEYFRAME = 0x01
+# version, flags, sequence, unix time in seconds, number of values
+TELEMETRY_FRAME_HEADER = struct.Struct('<BBHdB')
+TELEMETRY_FRAME_VALUE = struct.Struct('<Bf')
+
+WEBSOCKET_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+WEBSOCKET_OPCODE_BINARY = 0x2
+WEBSOCKET_OPCODE_CLOSE = 0x8
+WEBSOCKET_OPCODE_PING = 0x9
+WEBSOCKET_OPCODE_PONG = 0xA
+WEBSOCKET_MAX_CLIENT_FRAME = 1 << 16
+
+
+def encode_frame(sequence, timestamp, values, keyframe=False):
+    frame = bytearray(TELEMETRY_FRAME_HEADER.pack(TELEMETRY_FRAME_VERSION, TELEMETRY_FLAG_KEYFRAME if keyframe else 0,
+                                                  sequence & 0xFFFF, timestamp, len(values)))
+    for data_point, value in values.items():
+        frame += TELEMETRY_FRAME_VALUE.pack(data_point, value)
+    return bytes(frame)
+
+
+def decode_frame(frame):
+    # (sequence, timestamp, keyframe, {data point: value})
+    version, flags, sequence, timestamp, n_values = TELEMETRY_FRAME_HEADER.unpack_from(frame)
+    if version != TELEMETRY_FRAME_VERSION:
+        raise ValueError(f"unknown telemetry frame version {version}")
+    values = {}
+    for i in range(n_values):
+        data_point, value = TELEMETRY_FRAME_VALUE.unpack_from(frame, TELEMETRY_FRAME_HEADER.size +
+                                                              i * TELEMETRY_FRAME_VALUE.size)
+        values[data_point] = value
+    return sequence, timestamp, bool(flags & TELEMETRY_FLAG_KEYFRAME), values
+
+
+def encode_websocket_frame(payload, opcode=WEBSOCKET_OPCODE_BINARY):
+    # Server frames are never masked
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+async def read_websocket_frame(reader):
+    # (opcode, payload) of the next client frame; client frames are always masked
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        length, = struct.unpack('!H', await reader.readexactly(2))
+    elif length == 127:
+        length, = struct.unpack('!Q', await reader.readexactly(8))
+    if length > WEBSOCKET_MAX_CLIENT_FRAME:
+        raise ConnectionError(f"client frame of {length} bytes")
+    mask = await reader.readexactly(4) if second & 0x80 else bytes(4)
+    payload = bytearray(await reader.readexactly(length))
+    for i in range(length):
+        payload[i] ^= mask[i & 3]
+    return first & 0x0F, bytes(payload)
+
+
+class TelemetryClient:
+    # A bounded frame queue. A client that falls behind loses its queued frames, which only make sense in order, and
+    # gets a keyframe in their place, so a slow client costs at most `max_frames` frames of memory and catches up
+    # with the current values as soon as it reads again.
+    def __init__(self, name, writer, max_frames=DEFAULT_CLIENT_QUEUE_FRAMES):
+        self.name = name
+        self.writer = writer
+        self.frames = deque()
+        self.max_frames = max_frames
+        self.frame_ready = asyncio.Event()
+        self.sent = 0
+        self.dropped = 0
+
+    def push(self, frame, get_keyframe):
+        if len(self.frames) >= self.max_frames:
+            self.dropped += len(self.frames)
+            self.frames.clear()
+            frame = get_keyframe()
+        self.frames.append(frame)
+        self.frame_ready.set()
+
+
+class TelemetryServer:
+    # Pushes the live channel values to local consumers (OBS overlays, dashboards, other riders' screens) as compact
+    # binary frames over WebSocket and/or UDP multicast. Bus samples are coalesced into one frame per frame period
+    # that only carries the channels that changed, with a keyframe of every channel every `keyframe_interval` frames.
+    # channel_sensors ({data point: sensor}) limits every channel to its configured sensor, like the recording does;
+    # without it the newest sample of each data point wins.
+    def __init__(self, data_bus: SensorDataBus.SensorDataBus, channel_sensors=None,
+                 frame_rate=DEFAULT_TELEMETRY_FRAME_RATE, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL,
+                 client_queue_frames=DEFAULT_CLIENT_QUEUE_FRAMES):
+        self.data_bus = data_bus
+        self.channel_sensors = channel_sensors
+        self.frame_period = 1 / frame_rate
+        self.keyframe_interval = keyframe_interval
+        self.client_queue_frames = client_queue_frames
+        self.values = {}
+        self.sent_values = {}
+        self.sequence = 0
+        self.last_keyframe_sequence = None
+        self.clients = set()
+        self.servers = []
+        self.udp_transport = None
+        self.udp_address = None
+        self.running = False
+        self.frames = 0
+        self.udp_skipped = 0
+
+    async def start_websocket(self, host=DEFAULT_TELEMETRY_HOST, port=0):
+        server = await asyncio.start_server(self.handle_websocket, host, port)
+        self.servers.append(server)
+        port = server.sockets[0].getsockname()[1]
+        LOG.info("Telemetry| WebSocket on ws://%s:%d/", host, port)
+        return port
+
+    async def start_multicast(self, group, port, interface="0.0.0.0"):
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, MULTICAST_TTL)
+        udp_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.udp_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                                                            sock=udp_socket)
+        self.udp_address = (group, port)
+        LOG.info("Telemetry| UDP multicast to %s:%d", group, port)
+
+    async def run(self):
+        # Builds and sends frames until stop(); the servers are started before, with start_websocket() and
+        # start_multicast()
+        self.running = True
+        subscription = self.data_bus.subscribe(LAST_VALUE_ATTRIBUTES)
+        self.read_sensor_values()
+        loop = asyncio.get_running_loop()
+        next_frame = loop.time()
+        try:
+            while self.running:
+                next_frame += self.frame_period
+                await asyncio.sleep(max(0.0, next_frame - loop.time()))
+                if loop.time() - next_frame > self.frame_period:
+                    # behind schedule, skip the frames instead of sending a burst
+                    next_frame = loop.time()
+                self.add_samples(subscription.poll())
+                if subscription.dropped:
+                    subscription.dropped = 0
+                    self.read_sensor_values()
+                self.send_frame()
+        finally:
+            subscription.close()
+            await self.close()
+
+    def stop(self):
+        self.running = False
+
+    def read_sensor_values(self):
+        # current values straight from the sensors, at startup and after the bus overran our subscription
+        for data_point, sensor in (self.channel_sensors or {}).items():
+            if sensor is not None:
+                self.values[data_point] = getattr(sensor, LAST_VALUE_ATTRIBUTES[data_point])
+
+    def add_samples(self, samples):
+        for sample in samples:
+            data_point = sample[SensorDataBus.SAMPLE_DATA_POINT]
+            source = sample[SensorDataBus.SAMPLE_SOURCE]
+            if self.channel_sensors is None or self.channel_sensors.get(data_point) is source:
+                self.values[data_point] = sample[SensorDataBus.SAMPLE_VALUE]
+
+    def get_keyframe(self):
+        return encode_frame(self.sequence, time.time(), self.values, keyframe=True)
+
+    def send_frame(self):
+        keyframe = self.last_keyframe_sequence is None or self.sequence - self.last_keyframe_sequence >= \
+            self.keyframe_interval
+        if keyframe:
+            values = self.values
+            self.last_keyframe_sequence = self.sequence
+        else:
+            values = {data_point: value for data_point, value in self.values.items()
+                      if self.sent_values.get(data_point) != value}
+            if not values:
+                return
+        self.sequence += 1
+        frame = encode_frame(self.sequence, time.time(), values, keyframe)
+        self.sent_values = dict(self.values)
+        self.frames += 1
+        for client in self.clients:
+            client.push(frame, self.get_keyframe)
+        if self.udp_transport is not None:
+            if self.udp_transport.get_write_buffer_size() > MAX_UDP_BUFFER_BYTES:
+                self.udp_skipped += 1
+            else:
+                self.udp_transport.sendto(frame, self.udp_address)
+
+    async def handle_websocket(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        client = None
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            headers = {}
+            for line in request.decode("latin-1").split("\r\n")[1:]:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+            key = headers.get("sec-websocket-key")
+            if headers.get("upgrade", "").lower() != "websocket" or key is None:
+                writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                await writer.drain()
+                return
+            accept = base64.b64encode(hashlib.sha1(key.encode() + WEBSOCKET_GUID).digest())
+            writer.write(b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                         b"Sec-WebSocket-Accept: " + accept + b"\r\n\r\n")
+            writer.transport.set_write_buffer_limits(high=WEBSOCKET_WRITE_BUFFER_BYTES)
+            client = TelemetryClient(peer, writer, self.client_queue_frames)
+            # the first frame has every channel
+            client.push(self.get_keyframe(), self.get_keyframe)
+            self.clients.add(client)
+            LOG.info("Telemetry| client %s connected (%d clients)", peer, len(self.clients))
+            send_task = asyncio.create_task(self.send_frames(client))
+            try:
+                while True:
+                    opcode, payload = await read_websocket_frame(reader)
+                    if opcode == WEBSOCKET_OPCODE_CLOSE:
+                        writer.write(encode_websocket_frame(payload[:2], WEBSOCKET_OPCODE_CLOSE))
+                        break
+                    if opcode == WEBSOCKET_OPCODE_PING:
+                        writer.write(encode_websocket_frame(payload, WEBSOCKET_OPCODE_PONG))
+            finally:
+                send_task.cancel()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            if client is not None:
+                self.clients.discard(client)
+                LOG.info("Telemetry| client %s disconnected, %d frames sent, %d dropped", peer, client.sent,
+                         client.dropped)
+            writer.close()
+
+    @staticmethod
+    async def send_frames(client):
+        writer = client.writer
+        try:
+            while True:
+                await client.frame_ready.wait()
+                client.frame_ready.clear()
+                while client.frames:
+                    writer.write(encode_websocket_frame(client.frames.popleft()))
+                    client.sent += 1
+                    # a slow client blocks only here, while its queue keeps dropping frames
+                    await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def close(self):
+        for server in self.servers:
+            server.close()
+        for client in list(self.clients):
+            client.writer.close()
+        for server in self.servers:
+            await server.wait_closed()
+        self.servers = []
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+            self.udp_transport = None
+
+    def get_stats(self):
+        return {
+            "frames": self.frames,
+            "clients": len(self.clients),
+            "client_dropped": sum(client.dropped for client in self.clients),
+            "udp_skipped": self.udp_skipped,
+        }
@@ -0,0 +1,344 @@
+import asyncio
+import logging
+import threading
+import time
+
+import FECPages
+import SensorDataBus
+import Workout
+from DataPoints import (
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+)
+
+LOG = logging.getLogger(__name__)
+
+TRAINER_MODE_ERG = "erg"
+TRAINER_MODE_SIMULATION = "simulation"
+TRAINER_MODE_RESISTANCE = "resistance"
+
+# FE-C trainers send and expect pages at 4 Hz (doc/How-to FE-C over BLE v1_0_0.pdf)
+FEC_COMMAND_INTERVAL_S = 0.25
+# an unchanged command is sent again this often in case the trainer missed it
+FEC_KEEPALIVE_S = 5.0
+
+ERG_POWER_SMOOTHING_S = 3.0
+# W of correction per W of error and second
+ERG_INTEGRAL_GAIN = 0.1
+ERG_MAX_CORRECTION_W = 50
+# below this cadence the target is cut so the rider can spin back up instead of stalling against the trainer
+ERG_LOW_CADENCE_RPM = 50
+ERG_LOW_CADENCE_POWER_FRACTION = 0.5
+# while cadence changes faster than this the measured power lags the trainer and the correction is frozen
+ERG_CADENCE_CHANGE_RPM_S = 15
+
+DEFAULT_USER_WEIGHT_KG = 75
+DEFAULT_BIKE_WEIGHT_KG = 10
+DEFAULT_WHEEL_DIAMETER_M = 0.7
+
+
+class CommandLimiter:
+    # Coalesces trainer commands and spaces them at least `interval` apart. Pending commands are kept per slot, where
+    # all resistance mode pages share one slot, so only the newest command of a slot is ever sent. A command equal to
+    # the last one sent in its slot is dropped unless that was more than `keepalive` seconds ago.
+    def __init__(self, interval=FEC_COMMAND_INTERVAL_S, keepalive=FEC_KEEPALIVE_S):
+        self.interval = interval
+        self.keepalive = keepalive
+        # slot: (page, time it was first submitted)
+        self.pending = {}
+        # slot: (page, time it was sent)
+        self.last_sent = {}
+        self.last_send_time = None
+        self.sent = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def get_slot(page):
+        return FECPages.FEC_PAGE_TARGET_POWER if page[0] in FECPages.FEC_CONTROL_PAGES else page[0]
+
+    def submit(self, page, now):
+        slot = self.get_slot(page)
+        last_sent = self.last_sent.get(slot)
+        if last_sent is not None and last_sent[0] == page and now - last_sent[1] < self.keepalive:
+            # the trainer already has it, a change undone before it was sent is not sent at all
+            self.pending.pop(slot, None)
+            return
+        pending = self.pending.get(slot)
+        if pending is None:
+            self.pending[slot] = (page, now)
+        elif pending[0] != page:
+            self.coalesced += 1
+            self.pending[slot] = (page, pending[1])
+
+    def get_delay(self, now):
+        # seconds until the next command may be sent, None when there is nothing to send
+        if not self.pending:
+            return None
+        if self.last_send_time is None:
+            return 0.0
+        return max(0.0, self.last_send_time + self.interval - now)
+
+    def pop(self, now):
+        # (page, submit time) of the longest waiting command once it may be sent, otherwise None
+        if self.get_delay(now) != 0.0:
+            return None
+        slot = min(self.pending, key=lambda pending_slot: self.pending[pending_slot][1])
+        page, submit_time = self.pending.pop(slot)
+        self.last_sent[slot] = (page, now)
+        self.last_send_time = now
+        self.sent += 1
+        return page, submit_time
+
+    def forget(self, page):
+        # after a failed write, so the next submit of the page is sent again
+        slot = self.get_slot(page)
+        if slot in self.last_sent and self.last_sent[slot][0] == page:
+            del self.last_sent[slot]
+
+    def reset(self):
+        # e.g. after a reconnect, when the trainer may have lost every setting
+        self.last_sent.clear()
+
+
+class ErgController:
+    # Closes the loop around the trainer's own ERG mode. The power the trainer holds and the power measured on the
+    # power channel differ, e.g. with pedals as the power source, so the commanded power is the target plus an
+    # integral correction of the smoothed power error. The correction is frozen while the cadence changes quickly,
+    # when the trainer's flywheel makes the measured power lag and would wind it up, and below ERG_LOW_CADENCE_RPM the
+    # command is cut to a fraction of the target until the rider has spun back up.
+    def __init__(self, gain=ERG_INTEGRAL_GAIN, max_correction=ERG_MAX_CORRECTION_W,
+                 low_cadence_rpm=ERG_LOW_CADENCE_RPM):
+        self.gain = gain
+        self.max_correction = max_correction
+        self.low_cadence_rpm = low_cadence_rpm
+        self.target = 0
+        self.correction = 0.0
+        self.power = None
+        self.last_power_time = None
+        self.cadence = None
+        self.cadence_rate = 0.0
+        self.last_cadence_time = None
+
+    def set_target(self, target):
+        # the correction is kept, it is an offset between the trainer and the power source, not part of the target
+        self.target = target
+
+    def add_power(self, power, timestamp):
+        if self.power is None:
+            self.power = power
+        else:
+            dt = max(0.0, timestamp - self.last_power_time)
+            self.power += min(1.0, dt / ERG_POWER_SMOOTHING_S) * (power - self.power)
+            # a larger error is the trainer still settling on a new target, not an offset to correct
+            if self.is_steady() and abs(self.target - self.power) <= self.max_correction:
+                correction = self.correction + self.gain * (self.target - self.power) * dt
+                self.correction = min(self.max_correction, max(-self.max_correction, correction))
+        self.last_power_time = timestamp
+
+    def add_cadence(self, cadence, timestamp):
+        if self.cadence is not None and timestamp > self.last_cadence_time:
+            self.cadence_rate = (cadence - self.cadence) / (timestamp - self.last_cadence_time)
+        self.cadence = cadence
+        self.last_cadence_time = timestamp
+
+    def is_low_cadence(self):
+        return self.cadence is not None and self.cadence < self.low_cadence_rpm
+
+    def is_steady(self):
+        return self.target > 0 and not self.is_low_cadence() and abs(self.cadence_rate) <= ERG_CADENCE_CHANGE_RPM_S
+
+    def get_command(self):
+        if self.target > 0 and self.is_low_cadence():
+            return round(self.target * ERG_LOW_CADENCE_POWER_FRACTION)
+        return round(min(FECPages.FEC_MAX_TARGET_POWER_W, max(0.0, self.target + self.correction)))
+
+
+class TrainerController:
+    # Controls an FE-C trainer: ERG mode through ErgController, simulation mode with grades, basic resistance and
+    # structured workouts. Runs on its own thread, woken by every power and cadence sample on the bus, so a cadence
+    # change reaches the trainer within one command interval. Pages go out through the trainer proxy's
+    # write_fec_page() coroutine on the sensor loop, one write at a time and through a CommandLimiter, so commands
+    # never pile up on the trainer link.
+    def __init__(self, trainer, data_bus: SensorDataBus.SensorDataBus, ftp=Workout.DEFAULT_FTP,
+                 user_weight_kg=DEFAULT_USER_WEIGHT_KG, bike_weight_kg=DEFAULT_BIKE_WEIGHT_KG,
+                 wheel_diameter_m=DEFAULT_WHEEL_DIAMETER_M):
+        if not hasattr(trainer, "write_fec_page"):
+            raise ValueError(f"{trainer} cannot be controlled, only BLE and ANT+ sensors can send FE-C pages")
+        self.trainer = trainer
+        self.data_bus = data_bus
+        self.ftp = ftp
+        self.user_configuration_page = FECPages.encode_user_configuration_page(user_weight_kg, bike_weight_kg,
+                                                                               wheel_diameter_m)
+        self.erg = ErgController()
+        self.limiter = CommandLimiter()
+        self.mode = None
+        self.target = None
+        self.workout = None
+        self.workout_start = None
+        self.workout_step = None
+
+        self.running = False
+        self.thread = None
+        self.subscription = None
+        self.trainer_connected = False
+        self.write_future = None
+        self.write_page = None
+        self.write_submit_time = None
+
+        self.writes = 0
+        self.failed_writes = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.subscription = self.data_bus.subscribe((DATA_POINT_POWER, DATA_POINT_CADENCE))
+        self.thread = threading.Thread(target=self.run, name="TrainerController")
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.wake()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+    def wake(self):
+        if self.subscription is not None:
+            self.subscription.new_data.set()
+
+    def set_target_power(self, power):
+        FECPages.encode_target_power_page(power)
+        self.workout = None
+        self.set_target(TRAINER_MODE_ERG, power)
+
+    def set_grade(self, grade):
+        self.workout = None
+        self.set_target(TRAINER_MODE_SIMULATION, grade)
+
+    def set_resistance(self, resistance):
+        FECPages.encode_basic_resistance_page(resistance)
+        self.workout = None
+        self.set_target(TRAINER_MODE_RESISTANCE, resistance)
+
+    def set_target(self, mode, target):
+        # from other threads: the controller thread is woken to send the new command
+        self.apply_target(mode, target)
+        self.wake()
+
+    def apply_target(self, mode, target):
+        self.mode = mode
+        self.target = target
+        if mode == TRAINER_MODE_ERG:
+            self.erg.set_target(target)
+
+    def start_workout(self, workout: Workout.Workout):
+        LOG.info("Trainer| starting workout %s (%d steps, %.0fs)", workout.name, len(workout.steps), workout.duration)
+        self.workout_step = None
+        self.workout_start = time.monotonic()
+        self.workout = workout
+        self.wake()
+
+    def stop_workout(self):
+        self.workout = None
+
+    def update_workout(self, now):
+        workout = self.workout
+        elapsed = now - self.workout_start
+        step = workout.get_step_index(elapsed)
+        if step is None:
+            LOG.info("Trainer| workout %s finished", workout.name)
+            self.workout = None
+            return
+        if step != self.workout_step:
+            self.workout_step = step
+            LOG.info("Trainer| workout step %d/%d", step + 1, len(workout.steps))
+        target, value = workout.get_target(elapsed)
+        # on the controller thread itself, waking it would make every wait return at once
+        self.apply_target(TRAINER_MODE_ERG if target == Workout.TARGET_POWER else TRAINER_MODE_SIMULATION, value)
+
+    def get_command_page(self):
+        if self.mode == TRAINER_MODE_ERG:
+            return FECPages.encode_target_power_page(self.erg.get_command())
+        if self.mode == TRAINER_MODE_SIMULATION:
+            return FECPages.encode_track_resistance_page(self.target)
+        if self.mode == TRAINER_MODE_RESISTANCE:
+            return FECPages.encode_basic_resistance_page(self.target)
+        return None
+
+    def run(self):
+        try:
+            while self.running:
+                now = time.monotonic()
+                delay = self.limiter.get_delay(now)
+                if delay is None or self.write_future is not None or not self.trainer_connected:
+                    delay = FEC_COMMAND_INTERVAL_S
+                # cleared before polling, so neither a sample nor a finished write can slip past the wait
+                if self.subscription.new_data.wait(delay):
+                    self.subscription.new_data.clear()
+                for sample in self.subscription.poll():
+                    if sample[SensorDataBus.SAMPLE_DATA_POINT] == DATA_POINT_POWER:
+                        self.erg.add_power(sample[SensorDataBus.SAMPLE_VALUE], sample[SensorDataBus.SAMPLE_TIMESTAMP])
+                    else:
+                        self.erg.add_cadence(sample[SensorDataBus.SAMPLE_VALUE],
+                                             sample[SensorDataBus.SAMPLE_TIMESTAMP])
+                now = time.monotonic()
+                self.check_write(now)
+                if self.workout is not None:
+                    self.update_workout(now)
+                connected = self.trainer.connected
+                if connected and not self.trainer_connected:
+                    self.limiter.reset()
+                self.trainer_connected = connected
+                if not connected:
+                    continue
+                page = self.get_command_page()
+                if page is not None:
+                    # nothing is written to a trainer nobody asked to control, not even the user configuration
+                    self.limiter.submit(self.user_configuration_page, now)
+                    self.limiter.submit(page, now)
+                if self.write_future is None:
+                    command = self.limiter.pop(now)
+                    if command is not None:
+                        self.send(*command)
+        finally:
+            self.subscription.close()
+            self.subscription = None
+
+    def send(self, page, submit_time):
+        self.write_page = page
+        self.write_submit_time = submit_time
+        self.write_future = asyncio.run_coroutine_threadsafe(self.trainer.write_fec_page(page), self.trainer.loop)
+        self.write_future.add_done_callback(lambda _: self.wake())
+
+    def check_write(self, now):
+        if self.write_future is None or not self.write_future.done():
+            return
+        try:
+            self.write_future.result()
+            latency = now - self.write_submit_time
+            self.writes += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+        except Exception as e:
+            self.failed_writes += 1
+            self.limiter.forget(self.write_page)
+            LOG.warning("Trainer| writing page %#04x failed: %s", self.write_page[0], e)
+        self.write_future = None
+
+    def get_status(self):
+        return {
+            "mode": self.mode,
+            "target": self.target,
+            "command": self.erg.get_command() if self.mode == TRAINER_MODE_ERG else self.target,
+            "erg_correction": round(self.erg.correction, 1),
+            "workout": self.workout.name if self.workout is not None else None,
+            "workout_elapsed": time.monotonic() - self.workout_start if self.workout is not None else 0,
+            "writes": self.writes,
+            "failed_writes": self.failed_writes,
+            "coalesced": self.limiter.coalesced,
+            "mean_latency_ms": self.total_latency / self.writes * 1000 if self.writes else 0.0,
+            "max_latency_ms": self.max_latency * 1000,
+        }
@@ -0,0 +1,109 @@
+import json
+import xml.etree.ElementTree as ElementTree
+from bisect import bisect_right
+
+TARGET_POWER = "power"
+TARGET_GRADE = "grade"
+
+DEFAULT_FTP = 200
+
+
+class WorkoutStep:
+    # One interval with a target that ramps linearly from start to end; a steady interval has start == end
+    __slots__ = ('duration', 'target', 'start', 'end')
+
+    def __init__(self, duration, target, start, end=None):
+        if duration <= 0:
+            raise ValueError(f"workout step duration must be positive, got {duration}")
+        if target not in (TARGET_POWER, TARGET_GRADE):
+            raise ValueError(f"unknown workout target {target}")
+        self.duration = duration
+        self.target = target
+        self.start = start
+        self.end = start if end is None else end
+
+    def get_value(self, elapsed):
+        return self.start + (self.end - self.start) * min(1.0, elapsed / self.duration)
+
+
+class Workout:
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = list(steps)
+        self.step_starts = []
+        self.duration = 0
+        for step in self.steps:
+            self.step_starts.append(self.duration)
+            self.duration += step.duration
+
+    def get_step_index(self, elapsed):
+        # None once the workout is over
+        if elapsed < 0 or elapsed >= self.duration:
+            return None
+        return bisect_right(self.step_starts, elapsed) - 1
+
+    def get_target(self, elapsed):
+        # (target, value) at `elapsed` seconds into the workout, None once it is over
+        index = self.get_step_index(elapsed)
+        if index is None:
+            return None
+        step = self.steps[index]
+        return step.target, step.get_value(elapsed - self.step_starts[index])
+
+
+def parse_json_steps(step_configs, ftp):
+    # {"duration": s, "power": W | [from, to]}, {"duration": s, "ftp": fraction | [from, to]},
+    # {"duration": s, "grade": % | [from, to]} and {"repeat": n, "steps": [...]}
+    steps = []
+    for step_config in step_configs:
+        if "repeat" in step_config:
+            steps += parse_json_steps(step_config["steps"], ftp) * step_config["repeat"]
+            continue
+        if "power" in step_config:
+            target, values, scale = TARGET_POWER, step_config["power"], 1
+        elif "ftp" in step_config:
+            target, values, scale = TARGET_POWER, step_config["ftp"], ftp
+        elif "grade" in step_config:
+            target, values, scale = TARGET_GRADE, step_config["grade"], 1
+        else:
+            raise ValueError(f"workout step {step_config} has no power, ftp or grade target")
+        if not isinstance(values, list):
+            values = [values]
+        steps.append(WorkoutStep(step_config["duration"], target, values[0] * scale, values[-1] * scale))
+    return steps
+
+
+def parse_zwo_steps(workout_element, ftp):
+    # Zwift workout elements; powers are fractions of FTP, free rides become flat simulation mode
+    steps = []
+    for element in workout_element:
+        attributes = element.attrib
+        if element.tag == "SteadyState":
+            power = float(attributes["Power"]) * ftp
+            steps.append(WorkoutStep(float(attributes["Duration"]), TARGET_POWER, power))
+        elif element.tag in ("Warmup", "Cooldown", "Ramp"):
+            steps.append(WorkoutStep(float(attributes["Duration"]), TARGET_POWER, float(attributes["PowerLow"]) * ftp,
+                                     float(attributes["PowerHigh"]) * ftp))
+        elif element.tag == "IntervalsT":
+            on_step = WorkoutStep(float(attributes["OnDuration"]), TARGET_POWER, float(attributes["OnPower"]) * ftp)
+            off_step = WorkoutStep(float(attributes["OffDuration"]), TARGET_POWER, float(attributes["OffPower"]) * ftp)
+            steps += [on_step, off_step] * int(attributes.get("Repeat", 1))
+        elif element.tag in ("FreeRide", "MaxEffort"):
+            steps.append(WorkoutStep(float(attributes["Duration"]), TARGET_GRADE, 0.0))
+        else:
+            raise ValueError(f"unsupported workout element {element.tag}")
+    return steps
+
+
+def load_workout(file_name, ftp=DEFAULT_FTP):
+    # A JSON workout ({"name": ..., "ftp": ..., "steps": [...]}) or a Zwift .zwo file
+    if file_name.lower().endswith(".zwo"):
+        root = ElementTree.parse(file_name).getroot()
+        workout_element = root.find("workout")
+        if workout_element is None:
+            raise ValueError(f"{file_name} has no workout element")
+        return Workout(root.findtext("name", file_name), parse_zwo_steps(workout_element, ftp))
+    with open(file_name) as workout_file:
+        workout_config = json.load(workout_file)
+    return Workout(workout_config.get("name", file_name),
+                   parse_json_steps(workout_config["steps"], workout_config.get("ftp", ftp)))
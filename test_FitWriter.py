@@ -0,0 +1,37 @@
+import time
+
+import FitReader
+import FitWriter
+import SampleBuffer
+from DataPoints import (
+    DATA_POINT_TIME,
+    DATA_POINT_HEART_RATE,
+    DATA_POINT_POWER,
+    DATA_POINT_CADENCE,
+    DATA_POINT_SPEED,
+    DATA_POINT_DISTANCE,
+)
+
+DATA_POINTS = (DATA_POINT_TIME, DATA_POINT_HEART_RATE, DATA_POINT_POWER, DATA_POINT_CADENCE, DATA_POINT_SPEED,
+               DATA_POINT_DISTANCE)
+
+
+def test_out_of_range_values_are_clamped(tmp_path):
+    # a speed or cadence beyond its FIT field used to fail add_samples() and then stop_writing(), losing the ride
+    file_name = str(tmp_path / "ride.fit")
+    start_time = time.time()
+    fit_writer = FitWriter.FitWriter(streaming=True)
+    fit_writer.start_writing(file_name, round(start_time * 1000))
+    samples = SampleBuffer.SampleBuffer(DATA_POINTS)
+    for i in range(10):
+        samples.append(start_time + i, 120, 200, 90, 30.0, i * 0.01)
+    samples.append(start_time + 10, 120, 200, 300, 70.0, 0.1)
+    fit_writer.add_samples(samples)
+    fit_writer.add_record({DATA_POINT_TIME: start_time + 11, DATA_POINT_CADENCE: 999, DATA_POINT_SPEED: 1e6})
+    fit_writer.stop_writing(round((start_time + 12) * 1000))
+
+    assert not fit_writer.file_open
+    rows = list(FitReader.iter_records(file_name))
+    assert len(rows) == 12
+    assert rows[10][1:5] == [120, 200, 254, 65.534]
+    assert rows[11][3:5] == [254, 65.534]